@@ -56,6 +56,9 @@ except totpcgi.backends.BackendNotSupported, ex:
             'Backend engine not supported: %s' % ex)
     sys.exit(1)
 
+if config.has_option('secret', 'kdf_iterations'):
+    totpcgi.utils.set_kdf_iterations(config.getint('secret', 'kdf_iterations'))
+
 syslog.openlog('provisioning.cgi', syslog.LOG_PID, syslog.LOG_AUTH)
 
 def bad_request(config, why):
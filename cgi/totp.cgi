@@ -28,6 +28,7 @@ cgitb.enable()
 
 import totpcgi
 import totpcgi.backends
+import totpcgi.ratelimit
 
 if len(sys.argv) > 1:
     # blindly assume it's the config file
@@ -42,6 +43,10 @@ config.read(config_file)
 
 require_pincode = config.getboolean('main', 'require_pincode')
 success_string  = config.get('main', 'success_string')
+token_first = (config.has_option('main', 'token_first')
+               and config.getboolean('main', 'token_first'))
+
+source_limiter = totpcgi.ratelimit.load_from_config(config)
 
 backends = totpcgi.backends.Backends()
 
@@ -82,7 +87,13 @@ def cgimain():
     if mode != 'PAM_SM_AUTH':
         bad_request('We only support PAM_SM_AUTH')
 
-    ga = totpcgi.GoogleAuthenticator(backends, require_pincode)
+    if source_limiter is not None and not source_limiter.allow(remote_host):
+        syslog.syslog(syslog.LOG_NOTICE,
+            'Rejected: user=%s, mode=%s, host=%s, message=Source limit reached' % (
+                user, mode, remote_host))
+        bad_request('Too many attempts, please try again later')
+
+    ga = totpcgi.GoogleAuthenticator(backends, require_pincode, token_first)
 
     try:
         status = ga.verify_user_token(user, token)
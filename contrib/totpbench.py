@@ -0,0 +1,199 @@
+#!/usr/bin/python -tt
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from optparse import OptionParser
+
+import totpcgi
+
+
+def report(label, latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    print '%-12s %9.1f ops/s   avg %8.3f ms   p50 %8.3f ms   p99 %8.3f ms' % (
+        label, count/elapsed,
+        sum(latencies)/count*1000,
+        latencies[count/2]*1000,
+        latencies[min(count-1, int(count*0.99))]*1000)
+
+
+def run_threads(func, threads):
+    workers = []
+    for n in xrange(threads):
+        worker = threading.Thread(target=func, args=(n,))
+        workers.append(worker)
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return time.time() - start
+
+
+def state_durability(opts, args):
+    import totpcgi.backends.file
+
+    print 'File state backend writes, %s threads x %s logins, in %s' % (
+        opts.threads, opts.iterations, opts.dir or tempfile.gettempdir())
+
+    for durability in ('none', 'fsync', 'group'):
+        state_dir = tempfile.mkdtemp(dir=opts.dir)
+        backend = totpcgi.backends.file.GAStateBackend(state_dir, durability=durability)
+
+        latencies = []
+
+        def worker(n):
+            user = 'bench%s' % n
+            for i in xrange(opts.iterations):
+                start = time.time()
+                state = backend.get_user_state(user)
+                state.success_timestamps = [int(start)]
+                backend.update_user_state(user, state)
+                latencies.append(time.time() - start)
+
+        try:
+            elapsed = run_threads(worker, opts.threads)
+        finally:
+            shutil.rmtree(state_dir)
+
+        report(durability, latencies, elapsed)
+
+
+def pincode_schemes(opts, args):
+    import totpcgi.utils
+    import totpcgi.backends
+
+    from passlib.context import CryptContext
+
+    print 'Pincode verification, %s iterations per scheme' % opts.iterations
+
+    verify = totpcgi.backends.GAPincodeBackend._verify_by_hashcode
+
+    for algo in ('md5', 'sha256', 'sha512', 'bcrypt'):
+        hashcode = totpcgi.utils.hash_pincode('benchmark', algo)
+
+        # what every verification used to pay on top of the hash itself
+        latencies = []
+        start = time.time()
+        for i in xrange(opts.iterations):
+            vstart = time.time()
+            CryptContext(schemes=['sha256_crypt', 'sha512_crypt',
+                                  'bcrypt', 'md5_crypt']).verify('benchmark', hashcode)
+            latencies.append(time.time() - vstart)
+        report('%s/old' % algo, latencies, time.time() - start)
+
+        latencies = []
+        start = time.time()
+        for i in xrange(opts.iterations):
+            vstart = time.time()
+            verify('benchmark', hashcode)
+            latencies.append(time.time() - vstart)
+        report(algo, latencies, time.time() - start)
+
+
+def crypto_providers(opts, args):
+    import os
+    import totpcgi.utils
+    import totpcgi.crypto
+
+    print 'Chosen providers: pbkdf2=%s, aes=%s' % (
+        totpcgi.crypto.pbkdf2_provider, totpcgi.crypto.aes_provider)
+    print 'Key derivation with %s iterations, %s iterations per provider' % (
+        totpcgi.utils.kdf_iterations, opts.iterations)
+
+    salt = os.urandom(totpcgi.utils.SALT_SIZE)
+
+    for (name, func) in totpcgi.crypto.PBKDF2_PROVIDERS:
+        totpcgi.crypto.self_test(pbkdf2_func=func)
+
+        latencies = []
+        start = time.time()
+        for i in xrange(opts.iterations):
+            vstart = time.time()
+            func('benchmark', salt, totpcgi.utils.kdf_iterations,
+                 totpcgi.utils.KEY_SIZE*2)
+            latencies.append(time.time() - vstart)
+        report('pbkdf2/%s' % name, latencies, time.time() - start)
+
+    key = os.urandom(totpcgi.utils.KEY_SIZE)
+    iv = os.urandom(totpcgi.utils.AES_BLOCK_SIZE)
+    # a padded base32 secret
+    data = os.urandom(totpcgi.utils.AES_BLOCK_SIZE*2)
+
+    for (name, func) in totpcgi.crypto.AES_PROVIDERS:
+        totpcgi.crypto.self_test(aes_func=func)
+
+        latencies = []
+        start = time.time()
+        for i in xrange(opts.iterations):
+            vstart = time.time()
+            func(key, iv, data, False)
+            latencies.append(time.time() - vstart)
+        report('aes/%s' % name, latencies, time.time() - start)
+
+    latencies = []
+    start = time.time()
+    for i in xrange(opts.iterations):
+        vstart = time.time()
+        totpcgi.crypto.hmac_sha256(key, data)
+        latencies.append(time.time() - vstart)
+    report('hmac', latencies, time.time() - start)
+
+
+COMMANDS = {
+    'state-durability': state_durability,
+    'pincode-schemes': pincode_schemes,
+    'crypto-providers': crypto_providers,
+}
+
+if __name__ == '__main__':
+    usage = '''usage: %%prog [options] benchmark
+    Measures the cost of various totpcgi operations on this host.
+    Available benchmarks: %s
+    ''' % ', '.join(sorted(COMMANDS.keys()))
+
+    parser = OptionParser(usage=usage, version='0.1')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      default=8,
+                      help='Number of concurrent threads (%default)')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int',
+                      default=200,
+                      help='Iterations per thread (%default)')
+    parser.add_option('-d', '--dir', dest='dir', default=None,
+                      help='Where to put the files, use the same filesystem '
+                           'as your real state_dir (default: system tmpdir)')
+
+    (opts, args) = parser.parse_args()
+
+    if not args:
+        parser.error('Must specify benchmark')
+
+    if args[0] not in COMMANDS:
+        parser.error('Unknown benchmark: %s' % args[0])
+
+    COMMANDS[args[0]](opts, args)
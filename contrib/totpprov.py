@@ -238,8 +238,82 @@ def provision_user(backends, config, args):
 
     generate_user_token(backends, config, args, pincode)
 
+def shard_dirs(backends, config, args):
+    import totpcgi.backends.file
+
+    file_backends = (totpcgi.backends.file.GASecretBackend,
+                     totpcgi.backends.file.GAStateBackend)
+
+    for backend in (backends.secret_backend, backends.state_backend):
+        if not isinstance(backend, file_backends):
+            continue
+
+        if not backend.sharded:
+            print 'Error: set "sharded = True" for the file backends first'
+            sys.exit(1)
+
+    for backend in (backends.secret_backend, backends.state_backend):
+        if isinstance(backend, file_backends):
+            migrated = backend.migrate_to_sharded()
+            print 'Moved %s files into the sharded layout' % migrated
+
+
+def merge_state(backends, config, args):
+    import totpcgi.backends.file
+
+    if (not isinstance(backends.state_backend, totpcgi.backends.file.GAStateBackend)
+            or not backends.state_backend.peer_logs):
+        print 'Error: set "replication_log" and "replication_peers" for the file state backend first'
+        sys.exit(1)
+
+    merged = backends.state_backend.merge_peers()
+    print 'Merged %s state changes from peers' % merged
+
+
+def cluster_members(backends, config, args):
+    import totpcgi.cluster
+
+    if len(args) < 2:
+        print 'Error: give the new members, e.g. "one=10.0.0.1:8000, two=10.0.0.2:8000"'
+        sys.exit(1)
+
+    members = totpcgi.cluster.parse_members(' '.join(args[1:]))
+
+    # the members that are leaving need to hear about it, too
+    nodes = dict(members)
+    if config.has_option('cluster', 'members'):
+        nodes.update(totpcgi.cluster.parse_members(config.get('cluster', 'members')))
+
+    if not config.has_option('cluster', 'secret') or not config.get('cluster', 'secret'):
+        print 'Error: set "secret" in the [cluster] section first'
+        sys.exit(1)
+    secret = config.get('cluster', 'secret')
+
+    failed = totpcgi.cluster.announce_members(members, nodes, secret)
+    if failed:
+        print 'Error: could not reach %s' % ', '.join(failed)
+        sys.exit(1)
+
+    print 'Told %s nodes about the new members' % len(nodes)
+    print 'Remember to update "members" in totpcgi.conf and provisioning.conf'
+
+
+def calibrate_kdf(backends, config, args):
+    target_ms = 100
+    if len(args) > 1:
+        target_ms = int(args[1])
+
+    iterations = totpcgi.utils.calibrate_kdf(target_ms)
+    print 'Deriving a key with %s iterations takes about %s ms on this host.' % (
+        iterations, target_ms)
+    print 'To use it for newly encrypted secrets, set in provisioning.conf:'
+    print
+    print '[secret]'
+    print 'kdf_iterations = %s' % iterations
+
+
 if __name__ == '__main__':
-    usage = '''usage: %prog [-c provisioning.conf] command username
+    usage = '''usage: %prog [-c provisioning.conf] command [username|ms]
     Use this tool to provision totpcgi users and tokens. See manpage
     for more info on commands.
     '''
@@ -268,13 +342,31 @@ if __name__ == '__main__':
         syslog.syslog(syslog.LOG_CRIT, 
                 'Backend engine not supported: %s' % ex)
         sys.exit(1)
+
+    if config.has_option('secret', 'kdf_iterations'):
+        totpcgi.utils.set_kdf_iterations(config.getint('secret', 'kdf_iterations'))
     
     if not args:
         parser.error('Must specify command')
 
     command = args[0]
 
-    if command == 'delete-user':
+    if command == 'shard-dirs':
+        print 'Moving secret and state files into the sharded layout'
+        ays()
+        shard_dirs(backends, config, args)
+
+    elif command == 'merge-state':
+        merge_state(backends, config, args)
+
+    elif command == 'cluster-members':
+        cluster_members(backends, config, args)
+
+    elif command == 'calibrate-kdf':
+        print 'Measuring key derivation speed'
+        calibrate_kdf(backends, config, args)
+
+    elif command == 'delete-user':
         print 'Deleting user %s' % args[1]
         ays()
         delete_user(backends, config, args)
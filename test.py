@@ -25,10 +25,14 @@ import logging
 
 import totpcgi
 import totpcgi.backends
+import totpcgi.offload
 
 import sys
 import os
 import subprocess
+import tempfile
+import shutil
+import threading
 
 import bcrypt
 import crypt
@@ -47,6 +51,9 @@ mysql_connect_host = ''
 mysql_connect_user = ''
 mysql_connect_password = ''
 mysql_connect_db = ''
+sqlite_db = ''
+journal_dir = ''
+redis_url = ''
 
 SECRET_BACKEND = 'File'
 PINCODE_BACKEND = 'File'
@@ -87,6 +94,15 @@ def getBackends():
         import totpcgi.backends.mysql
         backends.state_backend = totpcgi.backends.mysql.GAStateBackend(mysql_connect_host, mysql_connect_user,
                                                                        mysql_connect_password, mysql_connect_db)
+    elif STATE_BACKEND == 'sqlite':
+        import totpcgi.backends.sqlite
+        backends.state_backend = totpcgi.backends.sqlite.GAStateBackend(sqlite_db)
+    elif STATE_BACKEND == 'journal':
+        import totpcgi.backends.journal
+        backends.state_backend = totpcgi.backends.journal.GAStateBackend(journal_dir)
+    elif STATE_BACKEND == 'redis':
+        import totpcgi.backends.redis
+        backends.state_backend = totpcgi.backends.redis.GAStateBackend(redis_url)
 
     if SECRET_BACKEND == 'File':
         backends.secret_backend = totpcgi.backends.file.GASecretBackend(secrets_dir)
@@ -95,6 +111,8 @@ def getBackends():
     elif SECRET_BACKEND == 'mysql':
         backends.secret_backend = totpcgi.backends.mysql.GASecretBackend(mysql_connect_host, mysql_connect_user,
                                                                          mysql_connect_password, mysql_connect_db)
+    elif SECRET_BACKEND == 'sqlite':
+        backends.secret_backend = totpcgi.backends.sqlite.GASecretBackend(sqlite_db)
 
     if PINCODE_BACKEND == 'File':
         backends.pincode_backend = totpcgi.backends.file.GAPincodeBackend(pincode_file)
@@ -103,6 +121,8 @@ def getBackends():
     elif PINCODE_BACKEND == 'mysql':
         backends.pincode_backend = totpcgi.backends.mysql.GAPincodeBackend(mysql_connect_host, mysql_connect_user,
                                                                            mysql_connect_password, mysql_connect_db)
+    elif PINCODE_BACKEND == 'sqlite':
+        backends.pincode_backend = totpcgi.backends.sqlite.GAPincodeBackend(sqlite_db)
     elif PINCODE_BACKEND == 'ldap':
         import totpcgi.backends.ldap
         backends.pincode_backend = totpcgi.backends.ldap.GAPincodeBackend(ldap_url, ldap_dn, ldap_cacert)
@@ -122,7 +142,7 @@ def setCustomPincode(pincode, algo='sha256', user='valid', makedb=True, addjunk=
     if PINCODE_BACKEND == 'File':
         backends.pincode_backend.save_user_hashcode(user, hashcode, makedb=makedb)
 
-    elif PINCODE_BACKEND in ('pgsql', 'mysql'):
+    elif PINCODE_BACKEND in ('pgsql', 'mysql', 'sqlite'):
         backends.pincode_backend.save_user_hashcode(user, hashcode)
 
     
@@ -144,6 +164,78 @@ def getValidUser():
     return totpcgi.GAUser('valid', backends)
 
 
+class StubLDAPConnection:
+    def __init__(self, stub, url):
+        self.stub = stub
+        self.url = url
+        self.broken = False
+        self.bound = None
+        self.protocol_version = 2
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, dn, password):
+        server = self.stub.servers[self.url]
+        server['binds'] += 1
+
+        if self.broken or not server['up']:
+            raise self.stub.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+        if server['passwords'].get(dn) != password:
+            self.bound = None
+            raise self.stub.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+
+        self.bound = dn
+
+    def unbind_s(self):
+        self.broken = True
+
+
+def useStubLDAP(*urls):
+    """ Swaps python-ldap for a stand-in talking to make-believe servers
+        at urls, and returns it along with totpcgi.backends.ldap imported
+        on top of it. Put things back with restoreLDAP."""
+    import types
+
+    stub = types.ModuleType('ldap')
+    stub.real = (sys.modules.get('ldap'), sys.modules.pop('totpcgi.backends.ldap', None))
+
+    class LDAPError(Exception):
+        pass
+
+    stub.LDAPError = LDAPError
+    for name in ('INVALID_CREDENTIALS', 'SERVER_DOWN', 'CONNECT_ERROR', 'TIMEOUT'):
+        setattr(stub, name, type(name, (LDAPError,), {}))
+    for name in ('OPT_X_TLS_CACERTFILE', 'OPT_REFERRALS', 'OPT_NETWORK_TIMEOUT',
+                 'OPT_TIMEOUT'):
+        setattr(stub, name, name)
+
+    stub.servers = dict((url, {'up': True, 'passwords': {}, 'binds': 0})
+                        for url in urls)
+    stub.connections = []
+
+    def initialize(url):
+        stub.connections.append(StubLDAPConnection(stub, url))
+        return stub.connections[-1]
+
+    stub.initialize = initialize
+    stub.set_option = lambda option, value: None
+
+    sys.modules['ldap'] = stub
+    import totpcgi.backends.ldap
+    return (stub, totpcgi.backends.ldap)
+
+
+def restoreLDAP(stub):
+    (real_ldap, real_backend) = stub.real
+    for (name, module) in (('ldap', real_ldap), ('totpcgi.backends.ldap', real_backend)):
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+
 class GATest(unittest.TestCase):
     def setUp(self):
         # Remove any existing state files for user "valid"
@@ -155,6 +247,8 @@ class GATest(unittest.TestCase):
             os.unlink(pincode_file)
         if os.access(pincode_file + '.db', os.W_OK):
             os.unlink(pincode_file + '.db')
+        if os.access(pincode_file + '.lock', os.W_OK):
+            os.unlink(pincode_file + '.lock')
 
     def testValidSecretParsing(self):
         logger.debug('Running testValidSecretParsing')
@@ -265,6 +359,53 @@ class GATest(unittest.TestCase):
         cleanState('hotp')
 
 
+    def testHOTPTables(self):
+        logger.debug('Running testHOTPTables')
+
+        otp = pyotp.HOTP(VALID_SECRET)
+        table = totpcgi.HOTPTable(otp, 50)
+
+        def first_match(token, counter, window_size):
+            for at_count in xrange(counter, counter+window_size+1):
+                if otp.at(at_count) == token:
+                    return at_count
+            return None
+
+        self.assertEqual(table.find(otp.at(10), 0, 20), 10)
+        self.assertEqual((table.start, table.end), (0, 50))
+        self.assertEqual(table.find(otp.at(30), 0, 20), first_match(otp.at(30), 0, 20))
+
+        logger.debug('Moving on should only compute the new counters')
+        self.assertEqual(table.find(otp.at(60), 40, 20), 60)
+        self.assertEqual((table.start, table.end), (40, 90))
+        self.assertEqual(len(table.tokens), 50)
+        self.assertEqual(sum(len(counters) for counters in table.codes.values()), 50)
+
+        logger.debug('Going back should start over')
+        self.assertEqual(table.find(otp.at(5), 5, 0), 5)
+        self.assertEqual((table.start, table.end), (5, 55))
+
+        logger.debug('Verifying with tables should work like without')
+        totpcgi.enable_hotp_tables(60, 10)
+        try:
+            backends = getBackends()
+            gau = totpcgi.GAUser('hotp', backends)
+            state = totpcgi.GAUserState()
+            state.counter = 0
+            setCustomState(state, 'hotp')
+
+            self.assertEqual(gau.verify_token(otp.at(0)), 'Valid HOTP token used')
+            with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'HOTP token failed to verify'):
+                gau.verify_token(otp.at(0))
+            self.assertEqual(gau.verify_token(otp.at(4)),
+                             'Valid HOTP token within window size used')
+            with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'HOTP token failed to verify'):
+                gau.verify_token(otp.at(12))
+            self.assertEqual(gau.verify_token(otp.at(5)), 'Valid HOTP token used')
+        finally:
+            totpcgi.hotp_tables = None
+            cleanState('hotp')
+
     def testTOTPWindowSize(self):
         logger.debug('Running testWindowSize')
         gau = getValidUser()
@@ -536,7 +677,7 @@ class GATest(unittest.TestCase):
 
             cleanState()
 
-        if PINCODE_BACKEND in ('pgsql', 'mysql'):
+        if PINCODE_BACKEND in ('pgsql', 'mysql', 'sqlite'):
             backends.pincode_backend.delete_user_hashcode('valid')
             logger.debug('Testing without a user pincode record present')
             with self.assertRaisesRegexp(totpcgi.UserNotFound, 
@@ -544,7 +685,7 @@ class GATest(unittest.TestCase):
                 ga.verify_user_token('valid', token)
 
 
-        if PINCODE_BACKEND in ('pgsql', 'mysql', 'File'):
+        if PINCODE_BACKEND in ('pgsql', 'mysql', 'sqlite', 'File'):
             logger.debug('Testing with 1-digit long pincode')
             setCustomPincode('1')
             ret = ga.verify_user_token('valid', '1'+tokencode)
@@ -652,6 +793,931 @@ class GATest(unittest.TestCase):
             'TOTP token failed to verify'):
             ga.verify_user_token(valid_user, pincode+'555555')
 
+    def testBoundedFailTimestamps(self):
+        logger.debug('Running testBoundedFailTimestamps')
+
+        backends = getBackends()
+        gau = getValidUser()
+
+        logger.debug('A flood of failures should not grow the state')
+        state = totpcgi.GAUserState()
+        now = int(time.time())
+        state.fail_timestamps = [now] * 100 + [now-3600] * 100
+        setCustomState(state)
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Rate-limit'):
+            gau.verify_token('555555')
+
+        state = backends.state_backend.get_user_state('valid')
+        backends.state_backend.update_user_state('valid', state)
+        # rate_limit is 4, 30 for the valid user
+        self.assertEqual(len(state.fail_timestamps), 4)
+
+        cleanState()
+
+        logger.debug('Neither should a flood of secret errors')
+        ga = totpcgi.GoogleAuthenticator(backends)
+        setCustomPincode('wakkawakka', user='encrypted-bad')
+        for i in xrange(15):
+            with self.assertRaises(totpcgi.UserSecretError):
+                ga.verify_user_token('encrypted-bad', 'wakkawakka555555')
+
+        state = backends.state_backend.get_user_state('encrypted-bad')
+        backends.state_backend.update_user_state('encrypted-bad', state)
+        self.assertTrue(len(state.fail_timestamps) <= totpcgi.FAIL_STEP_CAP*11)
+
+        cleanState(user='encrypted-bad')
+
+        logger.debug('...without dropping what a larger rate limit needs')
+        backends.set_max_rate_limit(20, 600)
+        state = totpcgi.GAUserState()
+        state.fail_timestamps = [now-500] * 15
+        setCustomState(state, user='encrypted-bad')
+
+        with self.assertRaises(totpcgi.UserSecretError):
+            ga.verify_user_token('encrypted-bad', 'wakkawakka555555')
+
+        state = backends.state_backend.get_user_state('encrypted-bad')
+        backends.state_backend.update_user_state('encrypted-bad', state)
+        self.assertEqual(len(state.fail_timestamps), 25)
+        self.assertNotEqual(totpcgi.get_lockout_until(state.fail_timestamps, (20, 600)),
+                            None)
+
+        cleanState(user='encrypted-bad')
+
+    def testOptimisticState(self):
+        logger.debug('Running testOptimisticState')
+
+        import totpcgi.backends.sqlite
+
+        db_dir = tempfile.mkdtemp()
+        db_file = os.path.join(db_dir, 'optimistic.db')
+
+        try:
+            first = totpcgi.backends.sqlite.GAStateBackend(db_file, optimistic=True)
+            second = totpcgi.backends.sqlite.GAStateBackend(db_file, optimistic=True)
+
+            logger.debug('The second writer of the same state should lose')
+            state = first.get_user_state('optimistic')
+            other = second.get_user_state('optimistic')
+            other.fail_timestamps.append(int(time.time())-3600)
+            second.update_user_state('optimistic', other)
+
+            with self.assertRaises(totpcgi.UserStateConflict):
+                first.update_user_state('optimistic', state)
+
+            state = first.get_user_state('optimistic')
+            self.assertEqual(len(state.fail_timestamps), 1)
+            first.update_user_state('optimistic', state)
+
+            logger.debug('GAUser should re-read the state and try again')
+
+            class Interfering(totpcgi.backends.GAStateBackend):
+                def __init__(self, times):
+                    totpcgi.backends.GAStateBackend.__init__(self)
+                    self.times = times
+
+                def get_user_state(self, user):
+                    state = first.get_user_state(user)
+                    if self.times:
+                        self.times -= 1
+                        second.update_user_state(user, second.get_user_state(user))
+                    return state
+
+                def update_user_state(self, user, state):
+                    first.update_user_state(user, state)
+
+                def abort_user_state(self, user):
+                    first.abort_user_state(user)
+
+            backends = getBackends()
+            secret = backends.secret_backend.get_user_secret('valid')
+            backends.state_backend = Interfering(1)
+            gau = totpcgi.GAUser('optimistic', backends)
+
+            self.assertEqual(gau.verify_token(secret.get_totp_token(), secret=secret),
+                             'Valid TOTP token used')
+
+            backends.state_backend = Interfering(totpcgi.STATE_CONFLICT_RETRIES)
+            with self.assertRaises(totpcgi.UserStateError):
+                gau.verify_token('555555', secret=secret)
+
+            first.delete_user_state('optimistic')
+
+        finally:
+            totpcgi.backends.sqlite.dbconn.conns.pop(db_file).close()
+            shutil.rmtree(db_dir)
+
+    def testThreadedSQLState(self):
+        logger.debug('Running testThreadedSQLState')
+
+        import threading
+        import totpcgi.backends.sqlite
+
+        db_dir = tempfile.mkdtemp()
+        db_file = os.path.join(db_dir, 'threaded.db')
+
+        try:
+            for optimistic in (False, True):
+                backend = totpcgi.backends.sqlite.GAStateBackend(db_file, optimistic=optimistic)
+                backend.set_lock_timeout(10)
+                user = 'threaded%s' % optimistic
+                errors = []
+
+                with backend.transaction(user) as state:
+                    pass
+
+                def same_user(n):
+                    try:
+                        for i in xrange(20):
+                            while True:
+                                try:
+                                    with backend.transaction(user) as state:
+                                        state.used_scratch_tokens.append(n*100+i)
+                                    break
+                                except totpcgi.UserStateConflict:
+                                    # someone else got there first, try again
+                                    pass
+                    except Exception, ex:
+                        errors.append(ex)
+
+                workers = [threading.Thread(target=same_user, args=(n,)) for n in xrange(4)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+
+                self.assertEqual(errors, [])
+                with backend.transaction(user) as state:
+                    self.assertEqual(sorted(state.used_scratch_tokens),
+                                     [n*100+i for n in xrange(4) for i in xrange(20)])
+                self.assertEqual(backend.versions.keys(), [])
+                self.assertEqual(backend.locks.keys(), [])
+                self.assertEqual(backend.held_locks(), [])
+                backend.delete_user_state(user)
+
+        finally:
+            totpcgi.backends.sqlite.dbconn.conns.pop(db_file).close()
+            shutil.rmtree(db_dir)
+
+    def testSQLiteUserIds(self):
+        logger.debug('Running testSQLiteUserIds')
+
+        import threading
+        import totpcgi.backends.sqlite
+
+        db_dir = tempfile.mkdtemp()
+        db_files = [os.path.join(db_dir, name) for name in ('first.db', 'second.db')]
+
+        try:
+            logger.debug('The same user may have different ids in different databases')
+            totpcgi.backends.sqlite.get_user_id(db_files[0], 'somebody')
+            ids = [totpcgi.backends.sqlite.get_user_id(db_file, 'shared') for db_file in db_files]
+            self.assertNotEqual(ids[0], ids[1])
+
+            for db_file, userid in zip(db_files, ids):
+                cur = totpcgi.backends.sqlite.db_connect(db_file).cursor()
+                cur.execute('SELECT userid FROM users WHERE username = ?', ('shared',))
+                self.assertEqual(cur.fetchone()[0], userid)
+
+            logger.debug('Concurrent first logins should all get the same id')
+            start = threading.Event()
+            found = {}
+            errors = []
+
+            def first_login(n):
+                start.wait()
+                try:
+                    for i in xrange(10):
+                        userid = totpcgi.backends.sqlite.get_user_id(db_files[1], 'fresh%s' % i)
+                        found.setdefault(i, set()).add(userid)
+                        # forget it again, so the next lookup goes to the database
+                        totpcgi.backends.sqlite.userids.pop((db_files[1], 'fresh%s' % i), None)
+                except Exception, ex:
+                    errors.append(ex)
+
+            workers = [threading.Thread(target=first_login, args=(n,)) for n in xrange(8)]
+            for thread in workers:
+                thread.start()
+            start.set()
+            for thread in workers:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            for i in xrange(10):
+                self.assertEqual(len(found[i]), 1)
+
+        finally:
+            for db_file in db_files:
+                totpcgi.backends.sqlite.dbconn.conns.pop(db_file).close()
+                for key in totpcgi.backends.sqlite.userids.keys():
+                    if key[0] == db_file:
+                        del totpcgi.backends.sqlite.userids[key]
+            shutil.rmtree(db_dir)
+
+    def testStateReplication(self):
+        logger.debug('Running testStateReplication')
+
+        import threading
+        import totpcgi.backends.file
+
+        repl_dir = tempfile.mkdtemp()
+
+        try:
+            nodes = []
+            for (name, peer) in (('one', 'two'), ('two', 'one')):
+                os.mkdir(os.path.join(repl_dir, name))
+                node = totpcgi.backends.file.GAStateBackend(os.path.join(repl_dir, name))
+                node.enable_replication(os.path.join(repl_dir, name + '.log'),
+                                        [os.path.join(repl_dir, peer + '.log')],
+                                        interval=0)
+                nodes.append(node)
+
+            backends = getBackends()
+            secret = backends.secret_backend.get_user_secret('valid')
+            token = secret.get_totp_token()
+
+            backends.state_backend = nodes[0]
+            gau = totpcgi.GAUser('valid', backends)
+            self.assertEqual(gau.verify_token(token, secret=secret),
+                             'Valid TOTP token used')
+
+            logger.debug('The other node should refuse the same token')
+            backends.state_backend = nodes[1]
+            with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+                gau.verify_token(token, secret=secret)
+
+            logger.debug('HOTP counters should only ever move forward')
+            with nodes[1].transaction('hotp') as state:
+                state.counter = 5
+                state.used_scratch_tokens.append(12345678)
+
+            with nodes[0].transaction('hotp') as state:
+                self.assertEqual(state.counter, 5)
+                self.assertEqual(state.used_scratch_tokens, [12345678])
+                state.counter = 3
+
+            with nodes[1].transaction('hotp') as state:
+                self.assertEqual(state.counter, 5)
+
+            logger.debug('Merges should wait for other threads holding the user')
+            state = nodes[1].get_user_state('valid')
+            with nodes[0].transaction('valid') as theirs:
+                theirs.used_scratch_tokens.append(11111111)
+
+            merger = threading.Thread(target=nodes[1].merge_peers)
+            merger.start()
+            time.sleep(0.1)
+            self.assertTrue(merger.is_alive())
+
+            state.used_scratch_tokens.append(22222222)
+            nodes[1].update_user_state('valid', state)
+            merger.join()
+
+            with nodes[1].transaction('valid') as state:
+                self.assertEqual(sorted(state.used_scratch_tokens),
+                                 [11111111, 22222222])
+
+            logger.debug('Merging again should change nothing')
+            state = nodes[1].get_user_state('valid')
+            nodes[1].abort_user_state('valid')
+            os.unlink(nodes[1].offsets_file)
+            self.assertTrue(nodes[1].merge_peers() > 0)
+
+            merged = nodes[1].get_user_state('valid')
+            nodes[1].abort_user_state('valid')
+            self.assertEqual(merged.success_timestamps, state.success_timestamps)
+            self.assertEqual(merged.fail_timestamps, state.fail_timestamps)
+
+        finally:
+            shutil.rmtree(repl_dir)
+
+    def testLockoutCache(self):
+        logger.debug('Running testLockoutCache')
+
+        backends = getBackends()
+        backends.enable_lockout_cache()
+        ga = totpcgi.GoogleAuthenticator(backends)
+
+        now = int(time.time())
+        self.assertEqual(totpcgi.get_lockout_until([now] * 3, (4, 30)), None)
+        self.assertEqual(totpcgi.get_lockout_until([now-60] + [now] * 10, (4, 30)),
+                         now+60)
+
+        state = totpcgi.GAUserState()
+        state.fail_timestamps = [now] * 4
+        setCustomState(state)
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Rate-limit'):
+            ga.verify_user_token('valid', '555555')
+
+        logger.debug('Now we should not need any backends to say no')
+        backends.secret_backend = None
+        backends.state_backend = None
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Rate-limit'):
+            ga.verify_user_token('valid', '555555')
+        self.assertEqual(backends.lockout_cache.rejected, 1)
+
+        logger.debug('Expired lockouts should be forgotten')
+        backends = getBackends()
+        backends.enable_lockout_cache()
+        ga = totpcgi.GoogleAuthenticator(backends)
+        backends.lockout_cache.lock_out('valid', now-1)
+        cleanState()
+
+        secret = backends.secret_backend.get_user_secret('valid')
+        self.assertEqual(ga.verify_user_token('valid', str(secret.get_totp_token())),
+                         'Valid TOTP token used')
+        self.assertEqual(backends.lockout_cache.entries, {})
+
+    def testLastStepReplayGuard(self):
+        logger.debug('Running testLastStepReplayGuard')
+
+        backends = getBackends()
+        backends.set_replay_guard('last_step')
+
+        gau = totpcgi.GAUser('valid', backends)
+        secret = backends.secret_backend.get_user_secret('valid')
+        step = secret.timestamp // 30
+        token = secret.get_totp_token()
+
+        self.assertEqual(gau.verify_token(token, secret=secret), 'Valid TOTP token used')
+
+        state = backends.state_backend.get_user_state('valid')
+        backends.state_backend.abort_user_state('valid')
+        self.assertEqual(state.last_step, step)
+        self.assertEqual(state.success_timestamps, [])
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+            gau.verify_token(token, secret=secret)
+
+        logger.debug('Tokens from before the last step count as used, too')
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+            gau.verify_token(secret.get_token_at(secret.timestamp-30), secret=secret)
+
+        logger.debug('Failures only count towards the rate limit')
+        with self.assertRaises(totpcgi.VerifyFailed):
+            gau.verify_token(555555, secret=secret)
+
+        state = backends.state_backend.get_user_state('valid')
+        backends.state_backend.abort_user_state('valid')
+        self.assertEqual(state.last_step, step)
+        self.assertEqual(len(state.fail_timestamps), 3)
+
+        logger.debug('Success timestamps from before switching still count')
+        cleanState()
+        state = totpcgi.GAUserState()
+        state.success_timestamps = [secret.timestamp]
+        setCustomState(state)
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+            gau.verify_token(token, secret=secret)
+
+        with self.assertRaises(ValueError):
+            backends.set_replay_guard('nonsense')
+
+    def testSQLiteLastSteps(self):
+        logger.debug('Running testSQLiteLastSteps')
+
+        import totpcgi.backends.sqlite
+
+        db_dir = tempfile.mkdtemp()
+        db_file = os.path.join(db_dir, 'steps.db')
+        has_upsert = totpcgi.backends.sqlite.HAS_UPSERT
+
+        try:
+            backend = totpcgi.backends.sqlite.GAStateBackend(db_file)
+
+            # with upserts if this SQLite has them, and without either way
+            for upsert in set((has_upsert, False)):
+                totpcgi.backends.sqlite.HAS_UPSERT = upsert
+                user = 'steps%s' % upsert
+
+                for (step, expected) in ((100, 100), (90, 100), (120, 120)):
+                    with backend.transaction(user) as state:
+                        state.last_step = step
+                    state = backend.get_user_state(user)
+                    backend.abort_user_state(user)
+                    self.assertEqual(state.last_step, expected)
+
+                backend.delete_user_state(user)
+
+        finally:
+            totpcgi.backends.sqlite.HAS_UPSERT = has_upsert
+            totpcgi.backends.sqlite.dbconn.conns.pop(db_file).close()
+            shutil.rmtree(db_dir)
+
+    def testCluster(self):
+        logger.debug('Running testCluster')
+
+        import json
+        import socket
+        import threading
+        import totpcgi.cluster
+
+        with self.assertRaisesRegexp(totpcgi.cluster.ClusterError, 'secret'):
+            totpcgi.cluster.ClusterNode('one', {'one': ('127.0.0.1', 0)},
+                                        getBackends(), secret='')
+
+        ring = totpcgi.cluster.HashRing(['one', 'two', 'three'])
+        users = ['user%s' % i for i in xrange(300)]
+        owners = dict((user, ring.get_node(user)) for user in users)
+        self.assertEqual(set(owners.values()), set(['one', 'two', 'three']))
+
+        logger.debug('Removing a member should only move its own users')
+        ring = totpcgi.cluster.HashRing(['one', 'three'])
+        for user in users:
+            if owners[user] != 'two':
+                self.assertEqual(ring.get_node(user), owners[user])
+
+        logger.debug('Only so many users are kept in memory')
+        backend = totpcgi.cluster.MemoryStateBackend(maxsize=2)
+        for user in ('first', 'second', 'third'):
+            with backend.transaction(user) as state:
+                state.counter = 5
+        self.assertEqual(sorted(backend.users()), ['second', 'third'])
+        self.assertEqual(backend.get_user_state('third').counter, 5)
+        backend.abort_user_state('third')
+
+        self.assertTrue(totpcgi.cluster.check_mac(
+            'secret', totpcgi.cluster.get_mac('secret', 'a', 'b'), 'a', 'b'))
+        self.assertFalse(totpcgi.cluster.check_mac('secret', 'nonsense', 'a', 'b'))
+
+        members = {}
+        for name in ('one', 'two'):
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            members[name] = sock.getsockname()
+            sock.close()
+
+        owner = totpcgi.cluster.HashRing(members.keys()).get_node('valid')
+        other = [name for name in members if name != owner][0]
+
+        logger.debug('Run the owner of the user in another process')
+        pid = os.fork()
+        if pid == 0:
+            try:
+                backends = getBackends()
+                backends.state_backend = None
+                node = totpcgi.cluster.ClusterNode(owner, members, backends,
+                                                   secret='sekrit')
+                node.start()
+                time.sleep(30)
+            finally:
+                os._exit(0)
+
+        backends = getBackends()
+        backends.state_backend = None
+        node = totpcgi.cluster.ClusterNode(other, members, backends,
+                                           secret='sekrit')
+
+        try:
+            node.start()
+
+            for i in xrange(50):
+                try:
+                    socket.create_connection(members[owner]).close()
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+
+            secret = backends.secret_backend.get_user_secret('valid')
+            token = str(secret.get_totp_token())
+
+            self.assertEqual(node.verify_user_token('valid', token),
+                             'Valid TOTP token used')
+            self.assertEqual(node.state_backend.users(), [])
+            with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+                node.verify_user_token('valid', token)
+
+            logger.debug('Unsigned requests should be refused')
+            conn = socket.create_connection(members[other])
+            conn.sendall(json.dumps({'op': 'members', 'members': {}}) + '\n')
+            reply = json.loads(json.loads(conn.makefile().readline())['body'])
+            conn.close()
+            self.assertIn('authentication', reply['error'])
+            self.assertEqual(node.members, members)
+
+            logger.debug('So should replies not signed with our secret')
+            fake = socket.socket()
+            fake.bind(('127.0.0.1', 0))
+            fake.listen(5)
+
+            def forge():
+                for body in (json.dumps({'status': 'OK'}),
+                             json.dumps({'body': json.dumps({'status': 'OK'}),
+                                         'mac': totpcgi.cluster.get_mac(
+                                             'wrong', 'response', '',
+                                             json.dumps({'status': 'OK'}))})):
+                    (conn, addr) = fake.accept()
+                    conn.makefile().readline()
+                    conn.sendall(body + '\n')
+                    conn.close()
+
+            forger = threading.Thread(target=forge)
+            forger.start()
+            real = node.peers[owner]
+            node.peers[owner] = totpcgi.cluster.PeerConnection(
+                fake.getsockname(), 'sekrit', pool_size=0)
+            try:
+                for i in xrange(2):
+                    with self.assertRaisesRegexp(totpcgi.cluster.ClusterError,
+                                                 'authentication'):
+                        node.verify_user_token('valid', token)
+            finally:
+                node.peers[owner] = real
+                forger.join()
+                fake.close()
+
+            logger.debug('When the owner leaves, it should hand the user off')
+            self.assertEqual(totpcgi.cluster.announce_members(
+                {other: members[other]}, members, 'sekrit'), [])
+            self.assertEqual(node.state_backend.users(), ['valid'])
+            with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+                node.verify_user_token('valid', token)
+
+        finally:
+            node.stop()
+            os.kill(pid, 15)
+            os.waitpid(pid, 0)
+
+    def testStateTransaction(self):
+        logger.debug('Running testStateTransaction')
+
+        backends = getBackends()
+        state_backend = backends.state_backend
+
+        with state_backend.transaction('valid') as state:
+            state.fail_timestamps.append(int(time.time())-3600)
+
+        logger.debug('A failing block should write nothing and release the lock')
+        with self.assertRaises(RuntimeError):
+            with state_backend.transaction('valid') as state:
+                state.fail_timestamps.append(int(time.time())-3600)
+                raise RuntimeError('Boom')
+
+        self.assertEqual(state_backend.held_locks(), [])
+
+        with state_backend.transaction('valid') as state:
+            self.assertEqual(len(state.fail_timestamps), 1)
+
+        logger.debug('Aborting a brand new state should leave nothing behind')
+        with self.assertRaises(RuntimeError):
+            with state_backend.transaction('newuser') as state:
+                raise RuntimeError('Boom')
+
+        with state_backend.transaction('newuser') as state:
+            self.assertEqual(state.fail_timestamps, [])
+        cleanState(user='newuser')
+
+        logger.debug('The pincode is checked without holding the state')
+        gau = totpcgi.GAUser('valid', backends)
+        secret = backends.secret_backend.get_user_secret('valid')
+
+        def pincode_check():
+            self.assertEqual(state_backend.held_locks(), [])
+            raise RuntimeError('Directory went away')
+
+        with self.assertRaises(RuntimeError):
+            gau.verify_token(secret.get_totp_token(), pincode_check=pincode_check)
+
+        # by then, the token was used
+        self.assertEqual(state_backend.held_locks(), [])
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'already been used'):
+            gau.verify_token(secret.get_totp_token())
+
+    def testStateLockTimeout(self):
+        logger.debug('Running testStateLockTimeout')
+
+        import totpcgi.backends.file
+        import totpcgi.backends.journal
+
+        backends = getBackends()
+        if STATE_BACKEND == 'File':
+            setCustomState(totpcgi.GAUserState())
+
+            logger.debug('Hold the state file lock in another process')
+            (rfd, wfd) = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(rfd)
+                holder = totpcgi.backends.file.GAStateBackend(state_dir)
+                holder.get_user_state('valid')
+                os.write(wfd, 'x')
+                time.sleep(2)
+                os._exit(0)
+
+            os.close(wfd)
+            os.read(rfd, 1)
+            os.close(rfd)
+
+            try:
+                backends.state_backend.set_lock_timeout(0.1)
+                stats = backends.state_backend.lock_stats
+                timeouts = stats.timeouts
+
+                with self.assertRaises(totpcgi.UserStateLockTimeout):
+                    backends.state_backend.get_user_state('valid')
+                self.assertEqual(stats.timeouts, timeouts+1)
+
+            finally:
+                os.kill(pid, 15)
+                os.waitpid(pid, 0)
+
+            # now that it's gone, we get the lock right away
+            acquired = stats.acquired
+            state = backends.state_backend.get_user_state('valid')
+            backends.state_backend.update_user_state('valid', state)
+            self.assertEqual(stats.acquired, acquired+1)
+            self.assertTrue('timeouts=' in stats.summary())
+
+        logger.debug('Journal locks are per thread')
+        journal_dir = tempfile.mkdtemp()
+
+        try:
+            holder = totpcgi.backends.journal.GAStateBackend(journal_dir)
+            waiter = totpcgi.backends.journal.GAStateBackend(journal_dir)
+            waiter.set_lock_timeout(0.1)
+
+            holding = threading.Event()
+            done = threading.Event()
+
+            def hold():
+                holder.get_user_state('valid')
+                holding.set()
+                done.wait()
+                holder.update_user_state('valid', totpcgi.GAUserState())
+
+            thread = threading.Thread(target=hold)
+            thread.start()
+            holding.wait()
+
+            try:
+                with self.assertRaises(totpcgi.UserStateLockTimeout):
+                    waiter.get_user_state('valid')
+            finally:
+                done.set()
+                thread.join()
+
+            waiter.update_user_state('valid', waiter.get_user_state('valid'))
+            totpcgi.backends.journal.journals.pop(journal_dir).journal.close()
+
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def testSourceLimiter(self):
+        logger.debug('Running testSourceLimiter')
+
+        import totpcgi.ratelimit
+
+        table_dir = tempfile.mkdtemp()
+        table_file = os.path.join(table_dir, 'source-limits')
+
+        try:
+            limiter = totpcgi.ratelimit.SourceLimiter(
+                table_file, ip_burst=3, ip_rate=0, subnet_burst=5, subnet_rate=0)
+
+            for i in xrange(3):
+                self.assertTrue(limiter.allow('192.0.2.1'))
+            self.assertFalse(limiter.allow('192.0.2.1'))
+
+            logger.debug('Other processes should see the same counts')
+            other = totpcgi.ratelimit.SourceLimiter(
+                table_file, ip_burst=3, ip_rate=0, subnet_burst=5, subnet_rate=0)
+            self.assertFalse(other.allow('192.0.2.1'))
+
+            logger.debug('The rest of the subnet shares a bucket')
+            self.assertTrue(other.allow('192.0.2.2'))
+            self.assertTrue(other.allow('192.0.2.3'))
+            self.assertFalse(other.allow('192.0.2.4'))
+            self.assertTrue(other.allow('198.51.100.1'))
+
+            self.assertEqual(totpcgi.ratelimit.get_subnet('2001:db8::1'),
+                             '2001:db8::/64')
+
+            logger.debug('A full table should evict instead of failing')
+            small = totpcgi.ratelimit.SourceLimiter(
+                table_file + '.small', ip_burst=1, ip_rate=0, subnet_burst=1,
+                subnet_rate=0, slots=4)
+            for i in xrange(20):
+                self.assertTrue(small.allow('10.0.%s.1' % i))
+
+            logger.debug('A table in use should never be resized')
+            with self.assertRaisesRegexp(ValueError, 'not a source limit table'):
+                totpcgi.ratelimit.SourceLimiter(table_file + '.small', slots=8)
+            self.assertTrue(small.allow('10.0.99.1'))
+            self.assertEqual(os.path.getsize(table_file + '.small'),
+                             totpcgi.ratelimit.HEADER_SIZE + 4*totpcgi.ratelimit.SLOT.size)
+
+            limiter.close()
+            other.close()
+            small.close()
+
+        finally:
+            shutil.rmtree(table_dir)
+
+    def testTokenFirst(self):
+        logger.debug('Running testTokenFirst')
+
+        if PINCODE_BACKEND == 'ldap':
+            return
+
+        backends = getBackends()
+        ga = totpcgi.GoogleAuthenticator(backends, token_first=True)
+
+        pincode = 'wakkawakka'
+        setCustomPincode(pincode)
+
+        pincode_checks = []
+        verify_user_pincode = backends.pincode_backend.verify_user_pincode
+
+        def count_pincode_checks(user, pincode):
+            pincode_checks.append(pincode)
+            return verify_user_pincode(user, pincode)
+
+        backends.pincode_backend.verify_user_pincode = count_pincode_checks
+
+        secret = backends.secret_backend.get_user_secret('valid')
+        tokencode = str(secret.get_totp_token()).zfill(6)
+
+        logger.debug('A bad token should not get as far as the pincode')
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Pincode or token failed'):
+            ga.verify_user_token('valid', pincode+'000000')
+        self.assertEqual(pincode_checks, [])
+
+        cleanState()
+
+        logger.debug('A good token with a bad pincode gets the same answer')
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Pincode or token failed'):
+            ga.verify_user_token('valid', 'blarg'+tokencode)
+        self.assertEqual(pincode_checks, ['blarg'])
+
+        logger.debug('...and still counts as a failure, burning the token')
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Pincode or token failed'):
+            ga.verify_user_token('valid', pincode+tokencode)
+        self.assertEqual(pincode_checks, ['blarg'])
+
+        cleanState()
+
+        ret = ga.verify_user_token('valid', pincode+tokencode)
+        self.assertEqual(ret, 'Valid TOTP token used')
+        self.assertEqual(pincode_checks, ['blarg', pincode])
+
+        logger.debug('A bad pincode burns a scratch-token, too')
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Pincode or token failed'):
+            ga.verify_user_token('valid', 'blarg'+str(VALID_SCRATCH_TOKENS[1]))
+
+        with backends.state_backend.transaction('valid') as state:
+            self.assertIn(int(VALID_SCRATCH_TOKENS[1]), state.used_scratch_tokens)
+            self.assertNotEqual(state.fail_timestamps, [])
+
+        logger.debug('Pincode + scratch-token')
+        ret = ga.verify_user_token('valid', pincode+str(VALID_SCRATCH_TOKENS[0]))
+        self.assertEqual(ret, 'Scratch-token used')
+
+        cleanState()
+
+        logger.debug('Rate-limiting should not be hidden')
+        state = totpcgi.GAUserState()
+        state.fail_timestamps = [int(time.time())] * 4
+        setCustomState(state)
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Rate-limit'):
+            ga.verify_user_token('valid', pincode+tokencode)
+
+        cleanState()
+
+        logger.debug('Encrypted secrets fall back to checking the pincode first')
+        setCustomPincode(pincode, user='encrypted')
+        totp = pyotp.TOTP(VALID_SECRET)
+        ret = ga.verify_user_token('encrypted', pincode+str(totp.now()).zfill(6))
+        self.assertTrue(ret.startswith('Valid TOTP token'))
+
+        cleanState(user='encrypted')
+
+    def testPincodeCache(self):
+        logger.debug('Running testPincodeCache')
+
+        if PINCODE_BACKEND == 'ldap':
+            return
+
+        backends = getBackends()
+        pincode_backend = backends.pincode_backend
+        pincode_backend.enable_verify_cache(60)
+
+        setCustomPincode('wakkawakka', algo='bcrypt')
+        self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+        self.assertEqual(len(pincode_backend.verify_cache.entries), 1)
+
+        # failures should never be cached
+        with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Pincode did not match'):
+            pincode_backend.verify_user_pincode('valid', 'blarg')
+        self.assertEqual(len(pincode_backend.verify_cache.entries), 1)
+
+        # a cache hit shouldn't need to run the hash at all
+        verify_by_hashcode = pincode_backend._verify_by_hashcode
+        try:
+            pincode_backend._verify_by_hashcode = None
+            self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+        finally:
+            pincode_backend._verify_by_hashcode = verify_by_hashcode
+
+        logger.debug('Changing the pincode should invalidate the cache')
+        setCustomPincode('blarg', algo='bcrypt')
+        with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Pincode did not match'):
+            pincode_backend.verify_user_pincode('valid', 'wakkawakka')
+        self.assertTrue(pincode_backend.verify_user_pincode('valid', 'blarg'))
+
+    def testPincodeRehash(self):
+        logger.debug('Running testPincodeRehash')
+
+        if PINCODE_BACKEND == 'ldap':
+            return
+
+        backends = getBackends()
+        pincode_backend = backends.pincode_backend
+        pincode_backend.enable_rehash('sha256')
+
+        saved = []
+        save_user_hashcode = pincode_backend.save_user_hashcode
+
+        def record_save(user, hashcode, *args):
+            saved.append(hashcode)
+            return save_user_hashcode(user, hashcode, *args)
+
+        pincode_backend.save_user_hashcode = record_save
+
+        logger.debug('Legacy md5_crypt hash should be upgraded')
+        setCustomPincode('wakkawakka', algo='md5')
+        self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+        self.assertEqual(len(saved), 1)
+        self.assertTrue(saved[0].startswith('$5$'))
+
+        logger.debug('Upgraded hash verifies and is left alone')
+        self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+        self.assertEqual(len(saved), 1)
+
+        logger.debug('Low-round hash should be upgraded')
+        hashcode = totpcgi.utils.hash_pincode('wakkawakka', 'sha256', rounds=1000)
+        save_user_hashcode('valid', hashcode)
+        self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+        self.assertEqual(len(saved), 2)
+        self.assertTrue('rounds=' not in saved[1])
+
+        logger.debug('Failed pincodes should never be rehashed')
+        setCustomPincode('wakkawakka', algo='md5')
+        with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Pincode did not match'):
+            pincode_backend.verify_user_pincode('valid', 'blarg')
+        self.assertEqual(len(saved), 2)
+
+        with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Unsupported hashcode'):
+            pincode_backend._verify_by_hashcode('wakkawakka', '$9$junk')
+
+    def testPincodeFileWriters(self):
+        logger.debug('Running testPincodeFileWriters')
+
+        import multiprocessing
+        import totpcgi.backends.file
+
+        tmpdir = tempfile.mkdtemp()
+        pincode_file = os.path.join(tmpdir, 'pincodes')
+        users = ['user%s-%s' % (n, i) for n in xrange(4) for i in xrange(10)]
+
+        def rehash(n):
+            backend = totpcgi.backends.file.GAPincodeBackend(pincode_file)
+            backend.enable_rehash('sha256', rounds=1000)
+            for user in users:
+                if user.startswith('user%s-' % n):
+                    backend.verify_user_pincode(user, 'wakkawakka')
+
+        try:
+            backend = totpcgi.backends.file.GAPincodeBackend(pincode_file)
+            hashcode = totpcgi.utils.hash_pincode('wakkawakka', 'md5')
+            for user in users:
+                backend.save_user_hashcode(user, hashcode, makedb=False)
+            os.chmod(pincode_file, 0640)
+
+            logger.debug('Processes rehashing at the same time should not lose lines')
+            workers = [multiprocessing.Process(target=rehash, args=(n,)) for n in xrange(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                self.assertEqual(worker.exitcode, 0)
+
+            hashcodes = backend._get_all_hashcodes()
+            self.assertEqual(sorted(hashcodes.keys()), sorted(users))
+            for user in users:
+                self.assertTrue(hashcodes[user].startswith('$5$'))
+
+            self.assertEqual(os.stat(pincode_file).st_mode & 07777, 0640)
+            self.assertEqual(sorted(name for name in os.listdir(tmpdir)
+                                    if not name.startswith('pincodes.db')),
+                             ['pincodes', 'pincodes.lock'])
+
+        finally:
+            shutil.rmtree(tmpdir)
+
     def testEncryptedSecret(self):
         logger.debug('Running testEncryptedSecret')
 
@@ -680,6 +1746,571 @@ class GATest(unittest.TestCase):
 
         cleanState(user='encrypted-bad')
 
+    def testEncryptedSecretFormats(self):
+        logger.debug('Running testEncryptedSecretFormats')
+
+        pincode = 'wakkawakka'
+
+        b64str = totpcgi.utils.encrypt_secret(VALID_SECRET, pincode, iterations=3000)
+        self.assertTrue(b64str.startswith('aes256+hmac256+v2$pbkdf2-sha256:3000$'))
+        self.assertEqual(totpcgi.utils.decrypt_secret(b64str, pincode), VALID_SECRET)
+
+        with self.assertRaisesRegexp(totpcgi.UserSecretError, 'Failed to verify'):
+            totpcgi.utils.decrypt_secret(b64str, 'blarg')
+
+        logger.debug('Tampering with the recorded cost should fail the hmac')
+        tampered = b64str.replace(':3000$', ':2000$')
+        with self.assertRaisesRegexp(totpcgi.UserSecretError, 'Failed to verify'):
+            totpcgi.utils.decrypt_secret(tampered, pincode)
+
+        tampered = b64str.replace('pbkdf2-sha256', 'rot13')
+        with self.assertRaisesRegexp(totpcgi.UserSecretError, 'Unsupported KDF'):
+            totpcgi.utils.decrypt_secret(tampered, pincode)
+
+        logger.debug('An absurd cost should be refused before running the KDF')
+        for iterations in ('1', '-5', str(totpcgi.utils.KDF_MAX_ITER+1)):
+            tampered = b64str.replace(':3000$', ':%s$' % iterations)
+            with self.assertRaisesRegexp(totpcgi.UserSecretError,
+                                         'Failed to parse encrypted secret'):
+                totpcgi.utils.decrypt_secret(tampered, pincode)
+
+        logger.debug('Legacy format should still be readable')
+        backends = getBackends()
+        gaus = backends.secret_backend.get_user_secret('encrypted', pincode)
+        self.assertEqual(gaus.otp.secret, VALID_SECRET)
+
+        self.assertTrue(totpcgi.utils.calibrate_kdf(1) >= totpcgi.utils.KDF_MIN_ITER)
+
+    def testCryptoProviders(self):
+        logger.debug('Running testCryptoProviders')
+
+        for (name, func) in totpcgi.crypto.PBKDF2_PROVIDERS:
+            logger.debug('Testing pbkdf2 provider %s' % name)
+            totpcgi.crypto.self_test(pbkdf2_func=func)
+
+        for (name, func) in totpcgi.crypto.AES_PROVIDERS:
+            logger.debug('Testing aes provider %s' % name)
+            totpcgi.crypto.self_test(aes_func=func)
+
+        # all providers must agree on odd key lengths, too
+        keys = set()
+        for (name, func) in totpcgi.crypto.PBKDF2_PROVIDERS:
+            keys.add(func('wakkawakka', 'salt', 10, 40))
+        self.assertEqual(len(keys), 1)
+
+        def broken_pbkdf2(password, salt, iterations, keylen):
+            return '\0' * keylen
+
+        with self.assertRaisesRegexp(totpcgi.crypto.CryptoSelfTestFailed, 'PBKDF2'):
+            totpcgi.crypto.self_test(pbkdf2_func=broken_pbkdf2)
+
+    def testOffload(self):
+        logger.debug('Running testOffload')
+
+        if PINCODE_BACKEND == 'ldap':
+            return
+
+        backends = getBackends()
+        pincode_backend = backends.pincode_backend
+
+        setCustomPincode('wakkawakka', algo='bcrypt')
+
+        totpcgi.offload.enable(2, queue_size=2, wait_timeout=1)
+        try:
+            self.assertTrue(pincode_backend.verify_user_pincode('valid', 'wakkawakka'))
+
+            logger.debug('Errors in the workers should come back to us')
+            with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Pincode did not match'):
+                pincode_backend.verify_user_pincode('valid', 'blarg')
+
+            gaus = backends.secret_backend.get_user_secret('encrypted', 'wakkawakka')
+            self.assertEqual(gaus.otp.secret, VALID_SECRET)
+            self.assertEqual(totpcgi.offload.pending, 0)
+
+            logger.debug('A full queue should turn us away')
+            totpcgi.offload.pending = totpcgi.offload.max_pending
+            try:
+                with self.assertRaisesRegexp(totpcgi.offload.OffloadBusy, 'Too many'):
+                    pincode_backend.verify_user_pincode('valid', 'wakkawakka')
+            finally:
+                totpcgi.offload.pending = 0
+
+        finally:
+            totpcgi.offload.disable()
+
+    def testKDFCache(self):
+        logger.debug('Running testKDFCache')
+
+        backends = getBackends()
+        secret_backend = backends.secret_backend
+        pincode = 'wakkawakka'
+
+        totpcgi.utils.enable_kdf_cache(60)
+        kdf_cache = totpcgi.utils.kdf_cache
+        pbkdf2 = totpcgi.crypto.pbkdf2_sha256
+
+        try:
+            gaus = secret_backend.get_user_secret('encrypted', pincode)
+            self.assertEqual(gaus.otp.secret, VALID_SECRET)
+            self.assertEqual(len(kdf_cache.entries), 1)
+
+            logger.debug('Wrong pincodes should never be cached')
+            with self.assertRaisesRegexp(totpcgi.UserSecretError, 'Failed to'):
+                secret_backend.get_user_secret('encrypted', 'blarg')
+            self.assertEqual(len(kdf_cache.entries), 1)
+
+            logger.debug('A cache hit should skip the KDF entirely')
+            totpcgi.crypto.pbkdf2_sha256 = None
+            gaus = secret_backend.get_user_secret('encrypted', pincode)
+            self.assertEqual(gaus.otp.secret, VALID_SECRET)
+            totpcgi.crypto.pbkdf2_sha256 = pbkdf2
+
+            logger.debug('Evicted keys should be zeroed out')
+            key = kdf_cache.entries.values()[0][1]
+            kdf_cache.clear()
+            self.assertEqual(key, bytearray(len(key)))
+
+        finally:
+            totpcgi.crypto.pbkdf2_sha256 = pbkdf2
+            totpcgi.utils.kdf_cache = None
+
+    def testSecretCache(self):
+        logger.debug('Running testSecretCache')
+
+        if SECRET_BACKEND != 'File':
+            return
+
+        backends = getBackends()
+        secret_backend = backends.secret_backend
+
+        secret = secret_backend.get_user_secret('valid')
+        self.assertTrue(secret_backend.secret_cache.get('valid') is not None)
+
+        # a hit should give us a fresh object every time
+        cached = secret_backend.get_user_secret('valid')
+        self.assertFalse(cached is secret)
+        self.assertEqual(cached.otp.secret, secret.otp.secret)
+        self.assertEqual(cached.rate_limit, (4, 30))
+
+        logger.debug('Changing the secret file behind the cache')
+        cached.scratch_tokens = VALID_SCRATCH_TOKENS
+        cached.rate_limit = (5, 60)
+        getBackends().secret_backend.save_user_secret('valid', cached)
+        # make sure mtime changes, even on coarse-grained filesystems
+        totp_file = secret_backend._get_totp_file('valid')
+        st = os.stat(totp_file)
+        os.utime(totp_file, (st.st_atime, st.st_mtime+1))
+
+        self.assertEqual(secret_backend.get_user_secret('valid').rate_limit, (5, 60))
+
+        cached.rate_limit = (4, 30)
+        secret_backend.save_user_secret('valid', cached)
+
+        logger.debug('Making sure we never cache decrypted secrets')
+        secret = secret_backend.get_user_secret('encrypted', 'wakkawakka')
+        self.assertEqual(secret.otp.secret, VALID_SECRET)
+        (cache_key, record) = secret_backend.secret_cache.get('encrypted')
+        self.assertTrue(record['secret'].startswith('aes256+hmac256'))
+
+    def testStateJournalReplay(self):
+        logger.debug('Running testStateJournalReplay')
+
+        import totpcgi.backends.journal
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            backend = totpcgi.backends.journal.GAStateBackend(tmpdir, snapshot_every=3)
+
+            for counter in xrange(5):
+                state = backend.get_user_state('valid')
+                state.fail_timestamps.append(counter)
+                state.counter = counter
+                backend.update_user_state('valid', state)
+
+            backend.get_user_state('gone')
+            backend.update_user_state('gone', totpcgi.GAUserState())
+            backend.delete_user_state('gone')
+
+            # we should have snapshotted twice, leaving 1 entry in the journal
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'state.snapshot')))
+            journal_file = os.path.join(tmpdir, 'state.journal')
+            self.assertEqual(len(open(journal_file).readlines()), 1)
+
+            # simulate a torn write of an unacknowledged entry
+            fh = open(journal_file, 'a')
+            fh.write('{"user": "valid", "sta')
+            fh.close()
+
+            logger.debug('Replaying snapshot and journal')
+            totpcgi.backends.journal.journals.pop(tmpdir).journal.close()
+            backend = totpcgi.backends.journal.GAStateBackend(tmpdir)
+
+            state = backend.get_user_state('valid')
+            self.assertEqual(state.fail_timestamps, range(5))
+            self.assertEqual(state.counter, 4)
+            state.counter = 5
+            backend.update_user_state('valid', state)
+
+            self.assertFalse('gone' in backend.journal.states)
+
+            logger.debug('Writes made after the tear should survive a restart')
+            totpcgi.backends.journal.journals.pop(tmpdir).journal.close()
+            backend = totpcgi.backends.journal.GAStateBackend(tmpdir)
+
+            state = backend.get_user_state('valid')
+            self.assertEqual(state.counter, 5)
+            backend.update_user_state('valid', state)
+
+        finally:
+            journal = totpcgi.backends.journal.journals.pop(tmpdir, None)
+            if journal is not None:
+                journal.journal.close()
+            shutil.rmtree(tmpdir)
+
+    def testLDAPConnectionPool(self):
+        logger.debug('Running testLDAPConnectionPool')
+
+        (stub, ldapbackend) = useStubLDAP('ldap://one')
+
+        try:
+            stub.servers['ldap://one']['passwords'] = {'uid=valid': 'right',
+                                                       'uid=other': 'other'}
+            pool = ldapbackend.LDAPConnectionPool('ldap://one', '', size=2)
+
+            logger.debug('Connections should be reused')
+            pool.bind('uid=valid', 'right')
+            pool.bind('uid=other', 'other')
+            self.assertEqual(len(stub.connections), 1)
+            self.assertEqual(len(pool.idle), 1)
+
+            logger.debug('...even after a failed bind, by binding again')
+            with self.assertRaises(stub.INVALID_CREDENTIALS):
+                pool.bind('uid=valid', 'wrong')
+            self.assertEqual(len(pool.idle), 1)
+            pool.bind('uid=valid', 'right')
+            self.assertEqual(len(stub.connections), 1)
+            self.assertEqual(stub.connections[0].bound, 'uid=valid')
+
+            logger.debug('A broken connection should be replaced')
+            stub.connections[0].broken = True
+            pool.bind('uid=valid', 'right')
+            self.assertEqual(len(stub.connections), 2)
+            self.assertEqual(pool.created, 1)
+            self.assertEqual([lconn for (lconn, last_used) in pool.idle],
+                             [stub.connections[1]])
+
+            logger.debug('...and not kept when the server is down')
+            stub.servers['ldap://one']['up'] = False
+            with self.assertRaises(stub.SERVER_DOWN):
+                pool.bind('uid=valid', 'right')
+            self.assertEqual(pool.created, 0)
+            self.assertEqual(pool.idle, [])
+
+            logger.debug('Nor should anything else unexpected use up the pool')
+            stub.servers['ldap://one']['up'] = True
+
+            def broken_bind(dn, password):
+                raise RuntimeError('Boom')
+
+            for i in xrange(3):
+                pool.bind('uid=valid', 'right')
+                pool.idle[0][0].simple_bind_s = broken_bind
+                with self.assertRaises(RuntimeError):
+                    pool.bind('uid=valid', 'right')
+            self.assertEqual(pool.created, 0)
+
+        finally:
+            restoreLDAP(stub)
+
+    def testLDAPFailover(self):
+        logger.debug('Running testLDAPFailover')
+
+        (stub, ldapbackend) = useStubLDAP('ldap://one', 'ldap://two')
+
+        try:
+            for server in stub.servers.values():
+                server['passwords'] = {'uid=valid': 'right'}
+            one = stub.servers['ldap://one']
+            two = stub.servers['ldap://two']
+
+            backend = ldapbackend.GAPincodeBackend('ldap://one, ldap://two',
+                                                   'uid=$username', '',
+                                                   breaker_failures=2,
+                                                   breaker_reset=0.2)
+
+            logger.debug('A down server should fail over to the next one')
+            one['up'] = False
+            self.assertTrue(backend.verify_user_pincode('valid', 'right'))
+            self.assertEqual(two['binds'], 1)
+            self.assertEqual(backend.pools[0].down_until, 0)
+
+            logger.debug('...and be skipped once it failed often enough')
+            self.assertTrue(backend.verify_user_pincode('valid', 'right'))
+            self.assertTrue(backend.pools[0].down_until > time.time())
+            binds = one['binds']
+            self.assertTrue(backend.verify_user_pincode('valid', 'right'))
+            self.assertEqual(one['binds'], binds)
+
+            logger.debug('...until the cooldown is over')
+            one['up'] = True
+            time.sleep(0.3)
+            self.assertTrue(backend.verify_user_pincode('valid', 'right'))
+            self.assertEqual(one['binds'], binds+1)
+            self.assertEqual(backend.pools[0].failures, 0)
+            self.assertEqual(backend.pools[0].down_until, 0)
+
+            logger.debug('Running out of connections is not the server failing')
+            busy = ldapbackend.GAPincodeBackend('ldap://one, ldap://two',
+                                                'uid=$username', '', pool_size=1,
+                                                timeout=0.05, breaker_failures=1)
+            held = busy.pools[0].acquire()
+            self.assertTrue(busy.verify_user_pincode('valid', 'right'))
+            self.assertEqual(busy.pools[0].failures, 0)
+            self.assertEqual(busy.pools[0].down_until, 0)
+            busy.pools[0].release(held)
+
+            logger.debug('With all of them down, we should say so')
+            one['up'] = two['up'] = False
+            with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'bind failed'):
+                backend.verify_user_pincode('valid', 'right')
+            one['up'] = two['up'] = True
+
+            logger.debug('Failed binds should be remembered for a while')
+            backend.enable_negative_cache(0.2)
+            with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Invalid'):
+                backend.verify_user_pincode('valid', 'wrong')
+            binds = one['binds']
+            with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'recently failed'):
+                backend.verify_user_pincode('valid', 'wrong')
+            self.assertEqual(one['binds'], binds)
+
+            # but not the right pincode
+            self.assertTrue(backend.verify_user_pincode('valid', 'right'))
+
+            time.sleep(0.3)
+            with self.assertRaisesRegexp(totpcgi.UserPincodeError, 'Invalid'):
+                backend.verify_user_pincode('valid', 'wrong')
+            self.assertEqual(one['binds'], binds+2)
+
+        finally:
+            restoreLDAP(stub)
+
+    def testRedisConcurrentReuse(self):
+        logger.debug('Running testRedisConcurrentReuse')
+
+        if STATE_BACKEND != 'redis':
+            self.skipTest('needs a redis server, set redis_url to run it')
+
+        gau = getValidUser()
+        backends = getBackends()
+        secret = backends.secret_backend.get_user_secret(gau.user)
+
+        # Two nodes read the same state at the same time ...
+        node1 = getBackends().state_backend
+        node2 = getBackends().state_backend
+        state1 = node1.get_user_state('valid')
+        state2 = node2.get_user_state('valid')
+
+        # ... and both accept the same token
+        state1.success_timestamps.append(secret.timestamp)
+        state2.success_timestamps.append(secret.timestamp)
+        node1.update_user_state('valid', state1)
+
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'been used once'):
+            node2.update_user_state('valid', state2)
+
+        # The second attempt should have been recorded as a failure
+        state = node1.get_user_state('valid')
+        self.assertEqual(state.success_timestamps, [secret.timestamp])
+        self.assertEqual(state.fail_timestamps, [secret.timestamp])
+        node1.update_user_state('valid', state)
+
+        # If the other node hits the rate limit while we verify a token,
+        # we must not accept it
+        state1 = node1.get_user_state('valid')
+        state2 = node2.get_user_state('valid')
+
+        state2.fail_timestamps.extend([secret.timestamp-30, secret.timestamp-60])
+        node2.update_user_state('valid', state2)
+
+        state1.success_timestamps.append(secret.timestamp+30)
+        state1.rate_limit = (3, 90)
+        with self.assertRaisesRegexp(totpcgi.VerifyFailed, 'Rate-limit'):
+            node1.update_user_state('valid', state1)
+
+        state = node1.get_user_state('valid')
+        self.assertEqual(state.success_timestamps, [secret.timestamp])
+        self.assertEqual(len(state.fail_timestamps), 4)
+        node1.update_user_state('valid', state)
+
+        # Threads sharing a backend must not mix up what each of them read
+        import threading
+
+        def same_user(n):
+            for i in xrange(20):
+                with node1.transaction('threaded') as state:
+                    state.used_scratch_tokens.append(n*100+i)
+
+        workers = [threading.Thread(target=same_user, args=(n,)) for n in xrange(4)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        with node1.transaction('threaded') as state:
+            self.assertEqual(sorted(state.used_scratch_tokens),
+                             [n*100+i for n in xrange(4) for i in xrange(20)])
+        node1.delete_user_state('threaded')
+
+    def testStateDurability(self):
+        logger.debug('Running testStateDurability')
+
+        import threading
+        import totpcgi.backends.file
+
+        with self.assertRaises(ValueError):
+            totpcgi.backends.file.GAStateBackend(state_dir, durability='bogus')
+
+        for durability in ('fsync', 'group'):
+            tmpdir = tempfile.mkdtemp()
+
+            try:
+                backend = totpcgi.backends.file.GAStateBackend(tmpdir, durability=durability)
+
+                def worker(n):
+                    for i in xrange(5):
+                        state = backend.get_user_state('user%s' % n)
+                        state.used_scratch_tokens.append(i)
+                        backend.update_user_state('user%s' % n, state)
+
+                workers = [threading.Thread(target=worker, args=(n,)) for n in xrange(4)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+
+                for n in xrange(4):
+                    state = backend.get_user_state('user%s' % n)
+                    self.assertEqual(state.used_scratch_tokens, range(5))
+                    backend.update_user_state('user%s' % n, state)
+
+                logger.debug('Threads taking turns with the same user')
+                backend.set_lock_timeout(10)
+
+                def same_user(n):
+                    for i in xrange(30):
+                        with backend.transaction('shared') as state:
+                            state.used_scratch_tokens.append(n*100+i)
+                        if i % 10 == 0:
+                            # an aborted transaction should let go, too
+                            with self.assertRaises(RuntimeError):
+                                with backend.transaction('shared') as state:
+                                    raise RuntimeError('Boom')
+
+                workers = [threading.Thread(target=same_user, args=(n,)) for n in xrange(4)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+
+                with backend.transaction('shared') as state:
+                    self.assertEqual(sorted(state.used_scratch_tokens),
+                                     [n*100+i for n in xrange(4) for i in xrange(30)])
+                self.assertEqual(backend.fhs, {})
+                # nobody has any of these users, so we shouldn't keep locks for them
+                self.assertEqual([key for key in totpcgi.backends.file.user_locks
+                                  if key[0] == tmpdir], [])
+
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def testShardedLayout(self):
+        logger.debug('Running testShardedLayout')
+
+        if SECRET_BACKEND != 'File' or STATE_BACKEND != 'File':
+            return
+
+        import totpcgi.backends.file
+
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            flat_secrets = totpcgi.backends.file.GASecretBackend(tmpdir)
+            flat_state = totpcgi.backends.file.GAStateBackend(tmpdir)
+
+            gaus = totpcgi.utils.generate_secret()
+            flat_secrets.save_user_secret('valid', gaus)
+            state = flat_state.get_user_state('valid')
+            state.used_scratch_tokens.append(12345678)
+            flat_state.update_user_state('valid', state)
+
+            secrets = totpcgi.backends.file.GASecretBackend(tmpdir, sharded=True)
+            states = totpcgi.backends.file.GAStateBackend(tmpdir, sharded=True)
+
+            logger.debug('Reading from the flat layout')
+            self.assertEqual(secrets.get_user_secret('valid').otp.secret,
+                             gaus.otp.secret)
+            state = states.get_user_state('valid')
+            self.assertEqual(state.used_scratch_tokens, [12345678])
+            states.update_user_state('valid', state)
+
+            logger.debug('Migrating to the sharded layout')
+            self.assertEqual(secrets.migrate_to_sharded(), 1)
+            self.assertEqual(states.migrate_to_sharded(), 1)
+
+            for ext in ('.totp', '.json'):
+                self.assertFalse(os.path.exists(
+                    totpcgi.backends.file.get_flat_path(tmpdir, 'valid', ext)))
+                self.assertTrue(os.path.exists(
+                    totpcgi.backends.file.get_sharded_path(tmpdir, 'valid', ext)))
+
+            self.assertEqual(secrets.get_user_secret('valid').otp.secret,
+                             gaus.otp.secret)
+            state = states.get_user_state('valid')
+            self.assertEqual(state.used_scratch_tokens, [12345678])
+            states.update_user_state('valid', state)
+
+            logger.debug('Writing new users into the sharded layout')
+            secrets.save_user_secret('shardy', gaus)
+            states.get_user_state('shardy')
+            states.update_user_state('shardy', totpcgi.GAUserState())
+            self.assertEqual(os.listdir(tmpdir).count('shardy.totp'), 0)
+            self.assertTrue(os.path.exists(
+                totpcgi.backends.file.get_sharded_path(tmpdir, 'shardy', '.json')))
+
+            secrets.delete_user_secret('shardy')
+            with self.assertRaises(totpcgi.UserNotFound):
+                secrets.get_user_secret('shardy')
+
+            logger.debug('Migrating a state file right after we found it')
+            state = flat_state.get_user_state('racy')
+            state.used_scratch_tokens.append(87654321)
+            flat_state.update_user_state('racy', state)
+
+            find_user_file = totpcgi.backends.file.find_user_file
+
+            def migrate_after_find(*args):
+                path = find_user_file(*args)
+                states.migrate_to_sharded()
+                return path
+
+            totpcgi.backends.file.find_user_file = migrate_after_find
+            try:
+                state = states.get_user_state('racy')
+            finally:
+                totpcgi.backends.file.find_user_file = find_user_file
+
+            self.assertEqual(state.used_scratch_tokens, [87654321])
+            states.update_user_state('racy', state)
+            self.assertEqual(os.listdir(tmpdir).count('racy.json'), 0)
+            state = states.get_user_state('racy')
+            self.assertEqual(state.used_scratch_tokens, [87654321])
+            states.update_user_state('racy', state)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     assert sys.version_info[0] >= 2 and sys.version_info[1] >= 7, \
@@ -706,6 +2337,24 @@ if __name__ == '__main__':
         mysql_connect_password = os.environ['mysql_connect_password']
         mysql_connect_db = os.environ['mysql_connect_db']
 
+    # To test sqlite backend, do:
+    # export sqlite_db='/path/to/test.db'
+    if 'sqlite_db' in os.environ.keys():
+        STATE_BACKEND = SECRET_BACKEND = PINCODE_BACKEND = 'sqlite'
+        sqlite_db = os.environ['sqlite_db']
+
+    # To test the in-memory journal state backend, do:
+    # export journal_dir='/path/to/dir'
+    if 'journal_dir' in os.environ.keys():
+        STATE_BACKEND = 'journal'
+        journal_dir = os.environ['journal_dir']
+
+    # To test the redis state backend, start a local redis-server and do:
+    # export redis_url='redis://localhost:6379/15'
+    if 'redis_url' in os.environ.keys():
+        STATE_BACKEND = 'redis'
+        redis_url = os.environ['redis_url']
+
     backends = getBackends()
 
     # valid user
@@ -16,16 +16,38 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
 # 02111-1307, USA.
 #
+import os
+import copy
+import hmac
 import time
 import pyotp
+import hashlib
 import logging
+import threading
 import exceptions
 import re
 
+from collections import deque
+
 logger = logging.getLogger('totpcgi')
 
 SANE_USERNAME_RE = re.compile(r'([\w\.@=+_-]+)')
 
+# What we say when checking the token first, so we don't tell which
+# of the two factors was wrong
+PINCODE_OR_TOKEN_FAILED = 'Pincode or token failed to verify'
+
+# How many fail timestamps we keep per 30-second step when we don't know
+# the user's rate limit, unless told the largest one in use, see
+# bound_fail_timestamps and Backends.set_max_rate_limit
+FAIL_STEP_CAP = 10
+
+# How many times we re-read the state and check the token again when an
+# optimistic state backend finds someone else updated it under us
+STATE_CONFLICT_RETRIES = 3
+
+RATE_LIMIT_REACHED = 'Rate-limit reached, please try again later'
+
 
 class UserNotFound(exceptions.Exception):
     def __init__(self, message):
@@ -45,6 +67,18 @@ class UserStateError(exceptions.Exception):
         logger.debug('!UserStateError: %s' % message)
 
 
+class UserStateConflict(UserStateError):
+    def __init__(self, message):
+        UserStateError.__init__(self, message)
+        logger.debug('!UserStateConflict: %s' % message)
+
+
+class UserStateLockTimeout(UserStateError):
+    def __init__(self, message):
+        UserStateError.__init__(self, message)
+        logger.debug('!UserStateLockTimeout: %s' % message)
+
+
 class UserPincodeError(exceptions.Exception):
     def __init__(self, message):
         exceptions.Exception.__init__(self, message)
@@ -69,12 +103,189 @@ class DeleteFailed(exceptions.Exception):
         logger.debug('!DeleteFailed: %s' % message)
 
 
+def bound_fail_timestamps(timestamps, per_step, cutoff):
+    """ Drops fail timestamps older than cutoff and keeps at most per_step
+        of the newest ones in each 30-second step, which is all that the
+        rate-limit and used-token checks can ever tell apart, so the state
+        doesn't grow with the number of attempts."""
+    counts = {}
+    kept = []
+
+    for timestamp in sorted(timestamps, reverse=True):
+        if timestamp < cutoff:
+            break
+
+        step = timestamp // 30
+        if counts.get(step, 0) >= per_step:
+            continue
+
+        counts[step] = counts.get(step, 0) + 1
+        kept.append(timestamp)
+
+    kept.reverse()
+    return kept
+
+
+def get_lockout_until(fail_timestamps, rate_limit):
+    """ Returns when fail_timestamps will no longer get the user
+        rate-limited, or None if they don't now."""
+    (times, seconds) = rate_limit
+
+    # count them the same way verify_token does
+    counted = bound_fail_timestamps(fail_timestamps, times, 0)
+    if len(counted) < times:
+        return None
+
+    return counted[-times] + 30 + seconds
+
+
+class LockoutCache:
+    """ Remembers which users are rate-limited, and until when, so that
+        further attempts can be turned away without reading their secret
+        or state. Attempts turned away are counted, per user and in total,
+        so they still show up in audits."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        # user -> [locked until, attempts turned away]
+        self.entries = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def _drop(self, user):
+        (until, rejected) = self.entries.pop(user)
+        if rejected:
+            logger.info('Turned away %s attempts for %s while rate-limited'
+                        % (rejected, user))
+
+    def lock_out(self, user, until):
+        with self.lock:
+            now = time.time()
+            for (locked_user, entry) in self.entries.items():
+                if entry[0] <= now:
+                    self._drop(locked_user)
+
+            if user in self.entries:
+                self.entries[user][0] = max(self.entries[user][0], until)
+                return
+
+            if len(self.entries) >= self.maxsize:
+                # make room by dropping whoever gets unlocked next
+                self._drop(min(self.entries, key=lambda u: self.entries[u][0]))
+
+            logger.debug('Locking out %s until %s' % (user, until))
+            self.entries[user] = [until, 0]
+
+    def check(self, user):
+        """ Returns True, and counts the attempt, if user is locked out."""
+        with self.lock:
+            if user not in self.entries:
+                return False
+
+            if self.entries[user][0] <= time.time():
+                self._drop(user)
+                return False
+
+            self.entries[user][1] += 1
+            self.rejected += 1
+            return True
+
+
+class HOTPTable:
+    """ Which code each of a secret's next HOTP counters gives, so that
+        checking a token against even a very large look-ahead window is a
+        dict lookup. As the counter moves on, we drop the counters behind
+        it and only compute the new ones ahead."""
+
+    def __init__(self, otp, lookahead=0):
+        self.otp = otp
+        self.lookahead = lookahead
+        self.start = 0
+        self.end = 0
+        # code -> counters that give it, lowest first
+        self.codes = {}
+        # the codes for counters start..end-1, in order
+        self.tokens = deque()
+        self.lock = threading.Lock()
+
+    def _move_to(self, start, end):
+        if start < self.start or start >= self.end:
+            # nothing we have is any use
+            self.codes = {}
+            self.tokens = deque()
+            (self.start, self.end) = (start, start)
+
+        while self.start < start:
+            token = self.tokens.popleft()
+            self.codes[token].pop(0)
+            if not self.codes[token]:
+                del self.codes[token]
+            self.start += 1
+
+        while self.end < end:
+            token = self.otp.at(self.end)
+            self.tokens.append(token)
+            self.codes.setdefault(token, []).append(self.end)
+            self.end += 1
+
+    def find(self, token, counter, window_size):
+        """ Returns the first counter from counter to counter+window_size
+            that gives token, or None."""
+        with self.lock:
+            self._move_to(counter, counter + max(window_size+1, self.lookahead))
+
+            counters = self.codes.get(token)
+            if counters and counters[0] <= counter+window_size:
+                return counters[0]
+
+        return None
+
+
+# Only enabled in persistent processes, see enable_hotp_tables
+hotp_tables = None
+hotp_tables_key = None
+hotp_lookahead = 0
+
+
+def enable_hotp_tables(ttl, lookahead=100, maxsize=1024):
+    global hotp_tables
+    global hotp_tables_key
+    global hotp_lookahead
+
+    import totpcgi.utils
+
+    logger.debug('Keeping the next %s HOTP codes for %s seconds' % (lookahead, ttl))
+    hotp_tables = totpcgi.utils.TTLCache(ttl, maxsize)
+    # so the cache isn't keyed by the secrets themselves
+    hotp_tables_key = os.urandom(32)
+    hotp_lookahead = lookahead
+
+
+def get_hotp_table(otp):
+    if hotp_tables is None:
+        return None
+
+    key = hmac.new(hotp_tables_key, otp.secret, hashlib.sha256).digest()
+
+    table = hotp_tables.get(key)
+    if table is None:
+        table = HOTPTable(otp, hotp_lookahead)
+        hotp_tables.set(key, table)
+
+    return table
+
+
 class GAUserState:
     def __init__(self):
         self.fail_timestamps = []
         self.success_timestamps = []
         self.used_scratch_tokens = []
         self.counter = -1
+        # the last TOTP step we accepted, with replay_guard = last_step
+        self.last_step = -1
+        # (count, seconds) of the secret it was checked against, if any,
+        # for backends that enforce the rate limit again when writing
+        self.rate_limit = None
 
 
 class GAUserSecret:
@@ -139,6 +350,23 @@ class GAUserSecret:
 
         else:
             logger.debug('Verifying as HOTP')
+
+            table = get_hotp_table(self.otp)
+            if table is not None:
+                at_count = table.find(token, self.counter, max(self.window_size, 0))
+                if at_count is None:
+                    return False, 'HOTP token failed to verify'
+
+                if at_count == self.counter:
+                    self.counter += 1
+                    logger.info('Incremented counter to %s' % self.counter)
+                    return True, 'Valid HOTP token used'
+
+                logger.info('Incremented counter by %s ticks to %s' %
+                            (at_count - self.counter, at_count+1))
+                self.counter = at_count+1
+                return True, 'Valid HOTP token within window size used'
+
             current = self.otp.at(self.counter)
             if token == current:
                 self.counter += 1
@@ -172,125 +400,221 @@ class GAUser:
     def verify_pincode(self, pincode):
         return self.backends.pincode_backend.verify_user_pincode(self.user, pincode)
 
-    def verify_token(self, token, pincode=None):
-        success = (False, 'Verification failed')
+    def get_secret(self, pincode=None):
+        return self.backends.secret_backend.get_user_secret(self.user, pincode)
 
-        try:
-            secret = self.backends.secret_backend.get_user_secret(self.user, pincode)
-        except UserSecretError, ex:
-            logger.debug('Failed to obtain user secret: %s' % ex)
-            logger.debug('Marking failed timestamp and returning failure')
-            state = self.backends.state_backend.get_user_state(self.user)
+    def _retry_on_conflict(self, func, *args):
+        for attempt in xrange(STATE_CONFLICT_RETRIES):
+            try:
+                return func(*args)
+            except UserStateConflict, ex:
+                logger.debug('Retrying after state conflict (attempt %s)'
+                             % (attempt+1))
+
+        raise UserStateError('Too many concurrent state updates for %s' % self.user)
+
+    def _mark_secret_failure(self):
+        with self.backends.state_backend.transaction(self.user) as state:
             # Since we were not able to obtain the secret object, we bluntly
             # invalidate the past 10 timestamps
             now = int(time.time())
             for timestamp in xrange(now, now-300, -30):
                 state.fail_timestamps.append(timestamp)
-            self.backends.state_backend.update_user_state(self.user, state)
-            raise ex
+            # We don't know the user's rate limit without the secret, so
+            # keep what the largest one in use needs, and at least
+            # whatever covers the steps we just invalidated.
+            (times, seconds) = self.backends.max_rate_limit
+            state.fail_timestamps = bound_fail_timestamps(
+                state.fail_timestamps, times, now-(30+max(seconds, 300)))
+            # which only keeps tokens from being reused with timestamps
+            if self.backends.replay_guard == 'last_step':
+                state.last_step = max(state.last_step, now // 30)
+
+    def _mark_pincode_failure(self, secret, last_step_only):
+        with self.backends.state_backend.transaction(self.user) as state:
+            cutoff = secret.timestamp-(30+secret.rate_limit[1])
+            state.fail_timestamps = bound_fail_timestamps(
+                state.fail_timestamps, secret.rate_limit[0], cutoff)
 
-        state = self.backends.state_backend.get_user_state(self.user)
-        new_state = GAUserState()
+            if last_step_only:
+                state.fail_timestamps.append(secret.timestamp)
+            else:
+                for ts in xrange(secret.timestamp, secret.timestamp-(secret.window_size*10), -30):
+                    state.fail_timestamps.append(ts)
 
-        # grab the counter from the state and modify user secret with latest counter info
-        logger.debug('state.counter=%s, secret.counter=%s' % (state.counter, secret.counter))
-        if state.counter > secret.counter:
-            secret.set_hotp(state.counter)
+        return state
 
-        used_tokens = []
+    def verify_token(self, token, pincode=None, pincode_check=None, secret=None):
+        """ If pincode_check is passed, it is called to verify the pincode
+            only once the token itself checks out, and either factor failing
+            gives the same answer."""
+        try:
+            if secret is None:
+                secret = self.get_secret(pincode)
+        except UserSecretError, ex:
+            logger.debug('Failed to obtain user secret: %s' % ex)
+            logger.debug('Marking failed timestamp and returning failure')
+            self._retry_on_conflict(self._mark_secret_failure)
+            raise ex
 
-        new_state.used_scratch_tokens = state.used_scratch_tokens
+        # Each attempt starts from the secret as we got it, since checking
+        # the token moves its timestamp or counter along.
+        return self._retry_on_conflict(
+            lambda: self._verify_with_state(token, pincode_check, copy.copy(secret)))
 
-        # We only track used_tokens in TOTP mode, so we don't care to track success_timestamps
-        # when we're using counters instead.
-        if not secret.is_hotp():
+    def _verify_with_state(self, token, pincode_check, secret):
+        success = (False, 'Verification failed')
+        rate_limited = False
 
-            for timestamp in state.success_timestamps:
-                # trim any timestamps that are older than (30s + WINDOW_SIZE)
-                cutoff = secret.timestamp-(30+(secret.window_size*10))
+        with self.backends.state_backend.transaction(self.user) as state:
+            new_state = GAUserState()
 
-                if timestamp < cutoff:
-                    continue
+            # grab the counter from the state and modify user secret with latest counter info
+            logger.debug('state.counter=%s, secret.counter=%s' % (state.counter, secret.counter))
+            if state.counter > secret.counter:
+                secret.set_hotp(state.counter)
 
-                at_token = secret.get_token_at(timestamp)
+            used_tokens = []
+            step_tokens = {}
 
-                if at_token not in used_tokens:
-                    used_tokens.append(at_token)
+            def add_used_token(timestamp):
+                # all timestamps within the same step give the same token
+                step = timestamp // 30
+                if step not in step_tokens:
+                    step_tokens[step] = secret.get_token_at(timestamp)
+                    if step_tokens[step] not in used_tokens:
+                        used_tokens.append(step_tokens[step])
 
-                new_state.success_timestamps.append(timestamp)
+            new_state.used_scratch_tokens = state.used_scratch_tokens
+            new_state.last_step = state.last_step
 
-        # are you being rate-limited right now?
-        for timestamp in state.fail_timestamps:
-            # trim any timestamps that are too old to consider
-            cutoff = secret.timestamp-(30+secret.rate_limit[1])
-            if timestamp < cutoff:
-                continue
+            # With only the last step we accepted to go by, any token from
+            # that step or before it counts as used, and we don't need to
+            # generate a single token to tell.
+            last_step_only = (self.backends.replay_guard == 'last_step'
+                              and not secret.is_hotp())
 
-            if not secret.is_hotp():
-                at_token = secret.get_token_at(timestamp)
+            if last_step_only:
+                # in case we just switched over from keeping timestamps
+                for timestamp in state.success_timestamps:
+                    new_state.last_step = max(new_state.last_step, timestamp // 30)
 
-                if at_token not in used_tokens:
-                    used_tokens.append(at_token)
+            # We only track used_tokens in TOTP mode, so we don't care to track success_timestamps
+            # when we're using counters instead.
+            elif not secret.is_hotp():
 
-            new_state.fail_timestamps.append(timestamp)
+                for timestamp in state.success_timestamps:
+                    # trim any timestamps that are older than (30s + WINDOW_SIZE)
+                    cutoff = secret.timestamp-(30+(secret.window_size*10))
 
-        logger.debug('used_tokens=%s' % used_tokens)
+                    if timestamp < cutoff:
+                        continue
 
-        if len(new_state.fail_timestamps) >= secret.rate_limit[0]:
-            success = (False, 'Rate-limit reached, please try again later')
+                    add_used_token(timestamp)
+                    new_state.success_timestamps.append(timestamp)
 
-        else:
-            # Is this token valid at all?
-            if len(str(token)) > 8:
-                success = (False, 'Token is too long')
-            else:
-                try:
-                    token = int(token)
-                except ValueError:
-                    success = (False, 'Token is not an integer')
-                    token = -1
-
-                # Is this a scratch-code token?
-                if token > 999999:
-                    logger.debug('A scratch-code token is used')
-
-                    # has it been used before?
-                    if token in state.used_scratch_tokens:
-                        success = (False, 'Scratch-token already used once')
-                    elif not secret.verify_scratch_token(token):
-                        # we get out early, without updating state, since we
-                        # will retry this as a pincode+6-digit token and the
-                        # failure will be recorded at that step.
-                        self.backends.state_backend.update_user_state(
-                            self.user, state)
-                        raise VerifyFailed('Not a valid scratch-token')
-                    else:
-                        success = (True, 'Scratch-token used')
-                        new_state.used_scratch_tokens.append(token)
+            # are you being rate-limited right now? Trim any timestamps that are
+            # too old to consider, and any beyond what it takes to hit the limit.
+            cutoff = secret.timestamp-(30+secret.rate_limit[1])
+            new_state.fail_timestamps = bound_fail_timestamps(
+                state.fail_timestamps, secret.rate_limit[0], cutoff)
 
-                elif token >= 0:
-                    logger.debug('A regular token is used')
+            if not secret.is_hotp() and not last_step_only:
+                for timestamp in new_state.fail_timestamps:
+                    add_used_token(timestamp)
 
-                    # has it been used before?
-                    if not secret.is_hotp() and token in used_tokens:
-                        success = (False, 'Token has already been used once')
-                    else:
-                        success = secret.verify_token(token)
+            logger.debug('used_tokens=%s' % used_tokens)
 
-            # Adjust state accordingly
-            if success[0] is True:
-                new_state.success_timestamps.append(secret.timestamp)
-            else:
-                # Add all timestamps that are within the back-window
-                for ts in xrange(secret.timestamp, secret.timestamp-(secret.window_size*10), -30):
-                    new_state.fail_timestamps.append(ts)
+            if len(new_state.fail_timestamps) >= secret.rate_limit[0]:
+                success = (False, RATE_LIMIT_REACHED)
+                rate_limited = True
 
-        new_state.counter = secret.counter
-        self.backends.state_backend.update_user_state(self.user, new_state)
+            else:
+                # Is this token valid at all?
+                if len(str(token)) > 8:
+                    success = (False, 'Token is too long')
+                else:
+                    try:
+                        token = int(token)
+                    except ValueError:
+                        success = (False, 'Token is not an integer')
+                        token = -1
+
+                    # Is this a scratch-code token?
+                    if token > 999999:
+                        logger.debug('A scratch-code token is used')
+
+                        # has it been used before?
+                        if token in state.used_scratch_tokens:
+                            success = (False, 'Scratch-token already used once')
+                        elif not secret.verify_scratch_token(token):
+                            # we get out early, without updating state, since we
+                            # will retry this as a pincode+6-digit token and the
+                            # failure will be recorded at that step.
+                            raise VerifyFailed('Not a valid scratch-token')
+                        else:
+                            success = (True, 'Scratch-token used')
+                            new_state.used_scratch_tokens.append(token)
+
+                    elif token >= 0:
+                        logger.debug('A regular token is used')
+
+                        # has it been used before?
+                        if not secret.is_hotp() and token in used_tokens:
+                            success = (False, 'Token has already been used once')
+                        else:
+                            success = secret.verify_token(token)
+
+                        if (success[0] is True and last_step_only
+                                and secret.timestamp // 30 <= new_state.last_step):
+                            success = (False, 'Token has already been used once')
+
+                # Adjust state accordingly
+                if last_step_only:
+                    if success[0] is True:
+                        if token <= 999999:
+                            new_state.last_step = secret.timestamp // 30
+                    else:
+                        # just to count towards the rate limit
+                        new_state.fail_timestamps.append(secret.timestamp)
+                elif success[0] is True:
+                    new_state.success_timestamps.append(secret.timestamp)
+                else:
+                    # Add all timestamps that are within the back-window
+                    for ts in xrange(secret.timestamp, secret.timestamp-(secret.window_size*10), -30):
+                        new_state.fail_timestamps.append(ts)
+
+            # what's in state when we're done is what gets written back
+            state.fail_timestamps = new_state.fail_timestamps
+            state.success_timestamps = new_state.success_timestamps
+            state.used_scratch_tokens = new_state.used_scratch_tokens
+            state.counter = secret.counter
+            state.last_step = new_state.last_step
+            state.rate_limit = secret.rate_limit
+
+        # Only now that the token checked out, and without holding the
+        # state, do we spend the time on the pincode. The token stays
+        # used either way, and a wrong pincode counts as a failure.
+        if success[0] is True and pincode_check is not None:
+            try:
+                pincode_check()
+            except (UserPincodeError, UserNotFound), ex:
+                logger.debug('Token verified, but pincode did not: %s' % ex)
+                success = (False, str(ex))
+                state = self._retry_on_conflict(
+                    self._mark_pincode_failure, secret, last_step_only)
+
+        lockout_cache = self.backends.lockout_cache
+        if lockout_cache is not None and success[0] is False:
+            until = get_lockout_until(state.fail_timestamps, secret.rate_limit)
+            if until is not None:
+                lockout_cache.lock_out(self.user, until)
 
         logger.debug('success=%s' % str(success))
 
         if success[0] is False:
+            if pincode_check is not None and not rate_limited:
+                raise VerifyFailed(PINCODE_OR_TOKEN_FAILED)
             raise VerifyFailed(success[1])
 
         return success[1]
@@ -298,12 +622,19 @@ class GAUser:
 
 class GoogleAuthenticator:
 
-    def __init__(self, backends, require_pincode=False):
+    def __init__(self, backends, require_pincode=False, token_first=False):
         self.backends = backends
         self.require_pincode = require_pincode
+        self.token_first = token_first
 
     def verify_user_token(self, user, token):
         user = GAUser(user, self.backends)
+
+        # Known to be rate-limited, so don't bother any of the backends
+        lockout_cache = self.backends.lockout_cache
+        if lockout_cache is not None and lockout_cache.check(user.user):
+            raise VerifyFailed(RATE_LIMIT_REACHED)
+
         # let's figure out if it's:
         #  1. regular 6-digit token
         #  2. 8-digit scratch-code
@@ -335,6 +666,18 @@ class GoogleAuthenticator:
 
             except ValueError:
                 logger.debug('8-char token used, but is not an int')
+
+        if self.token_first:
+            try:
+                secret = user.get_secret()
+            except UserSecretError:
+                # Most likely encrypted with the pincode, so there is no
+                # checking the token without it.
+                logger.debug('Cannot check the token first, checking pincode first')
+                secret = None
+
+            if secret is not None:
+                return self._verify_token_first(user, token, secret)
         
         # Let's try to verify as a pincode + 6-digit 
         pincode = token[:-6]
@@ -364,4 +707,31 @@ class GoogleAuthenticator:
 
             raise ex
 
-        return user.verify_token(tokencode, pincode)
\ No newline at end of file
+        return user.verify_token(tokencode, pincode)
+
+    def _verify_token_first(self, user, token, secret):
+        # Try pincode + 8-digit scratch code first, since a scratch code
+        # that doesn't exist gets rejected without recording a failure,
+        # which a wrong 6-digit token would.
+        if len(token) > 8:
+            pincode = token[:-8]
+            tokencode = token[-8:]
+
+            try:
+                if int(tokencode) > 999999:
+                    logger.debug('Trying to verify as pincode + 8-digit scratch code')
+                    return user.verify_token(tokencode, pincode,
+                                             lambda: user.verify_pincode(pincode),
+                                             secret)
+            except ValueError:
+                pass
+            except VerifyFailed, ex:
+                if str(ex) != 'Not a valid scratch-token':
+                    raise
+
+        logger.debug('Trying to verify as pincode + 6-digit token')
+        pincode = token[:-6]
+        tokencode = token[-6:]
+
+        return user.verify_token(tokencode, pincode,
+                                 lambda: user.verify_pincode(pincode), secret)
@@ -13,14 +13,205 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
 # 02111-1307, USA.
 #
+import os
+import sys
+import hmac
+import time
+import bisect
+import hashlib
+import contextlib
 import logging
+import threading
 import totpcgi
+import totpcgi.utils
+import totpcgi.offload
 import syslog
 
 import exceptions
 
 logger = logging.getLogger('totpcgi')
 
+# Hashcode prefixes of the schemes we accept for pincodes
+HASHCODE_PREFIXES = (
+    ('$2a$', 'bcrypt'),
+    ('$2b$', 'bcrypt'),
+    ('$2y$', 'bcrypt'),
+    ('$5$', 'sha256_crypt'),
+    ('$6$', 'sha512_crypt'),
+    ('$1$', 'md5_crypt'),
+)
+
+# What hash_pincode algorithms we can rehash to
+REHASH_SCHEMES = {
+    'bcrypt': 'bcrypt',
+    'sha256': 'sha256_crypt',
+    'sha512': 'sha512_crypt',
+}
+
+crypt_context = None
+
+# Upper bounds, in seconds, of the state lock wait histogram buckets
+LOCK_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+
+# Per-process lock wait stats, by state backend engine
+lock_wait_stats = {}
+
+# How GAUser tells a reused TOTP token: by the timestamps it keeps of
+# recent successes and failures, or by just the last step it accepted
+REPLAY_GUARDS = ('timestamps', 'last_step')
+
+
+def get_crypt_context():
+    global crypt_context
+
+    if crypt_context is None:
+        from passlib.context import CryptContext
+        crypt_context = CryptContext(schemes=['sha256_crypt', 'sha512_crypt',
+                                              'bcrypt', 'md5_crypt'])
+    return crypt_context
+
+
+def get_hashcode_scheme(hashcode):
+    for (prefix, scheme) in HASHCODE_PREFIXES:
+        if hashcode.startswith(prefix):
+            return scheme
+
+    raise totpcgi.UserPincodeError('Unsupported hashcode format')
+
+
+def verify_hashcode(pincode, hashcode):
+    # This is the expensive part, so it may run in an offload worker
+    scheme = get_hashcode_scheme(hashcode)
+
+    try:
+        handler = get_crypt_context().handler(scheme)
+        if not handler.verify(pincode, hashcode):
+            raise totpcgi.UserPincodeError('Pincode did not match.')
+
+        return True
+
+    except ValueError:
+        raise totpcgi.UserPincodeError('Unsupported hashcode format')
+
+
+class LockWaitStats:
+    """ Counts how often and for how long a state backend had to wait
+        for user locks in this process, so contention shows up before
+        requests start timing out."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.buckets = [0] * (len(LOCK_WAIT_BUCKETS)+1)
+
+    def record(self, waited, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            self.buckets[bisect.bisect_left(LOCK_WAIT_BUCKETS, waited)] += 1
+
+    def summary(self):
+        with self.lock:
+            count = self.acquired + self.timeouts
+            if count:
+                avg_wait = self.total_wait / count
+            else:
+                avg_wait = 0
+
+            labels = ['<=%gs' % bound for bound in LOCK_WAIT_BUCKETS]
+            labels.append('>%gs' % LOCK_WAIT_BUCKETS[-1])
+            histogram = ' '.join('%s:%s' % (label, hits)
+                                 for (label, hits) in zip(labels, self.buckets))
+
+            return ('acquired=%s, timeouts=%s, avg_wait=%.4fs, max_wait=%.4fs, '
+                    'waits=[%s]' % (self.acquired, self.timeouts, avg_wait,
+                                    self.max_wait, histogram))
+
+
+def changed_state(loaded, state):
+    """ Returns which parts of the state differ from what was loaded,
+        out of timestamps, used_scratch_tokens, counter and last_step.
+        Everything has changed if nothing was loaded."""
+    if loaded is None:
+        return set(['timestamps', 'used_scratch_tokens', 'counter', 'last_step'])
+
+    changed = set()
+    if (sorted(loaded.fail_timestamps) != sorted(state.fail_timestamps)
+            or sorted(loaded.success_timestamps) != sorted(state.success_timestamps)):
+        changed.add('timestamps')
+    if sorted(loaded.used_scratch_tokens) != sorted(state.used_scratch_tokens):
+        changed.add('used_scratch_tokens')
+    if loaded.counter != state.counter:
+        changed.add('counter')
+    if loaded.last_step != state.last_step:
+        changed.add('last_step')
+
+    return changed
+
+
+class PerThreadDict:
+    """ A dict every thread sees its own contents of. State backends keep
+        what they need between get_user_state and update_user_state in
+        these, so threads working on the same user at the same time
+        don't overwrite each other's entries."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def _get_dict(self):
+        if not hasattr(self.local, 'entries'):
+            self.local.entries = {}
+        return self.local.entries
+
+    def __getitem__(self, key):
+        return self._get_dict()[key]
+
+    def __setitem__(self, key, value):
+        self._get_dict()[key] = value
+
+    def __delitem__(self, key):
+        del self._get_dict()[key]
+
+    def __contains__(self, key):
+        return key in self._get_dict()
+
+    def get(self, key, default=None):
+        return self._get_dict().get(key, default)
+
+    def pop(self, key, *default):
+        return self._get_dict().pop(key, *default)
+
+    def keys(self):
+        return self._get_dict().keys()
+
+
+def get_lock_wait_stats(engine):
+    return lock_wait_stats.setdefault(engine, LockWaitStats())
+
+
+def poll_lock(try_lock, timeout):
+    """ For locks we can only try to take: calls try_lock until it returns
+        True, backing off up to 50ms between tries. Returns False if it
+        didn't within timeout seconds."""
+    deadline = time.time() + timeout
+    delay = 0.001
+
+    while not try_lock():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay*2, 0.05)
+
+    return True
+
 
 class BackendNotSupported(exceptions.Exception):
     def __init__(self, message):
@@ -34,6 +225,29 @@ class Backends:
         self.secret_backend = None
         self.pincode_backend = None
         self.state_backend = None
+        self.lockout_cache = None
+        self.replay_guard = 'timestamps'
+        self.max_rate_limit = (totpcgi.FAIL_STEP_CAP, 300)
+
+    def enable_lockout_cache(self, maxsize=10000):
+        # Only useful in persistent processes
+        logger.debug('Caching rate-limit lockouts for up to %s users' % maxsize)
+        self.lockout_cache = totpcgi.LockoutCache(maxsize)
+
+    def set_max_rate_limit(self, times, seconds):
+        """ Fail timestamps recorded when we can't get at a user's secret
+            are trimmed to what this rate limit needs, so it must be at
+            least as large as the largest any user has."""
+        logger.debug('Largest rate limit in use is %s in %s seconds'
+                     % (times, seconds))
+        self.max_rate_limit = (max(times, 1), seconds)
+
+    def set_replay_guard(self, replay_guard):
+        if replay_guard not in REPLAY_GUARDS:
+            raise ValueError('Unsupported replay guard: %s' % replay_guard)
+
+        logger.debug('Guarding against TOTP token reuse by %s' % replay_guard)
+        self.replay_guard = replay_guard
 
     def load_from_config(self, config):
         secret_backend_engine = config.get('secret_backend', 'engine')
@@ -41,7 +255,9 @@ class Backends:
         if secret_backend_engine == 'file':
             import totpcgi.backends.file
             secrets_dir = config.get('secret_backend', 'secrets_dir')
-            self.secret_backend = totpcgi.backends.file.GASecretBackend(secrets_dir)
+            sharded = (config.has_option('secret_backend', 'sharded')
+                       and config.getboolean('secret_backend', 'sharded'))
+            self.secret_backend = totpcgi.backends.file.GASecretBackend(secrets_dir, sharded)
 
         elif secret_backend_engine == 'pgsql':
             import totpcgi.backends.pgsql
@@ -58,10 +274,28 @@ class Backends:
                 mysql_connect_host, mysql_connect_user,
                 mysql_connect_password, mysql_connect_db)
 
+        elif secret_backend_engine == 'sqlite':
+            import totpcgi.backends.sqlite
+            sqlite_db = config.get('secret_backend', 'sqlite_db')
+            self.secret_backend = totpcgi.backends.sqlite.GASecretBackend(sqlite_db)
+
         else:
             raise BackendNotSupported(
                 'secret_backend engine not supported: %s' % secret_backend_engine)
 
+        if config.has_option('secret_backend', 'kdf_cache_ttl'):
+            kdf_cache_ttl = config.getint('secret_backend', 'kdf_cache_ttl')
+            if kdf_cache_ttl > 0:
+                totpcgi.utils.enable_kdf_cache(kdf_cache_ttl)
+
+        if config.has_option('secret_backend', 'hotp_cache_ttl'):
+            hotp_cache_ttl = config.getint('secret_backend', 'hotp_cache_ttl')
+            hotp_lookahead = 100
+            if config.has_option('secret_backend', 'hotp_lookahead'):
+                hotp_lookahead = config.getint('secret_backend', 'hotp_lookahead')
+            if hotp_cache_ttl > 0:
+                totpcgi.enable_hotp_tables(hotp_cache_ttl, hotp_lookahead)
+
         pincode_backend_engine = config.get('pincode_backend', 'engine')
 
         if pincode_backend_engine == 'file':
@@ -84,28 +318,96 @@ class Backends:
                 mysql_connect_host, mysql_connect_user,
                 mysql_connect_password, mysql_connect_db)
 
+        elif pincode_backend_engine == 'sqlite':
+            import totpcgi.backends.sqlite
+            sqlite_db = config.get('pincode_backend', 'sqlite_db')
+            self.pincode_backend = totpcgi.backends.sqlite.GAPincodeBackend(sqlite_db)
+
         elif pincode_backend_engine == 'ldap':
             import totpcgi.backends.ldap
             ldap_url = config.get('pincode_backend', 'ldap_url')
             ldap_dn = config.get('pincode_backend', 'ldap_dn')
             ldap_cacert = config.get('pincode_backend', 'ldap_cacert')
 
-            self.pincode_backend = totpcgi.backends.ldap.GAPincodeBackend(ldap_url, ldap_dn, ldap_cacert)
+            ldap_pool_size = 4
+            if config.has_option('pincode_backend', 'ldap_pool_size'):
+                ldap_pool_size = config.getint('pincode_backend', 'ldap_pool_size')
+            ldap_timeout = 5
+            if config.has_option('pincode_backend', 'ldap_timeout'):
+                ldap_timeout = config.getint('pincode_backend', 'ldap_timeout')
+            ldap_max_idle = 300
+            if config.has_option('pincode_backend', 'ldap_max_idle'):
+                ldap_max_idle = config.getint('pincode_backend', 'ldap_max_idle')
+
+            ldap_breaker_failures = 3
+            if config.has_option('pincode_backend', 'ldap_breaker_failures'):
+                ldap_breaker_failures = config.getint('pincode_backend', 'ldap_breaker_failures')
+            ldap_breaker_reset = 30
+            if config.has_option('pincode_backend', 'ldap_breaker_reset'):
+                ldap_breaker_reset = config.getint('pincode_backend', 'ldap_breaker_reset')
+
+            self.pincode_backend = totpcgi.backends.ldap.GAPincodeBackend(
+                ldap_url, ldap_dn, ldap_cacert, ldap_pool_size, ldap_timeout,
+                ldap_max_idle, ldap_breaker_failures, ldap_breaker_reset)
+
+            if config.has_option('pincode_backend', 'ldap_negative_ttl'):
+                ldap_negative_ttl = config.getint('pincode_backend', 'ldap_negative_ttl')
+                if ldap_negative_ttl > 0:
+                    self.pincode_backend.enable_negative_cache(ldap_negative_ttl)
         else:
             raise BackendNotSupported(
                 'pincode_engine not supported: %s' % pincode_backend_engine)
 
+        if config.has_option('pincode_backend', 'cache_ttl'):
+            cache_ttl = config.getint('pincode_backend', 'cache_ttl')
+            if cache_ttl > 0:
+                self.pincode_backend.enable_verify_cache(cache_ttl)
+
+        if config.has_option('pincode_backend', 'rehash_to'):
+            rehash_to = config.get('pincode_backend', 'rehash_to')
+            rehash_rounds = None
+            if config.has_option('pincode_backend', 'rehash_rounds'):
+                rehash_rounds = config.getint('pincode_backend', 'rehash_rounds')
+            self.pincode_backend.enable_rehash(rehash_to, rehash_rounds)
+
         state_backend_engine = config.get('state_backend', 'engine')
 
+        # only used by the SQL backends
+        optimistic = (config.has_option('state_backend', 'optimistic')
+                      and config.getboolean('state_backend', 'optimistic'))
+
         if state_backend_engine == 'file':
             import totpcgi.backends.file
             state_dir = config.get('state_backend', 'state_dir')
-            self.state_backend = totpcgi.backends.file.GAStateBackend(state_dir)
+            sharded = (config.has_option('state_backend', 'sharded')
+                       and config.getboolean('state_backend', 'sharded'))
+            durability = 'none'
+            if config.has_option('state_backend', 'durability'):
+                durability = config.get('state_backend', 'durability')
+            group_commit_ms = 2
+            if config.has_option('state_backend', 'group_commit_ms'):
+                group_commit_ms = config.getint('state_backend', 'group_commit_ms')
+            self.state_backend = totpcgi.backends.file.GAStateBackend(
+                state_dir, sharded, durability, group_commit_ms)
+
+            if config.has_option('state_backend', 'replication_log'):
+                replication_log = config.get('state_backend', 'replication_log')
+                peer_logs = []
+                if config.has_option('state_backend', 'replication_peers'):
+                    peer_logs = config.get('state_backend',
+                                           'replication_peers').replace(',', ' ').split()
+                replication_interval = 5
+                if config.has_option('state_backend', 'replication_interval'):
+                    replication_interval = config.getint('state_backend',
+                                                         'replication_interval')
+                self.state_backend.enable_replication(replication_log, peer_logs,
+                                                      replication_interval)
 
         elif state_backend_engine == 'pgsql':
             import totpcgi.backends.pgsql
             pg_connect_string = config.get('state_backend', 'pg_connect_string')
-            self.state_backend = totpcgi.backends.pgsql.GAStateBackend(pg_connect_string)
+            self.state_backend = totpcgi.backends.pgsql.GAStateBackend(
+                pg_connect_string, optimistic)
 
         elif state_backend_engine == 'mysql':
             import totpcgi.backends.mysql
@@ -115,18 +417,111 @@ class Backends:
             mysql_connect_db = config.get('state_backend', 'mysql_connect_db')
             self.state_backend = totpcgi.backends.mysql.GAStateBackend(
                 mysql_connect_host, mysql_connect_user,
-                mysql_connect_password, mysql_connect_db)
+                mysql_connect_password, mysql_connect_db, optimistic)
+
+        elif state_backend_engine == 'sqlite':
+            import totpcgi.backends.sqlite
+            sqlite_db = config.get('state_backend', 'sqlite_db')
+            self.state_backend = totpcgi.backends.sqlite.GAStateBackend(
+                sqlite_db, optimistic)
+
+        elif state_backend_engine == 'journal':
+            import totpcgi.backends.journal
+            journal_dir = config.get('state_backend', 'journal_dir')
+            snapshot_every = 1000
+            if config.has_option('state_backend', 'snapshot_every'):
+                snapshot_every = config.getint('state_backend', 'snapshot_every')
+            self.state_backend = totpcgi.backends.journal.GAStateBackend(
+                journal_dir, snapshot_every)
+
+        elif state_backend_engine == 'redis':
+            import totpcgi.backends.redis
+            redis_url = config.get('state_backend', 'redis_url')
+            state_ttl = 900
+            if config.has_option('state_backend', 'state_ttl'):
+                state_ttl = config.getint('state_backend', 'state_ttl')
+            self.state_backend = totpcgi.backends.redis.GAStateBackend(redis_url, state_ttl)
 
         else:
             syslog.syslog(syslog.LOG_CRIT, 
                 'state_backend engine not supported: %s' % state_backend_engine)
 
+        if (config.has_option('state_backend', 'lockout_cache')
+                and config.getboolean('state_backend', 'lockout_cache')):
+            lockout_cache_size = 10000
+            if config.has_option('state_backend', 'lockout_cache_size'):
+                lockout_cache_size = config.getint('state_backend', 'lockout_cache_size')
+            self.enable_lockout_cache(lockout_cache_size)
+
+        if config.has_option('state_backend', 'replay_guard'):
+            self.set_replay_guard(config.get('state_backend', 'replay_guard'))
+
+        if config.has_option('state_backend', 'max_rate_limit'):
+            (times, seconds) = config.get('state_backend', 'max_rate_limit').split()
+            self.set_max_rate_limit(int(times), int(seconds))
+
+        if (self.state_backend is not None
+                and config.has_option('state_backend', 'lock_timeout')):
+            self.state_backend.set_lock_timeout(
+                config.getfloat('state_backend', 'lock_timeout'))
+
 
 ############################### API STUBS #################################
 
 class GAStateBackend:
     def __init__(self):
-        pass
+        # None waits as long as the underlying lock does
+        self.lock_timeout = None
+        self.lock_stats = get_lock_wait_stats(self.__module__.split('.')[-1])
+        # (user, thread) we hold locks for, and since when
+        self.held = {}
+
+    def set_lock_timeout(self, timeout):
+        logger.debug('Waiting at most %s seconds for state locks' % timeout)
+        self.lock_timeout = timeout
+
+    def _lock_acquired(self, user, started):
+        now = time.time()
+        self.held[(user, threading.current_thread().ident)] = now
+        self.lock_stats.record(now-started)
+
+    def _lock_released(self, user):
+        self.held.pop((user, threading.current_thread().ident), None)
+
+    def held_locks(self, min_age=0):
+        """ Returns (user, seconds held) for the locks we've held for at
+            least min_age seconds. Outside of a request, there should be
+            none, so anything here has leaked."""
+        now = time.time()
+        return sorted((user, now-since) for ((user, thread), since) in self.held.items()
+                      if now-since >= min_age)
+
+    @contextlib.contextmanager
+    def transaction(self, user):
+        """ with state_backend.transaction(user) as state: ...
+
+            Whatever state holds when the block ends gets written back. If
+            the block raises, nothing is written and the lock is released
+            all the same."""
+        try:
+            # if this fails half-way, it may already hold the lock, too
+            state = self.get_user_state(user)
+            yield state
+            self.update_user_state(user, state)
+        except:
+            # don't let a failing abort hide what went wrong in the block
+            exc_info = sys.exc_info()
+            try:
+                self.abort_user_state(user)
+            except Exception, ex:
+                logger.info('Could not abort state update for %s: %s' % (user, ex))
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _lock_timed_out(self, user, started):
+        waited = time.time()-started
+        self.lock_stats.record(waited, timed_out=True)
+        return totpcgi.UserStateLockTimeout(
+            'Timed out after %.1f seconds waiting for the state of %s' % (waited, user))
 
     def get_user_state(self, user):
         pass
@@ -134,6 +529,11 @@ class GAStateBackend:
     def update_user_state(self, user, state):
         pass
 
+    def abort_user_state(self, user):
+        """ Releases whatever get_user_state took without writing anything.
+            Does nothing if we're not holding anything for the user."""
+        pass
+
     def delete_user_state(self, user):
         pass
 
@@ -154,7 +554,31 @@ class GASecretBackend:
 
 class GAPincodeBackend:
     def __init__(self):
-        pass
+        self.verify_cache = None
+        self.rehash_algo = None
+
+    def enable_verify_cache(self, ttl, maxsize=1024):
+        # Only useful in persistent processes. We never keep the pincode
+        # itself around, just a keyed hash of it, using a key that only
+        # ever lives in this process's memory.
+        logger.debug('Caching successful pincode verifications for %s seconds' % ttl)
+        self.verify_cache = totpcgi.utils.TTLCache(ttl, maxsize)
+        self.verify_cache_key = os.urandom(32)
+
+    def enable_rehash(self, algo, rounds=None):
+        if algo not in REHASH_SCHEMES:
+            raise ValueError('Unsupported rehash algorithm: %s' % algo)
+
+        if rounds is None:
+            # same defaults as hash_pincode
+            if algo == 'bcrypt':
+                rounds = get_crypt_context().handler('bcrypt').default_rounds
+            else:
+                rounds = 5000
+
+        logger.debug('Will rehash pincodes to %s with %s rounds' % (algo, rounds))
+        self.rehash_algo = algo
+        self.rehash_rounds = rounds
 
     def verify_user_pincode(self, user, pincode):
         pass
@@ -165,18 +589,57 @@ class GAPincodeBackend:
     def delete_user_hashcode(self, user):
         pass
 
-    @staticmethod
-    def _verify_by_hashcode(pincode, hashcode):
-        logger.debug('Will test against %s' % hashcode)
-        from passlib.context import CryptContext
-        myctx = CryptContext(schemes=['sha256_crypt', 'sha512_crypt',
-                                      'bcrypt', 'md5_crypt'])
+    def _verify_user_hashcode(self, user, pincode, hashcode):
+        cache_key = None
 
-        try:
-            if not myctx.verify(pincode, hashcode):
-                raise totpcgi.UserPincodeError('Pincode did not match.')
+        if self.verify_cache is not None:
+            # Since the stored hashcode is part of the key, changing it
+            # automatically invalidates anything we have cached.
+            cache_key = hmac.new(self.verify_cache_key,
+                                 '\0'.join((user, pincode, hashcode)),
+                                 hashlib.sha256).digest()
+
+            if self.verify_cache.get(cache_key):
+                logger.debug('Found cached pincode verification for %s' % user)
+                return True
+
+        # This raises if the pincode doesn't match, so we only ever
+        # cache successful verifications.
+        self._verify_by_hashcode(pincode, hashcode)
+
+        if cache_key is not None:
+            self.verify_cache.set(cache_key, True)
+
+        if self.rehash_algo is not None:
+            self._rehash_user_hashcode(user, pincode, hashcode)
+
+        return True
 
+    def _needs_rehash(self, hashcode):
+        scheme = get_hashcode_scheme(hashcode)
+
+        if scheme != REHASH_SCHEMES[self.rehash_algo]:
             return True
 
-        except ValueError:
-            raise totpcgi.UserPincodeError('Unsupported hashcode format')
\ No newline at end of file
+        handler = get_crypt_context().handler(scheme)
+        return handler.from_string(hashcode).rounds < self.rehash_rounds
+
+    def _rehash_user_hashcode(self, user, pincode, hashcode):
+        if not self._needs_rehash(hashcode):
+            return
+
+        logger.debug('Rehashing pincode for %s to %s' % (user, self.rehash_algo))
+        new_hashcode = totpcgi.utils.hash_pincode(pincode, self.rehash_algo,
+                                                  self.rehash_rounds)
+
+        # The pincode already verified, so failing to write the upgraded
+        # hash back (e.g. read-only pincodes file) should not fail the login.
+        try:
+            self.save_user_hashcode(user, new_hashcode)
+        except Exception, ex:
+            logger.info('Could not save rehashed pincode for %s: %s' % (user, ex))
+
+    @staticmethod
+    def _verify_by_hashcode(pincode, hashcode):
+        logger.debug('Will test against %s' % hashcode)
+        return totpcgi.offload.run(verify_hashcode, pincode, hashcode)
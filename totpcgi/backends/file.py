@@ -23,10 +23,209 @@ import totpcgi.utils
 logger = logging.getLogger('totpcgi')
 
 import os
-from fcntl import lockf, LOCK_EX, LOCK_UN, LOCK_SH
+import errno
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+from fcntl import lockf, LOCK_EX, LOCK_UN, LOCK_SH, LOCK_NB
 
 import anydbm
 
+# lockf locks belong to the whole process, so they don't keep our own
+# threads off a state file. These do, keyed by (state_dir, user) and
+# holding the ident of the thread that has the user. Every lock also
+# counts the threads holding or waiting for it, and goes away once none
+# do, so we only ever keep locks for the users being logged in right now.
+user_locks = {}
+user_owners = {}
+user_locks_lock = threading.Lock()
+
+# Keeps our own threads from rewriting the pincodes file at the same time,
+# as the lockf lock on its .lock file only keeps out other processes
+pincode_lock = threading.Lock()
+
+# Parsed secret files we keep around, checked against the file's inode,
+# mtime and size before every use
+SECRET_CACHE_TTL = 3600
+SECRET_CACHE_SIZE = 4096
+
+
+def get_flat_path(basedir, user, ext):
+    return os.path.join(basedir, user) + ext
+
+
+def get_sharded_path(basedir, user, ext):
+    # Two levels of hash-prefix subdirectories give us 65536 buckets,
+    # which keeps each directory small even with millions of users.
+    digest = hashlib.sha1(user).hexdigest()
+    return os.path.join(basedir, digest[0:2], digest[2:4], user + ext)
+
+
+def make_shard_dirs(basedir, path):
+    # Create the shard subdirectories with the same permissions as the
+    # parent directory, as we rely on those to keep things safe.
+    mode = os.stat(basedir).st_mode & 07777
+    shard_dir = os.path.dirname(path)
+    try:
+        os.makedirs(shard_dir, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def find_user_file(basedir, user, ext, sharded=False):
+    # When using the sharded layout, we still look in the flat layout,
+    # so things keep working while the migration is under way.
+    # Returns the preferred path if the file does not exist anywhere.
+    paths = [get_flat_path(basedir, user, ext)]
+    if sharded:
+        paths.insert(0, get_sharded_path(basedir, user, ext))
+
+    for path in paths:
+        if os.path.exists(path):
+            return path
+
+    return paths[0]
+
+
+def migrate_to_sharded(basedir, ext):
+    # We hardlink each flat file into its shard before removing the flat
+    # name, so the file is always reachable by at least one of them and any
+    # locks held on it remain valid, as they are tied to the inode.
+    migrated = 0
+
+    for name in os.listdir(basedir):
+        if not name.endswith(ext):
+            continue
+
+        flat_path = os.path.join(basedir, name)
+        if not os.path.isfile(flat_path):
+            continue
+
+        user = name[:-len(ext)]
+        sharded_path = get_sharded_path(basedir, user, ext)
+        make_shard_dirs(basedir, sharded_path)
+
+        try:
+            os.link(flat_path, sharded_path)
+        except OSError as e:
+            # If the sharded file is already there, it was written after
+            # we switched layouts and takes precedence over the flat one.
+            if e.errno != errno.EEXIST:
+                raise
+
+        os.unlink(flat_path)
+        logger.debug('Moved %s to %s' % (flat_path, sharded_path))
+        migrated += 1
+
+    return migrated
+
+
+def fsync_dir(path):
+    dirfd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def merge_timestamps(ours, theirs):
+    """ Every timestamp in either list, as many times as in the list
+        that has it the most often, so merging the same thing twice
+        changes nothing."""
+    counts = collections.Counter(ours)
+    for (timestamp, count) in collections.Counter(theirs).items():
+        counts[timestamp] = max(counts[timestamp], count)
+
+    merged = []
+    for timestamp in sorted(counts):
+        merged.extend([timestamp] * counts[timestamp])
+
+    return merged
+
+
+def merge_user_states(ours, theirs):
+    """ Combines our state with a peer's, keeping every step either of us
+        saw used or failed, and the furthest HOTP counter and TOTP step, so
+        a token used on one node can't be replayed on another."""
+    merged = totpcgi.GAUserState()
+    merged.fail_timestamps = merge_timestamps(ours.fail_timestamps,
+                                              theirs.fail_timestamps)
+    merged.success_timestamps = merge_timestamps(ours.success_timestamps,
+                                                 theirs.success_timestamps)
+
+    merged.used_scratch_tokens = list(ours.used_scratch_tokens)
+    for token in theirs.used_scratch_tokens:
+        if token not in merged.used_scratch_tokens:
+            merged.used_scratch_tokens.append(token)
+
+    merged.counter = max(ours.counter, theirs.counter)
+    merged.last_step = max(ours.last_step, theirs.last_step)
+
+    return merged
+
+
+class GroupCommit:
+    """ Batches fsyncs from concurrent writers in the same process. The
+        first writer to arrive waits for the window to let others join
+        its batch, then fsyncs the whole batch and wakes everyone up."""
+
+    class Batch:
+        def __init__(self):
+            self.fds = []
+            self.done = False
+            self.error = None
+
+    def __init__(self, window):
+        self.window = window
+        self.cond = threading.Condition()
+        self.batch = self.Batch()
+        self.leading = False
+
+    def sync(self, fd):
+        self.cond.acquire()
+        try:
+            batch = self.batch
+            batch.fds.append(fd)
+
+            if self.leading:
+                while not batch.done:
+                    self.cond.wait()
+
+                if batch.error is not None:
+                    raise batch.error
+                return
+
+            self.leading = True
+        finally:
+            self.cond.release()
+
+        time.sleep(self.window)
+
+        # Anyone arriving from now on goes into the next batch, which
+        # gets its own leader while we are busy syncing this one.
+        self.cond.acquire()
+        self.batch = self.Batch()
+        self.leading = False
+        self.cond.release()
+
+        logger.debug('Group commit of %s state files' % len(batch.fds))
+        try:
+            for batch_fd in batch.fds:
+                os.fsync(batch_fd)
+        except OSError, ex:
+            batch.error = ex
+
+        self.cond.acquire()
+        batch.done = True
+        self.cond.notify_all()
+        self.cond.release()
+
+        if batch.error is not None:
+            raise batch.error
+
 
 class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
     def __init__(self, pincode_file):
@@ -112,9 +311,21 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
             except KeyError:
                 raise totpcgi.UserPincodeError('Pincode not found for user %s' % user)
 
-        return self._verify_by_hashcode(pincode, hashcode)
+        return self._verify_user_hashcode(user, pincode, hashcode)
 
     def save_user_hashcode(self, user, hashcode, makedb=True):
+        # Logins rehashing pincodes write here too, so we hold the lock
+        # from reading the file until the new one is in place, or
+        # concurrent writers would drop each other's changes.
+        with pincode_lock:
+            lock_fh = open(self.pincode_file + '.lock', 'a')
+            try:
+                lockf(lock_fh, LOCK_EX)
+                self._save_user_hashcode(user, hashcode, makedb)
+            finally:
+                lock_fh.close()
+
+    def _save_user_hashcode(self, user, hashcode, makedb):
         hashcodes = self._get_all_hashcodes()
 
         if hashcode is None:
@@ -129,61 +340,100 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
             logger.debug('Setting new hashcode: %s:%s' % (user, hashcode))
             hashcodes[user] = hashcode
 
+        # Readers don't take the .lock, so we write a new file and move it
+        # into place, and they see either all of the old one or the new one.
         # Bubble up any write errors up the chain
-        fh = open(self.pincode_file, 'w')
-        lockf(fh, LOCK_EX)
-
-        for user, hashcode in hashcodes.iteritems():
-            fh.write('%s:%s\n' % (user, hashcode))
-
-        lockf(fh, LOCK_UN)
-        fh.close()
+        (fd, tmp_file) = tempfile.mkstemp(prefix=os.path.basename(self.pincode_file) + '.',
+                                          dir=os.path.dirname(self.pincode_file) or '.')
+        try:
+            fh = os.fdopen(fd, 'w')
+            try:
+                for user, hashcode in hashcodes.iteritems():
+                    fh.write('%s:%s\n' % (user, hashcode))
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+
+            # keep whoever could read the old file able to read the new one
+            try:
+                st = os.stat(self.pincode_file)
+                (mode, owner) = (st.st_mode & 07777, (st.st_uid, st.st_gid))
+            except OSError:
+                # what open() would have created it with
+                umask = os.umask(0)
+                os.umask(umask)
+                (mode, owner) = (0666 & ~umask, None)
+
+            os.chmod(tmp_file, mode)
+            if owner is not None:
+                try:
+                    os.chown(tmp_file, *owner)
+                except OSError, ex:
+                    # only root may give files away
+                    if ex.errno != errno.EPERM:
+                        raise
+
+            os.rename(tmp_file, self.pincode_file)
+        except:
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            raise
 
         if makedb:
             # We always overwrite the db file to avoid any discrepancies with
-            # the text file.
+            # the text file. It, too, is built under the temporary name and
+            # then moved into place.
             pincode_db_file = self.pincode_file + '.db'
             logger.debug('Compiling the db in %s' % pincode_db_file)
 
-            db = anydbm.open(pincode_db_file, 'n')
+            db = anydbm.open(tmp_file + '.db', 'n')
             db.update(hashcodes)
             db.close()
 
+            # Some dbm modules make more than one file, e.g. .dir and .dat
+            (tmp_dir, tmp_name) = os.path.split(tmp_file + '.db')
+            for name in os.listdir(tmp_dir or '.'):
+                if name.startswith(tmp_name):
+                    os.rename(os.path.join(tmp_dir, name),
+                              pincode_db_file + name[len(tmp_name):])
+
     def delete_user_hashcode(self, user):
         self.save_user_hashcode(user, None)
 
 
 class GASecretBackend(totpcgi.backends.GASecretBackend):
-    def __init__(self, secrets_dir):
+    def __init__(self, secrets_dir, sharded=False):
         totpcgi.backends.GASecretBackend.__init__(self)
         logger.debug('Using FILE Secret backend')
 
         self.secrets_dir = secrets_dir
-
-    def get_user_secret(self, user, pincode=None):
-
-        totp_file = os.path.join(self.secrets_dir, user) + '.totp'
-        logger.debug('Examining user secret file: %s' % totp_file)
-
-        if not os.access(totp_file, os.R_OK):
-            raise totpcgi.UserNotFound('%s.totp does not exist or is not readable' % user)
-
-        fh = open(totp_file, 'r')
-        lockf(fh, LOCK_SH)
+        self.sharded = sharded
+        self.secret_cache = totpcgi.utils.TTLCache(SECRET_CACHE_TTL, SECRET_CACHE_SIZE)
+
+    def _get_totp_file(self, user):
+        return find_user_file(self.secrets_dir, user, '.totp', self.sharded)
+
+    def migrate_to_sharded(self):
+        return migrate_to_sharded(self.secrets_dir, '.totp')
+
+    def _parse_secret_file(self, fh):
+        record = {
+            'secret': None,
+            'rate_limit': None,
+            'window_size': None,
+            'counter': None,
+            'scratch_tokens': [],
+        }
 
         # secret is always the first entry
         secret = fh.readline()
         secret = secret.strip()
+        record['secret'] = secret
 
-        using_encrypted_secret = False
-        if secret.find('aes256+hmac256') == 0:
-            using_encrypted_secret = True
-            if pincode is not None:
-                secret = totpcgi.utils.decrypt_secret(secret, pincode)
-            else:
-                raise totpcgi.UserSecretError('Secret is encrypted, but no pincode provided')
-
-        gaus = totpcgi.GAUserSecret(secret)
+        using_encrypted_secret = secret.find('aes256+hmac256') == 0
 
         while True:
             line = fh.readline()
@@ -196,51 +446,114 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
             if len(line) and line[0] == '"':
                 if line[2:12] == 'RATE_LIMIT':
                     (tries, seconds) = line[13:].split(' ')
-                    gaus.rate_limit = (int(tries), int(seconds))
-                    logger.debug('rate_limit=%s' % str(gaus.rate_limit))
+                    record['rate_limit'] = (int(tries), int(seconds))
+                    logger.debug('rate_limit=%s' % str(record['rate_limit']))
 
                 elif line[2:13] == 'WINDOW_SIZE':
                     window_size = int(line[14:])
                     if 0 < window_size < 3:
                         window_size = 3
-                    gaus.window_size = window_size
+                    record['window_size'] = window_size
                     logger.debug('window_size=%s' % window_size)
 
                 elif line[2:14] == 'HOTP_COUNTER':
                     # This will most likely be overriden by user state, but load it up anyway,
                     # as this will trigger HOTP mode.
                     try:
-                        gaus.set_hotp(int(line[15:]))
+                        record['counter'] = int(line[15:])
                     except ValueError:
-                        gaus.set_hotp(0)
+                        record['counter'] = 0
 
-                    logger.debug('hotp_counter=%s' % gaus.counter)
+                    logger.debug('hotp_counter=%s' % record['counter'])
 
             # Scratch code tokens are 8-digit
             # We ignore scratch tokens if we're using encrypted secret
             elif len(line) == 8 and not using_encrypted_secret:
                 try:
-                    gaus.scratch_tokens.append(int(line))
+                    record['scratch_tokens'].append(int(line))
                     logger.debug('Found a scratch-code token, adding it')
                 except ValueError:
                     logger.debug('Non-numeric scratch token found')
                     # don't fail, just pretend we didn't see it
                     continue
 
-        lockf(fh, LOCK_UN)
-        fh.close()
+        return record
+
+    def _get_secret_record(self, user):
+        totp_file = self._get_totp_file(user)
+        logger.debug('Examining user secret file: %s' % totp_file)
+
+        # If the file hasn't changed since we last parsed it, we don't need
+        # to do it again. Note, that for encrypted secrets the record only
+        # ever holds the ciphertext, never the decrypted secret.
+        try:
+            st = os.stat(totp_file)
+        except OSError:
+            raise totpcgi.UserNotFound('%s.totp does not exist or is not readable' % user)
+
+        cached = self.secret_cache.get(user)
+        if cached is not None:
+            (cache_key, record) = cached
+            if cache_key == (st.st_ino, st.st_mtime, st.st_size):
+                logger.debug('Using cached record for %s' % totp_file)
+                return record
+
+        if not os.access(totp_file, os.R_OK):
+            raise totpcgi.UserNotFound('%s.totp does not exist or is not readable' % user)
+
+        fh = open(totp_file, 'r')
+        lockf(fh, LOCK_SH)
+
+        try:
+            st = os.fstat(fh.fileno())
+            record = self._parse_secret_file(fh)
+        finally:
+            lockf(fh, LOCK_UN)
+            fh.close()
+
+        self.secret_cache.set(user, ((st.st_ino, st.st_mtime, st.st_size), record))
+
+        return record
+
+    def get_user_secret(self, user, pincode=None):
+        record = self._get_secret_record(user)
+
+        secret = record['secret']
+
+        if secret.find('aes256+hmac256') == 0:
+            if pincode is not None:
+                secret = totpcgi.utils.decrypt_secret(secret, pincode, user)
+            else:
+                raise totpcgi.UserSecretError('Secret is encrypted, but no pincode provided')
+
+        gaus = totpcgi.GAUserSecret(secret)
+
+        if record['rate_limit'] is not None:
+            gaus.rate_limit = record['rate_limit']
 
         # Make sure that we have a window_size defined
         # The topt configuration many not have had one, if not we need
-        # to make sure we set it to the default of 3
-        if not hasattr(gaus, 'window_size'):
-                gaus.window_size = 3
+        # to make sure we stick with the default of 3
+        if record['window_size'] is not None:
+            gaus.window_size = record['window_size']
+
+        if record['counter'] is not None:
+            gaus.set_hotp(record['counter'])
+
+        gaus.scratch_tokens = list(record['scratch_tokens'])
 
         return gaus
 
     def save_user_secret(self, user, gaus, pincode=None):
         totp_file = os.path.join(self.secrets_dir, user) + '.totp'
 
+        if self.sharded:
+            flat_file = totp_file
+            totp_file = get_sharded_path(self.secrets_dir, user, '.totp')
+            make_shard_dirs(self.secrets_dir, totp_file)
+
+        self.secret_cache.delete(user)
+
         try:
             fh = open(totp_file, 'w')
         except IOError as e:
@@ -270,8 +583,15 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
 
         logger.debug('Wrote %s' % totp_file)
 
+        # Don't leave a stale copy in the flat layout
+        if self.sharded and os.path.exists(flat_file):
+            os.unlink(flat_file)
+            logger.debug('Removed %s' % flat_file)
+
     def delete_user_secret(self, user):
-        totp_file = os.path.join(self.secrets_dir, user) + '.totp'
+        self.secret_cache.delete(user)
+
+        totp_file = self._get_totp_file(user)
 
         try:
             os.unlink(totp_file)
@@ -279,22 +599,140 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
             raise totpcgi.DeleteFailed('%s could not be deleted: %s' %
                                        (totp_file, e))
 
+        # Make sure there isn't a flat copy left behind, either
+        if self.sharded:
+            flat_file = get_flat_path(self.secrets_dir, user, '.totp')
+            if os.path.exists(flat_file):
+                os.unlink(flat_file)
+
 
 class GAStateBackend(totpcgi.backends.GAStateBackend):
-    def __init__(self, state_dir):
+    def __init__(self, state_dir, sharded=False, durability='none', group_commit_ms=2):
         totpcgi.backends.GAStateBackend.__init__(self)
         logger.debug('Using FILE State backend')
 
+        if durability not in ('none', 'fsync', 'group'):
+            raise ValueError('Unsupported durability: %s' % durability)
+
         self.state_dir = state_dir
+        self.sharded = sharded
         self.fhs = {}
 
+        # none:  leave it to the OS to write things out eventually
+        # fsync: fsync every state file before returning
+        # group: same as fsync, but fsyncs of concurrent writers are batched
+        self.durability = durability
+        self.created = set()
+        if durability == 'group':
+            self.group_commit = GroupCommit(group_commit_ms/1000.0)
+
+        self.replication_log = None
+        self.peer_logs = []
+
+    def enable_replication(self, log_file, peer_logs=(), interval=5):
+        """ Appends every state change to log_file, and every interval
+            seconds merges in whatever changes were appended to peer_logs
+            since we last looked. Getting the peers' logs over here (and
+            ours over there) is up to rsync, a shared filesystem or the
+            like."""
+        logger.debug('Logging state changes to %s, merging from %s'
+                     % (log_file, ', '.join(peer_logs)))
+        self.replication_log = log_file
+        self.peer_logs = list(peer_logs)
+        self.replication_interval = interval
+        # how far we've read each of the peer logs
+        self.offsets_file = log_file + '.offsets'
+        self.merged_at = 0
+
+    def _get_state_file(self, user):
+        return find_user_file(self.state_dir, user, '.json', self.sharded)
+
+    def migrate_to_sharded(self):
+        return migrate_to_sharded(self.state_dir, '.json')
+
+    def _lock_state_file(self, user, fh):
+        started = time.time()
+
+        if self.lock_timeout is None:
+            lockf(fh, LOCK_EX)
+        else:
+            def try_lock():
+                try:
+                    lockf(fh, LOCK_EX | LOCK_NB)
+                    return True
+                except IOError, ex:
+                    if ex.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    return False
+
+            if not totpcgi.backends.poll_lock(try_lock, self.lock_timeout):
+                fh.close()
+                raise self._lock_timed_out(user, started)
+
+        self._lock_acquired(user, started)
+
+    def _lock_user(self, user):
+        key = (self.state_dir, user)
+        with user_locks_lock:
+            if key not in user_locks:
+                user_locks[key] = [threading.Lock(), 0]
+            user_locks[key][1] += 1
+            lock = user_locks[key][0]
+
+        if self.lock_timeout is None:
+            lock.acquire()
+        elif not totpcgi.backends.poll_lock(lambda: lock.acquire(False),
+                                            self.lock_timeout):
+            self._drop_user_lock(key)
+            raise self._lock_timed_out(user, time.time()-self.lock_timeout)
+
+        user_owners[key] = threading.current_thread().ident
+
+    def _drop_user_lock(self, key):
+        with user_locks_lock:
+            user_locks[key][1] -= 1
+            if not user_locks[key][1]:
+                del user_locks[key]
+
+    def _unlock_user(self, user):
+        # does nothing unless this thread holds the user
+        key = (self.state_dir, user)
+        if user_owners.get(key) != threading.current_thread().ident:
+            return
+        del user_owners[key]
+        user_locks[key][0].release()
+        self._drop_user_lock(key)
+
     def get_user_state(self, user):
+        # A thread that already holds a user would wait for itself if the
+        # merge got to that user, so it leaves merging to the next call.
+        me = threading.current_thread().ident
+        if (self.peer_logs and me not in user_owners.values()
+                and time.time()-self.merged_at >= self.replication_interval):
+            self.merged_at = time.time()
+            # better to go on with what we have than to fail the login
+            try:
+                self.merge_peers()
+            except Exception, ex:
+                logger.info('Merging peer state changes failed: %s' % ex)
+
+        return self._load_user_state(user)
+
+    def _load_user_state(self, user):
+        self._lock_user(user)
+        try:
+            return self._open_user_state(user)
+        except:
+            self._unlock_user(user)
+            raise
+
+    def _open_user_state(self, user):
         state = totpcgi.GAUserState()
 
         import json
 
         # load the state file and keep it locked while we do verification
-        state_file = os.path.join(self.state_dir, user) + '.json'
+        state_file = self._get_state_file(user)
         logger.debug('Loading user state from: %s' % state_file)
         
         # For totpcgiprov and totpcgi to be able to write to the same state
@@ -303,13 +741,26 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
         # selinux labels in place, this should keep this safe from tampering.
         os.umask(0000)
 
+        if not os.access(state_file, os.W_OK):
+            # The sharding migration may have moved it since we looked. It
+            # links the shard before unlinking the flat name, and the shard
+            # is looked at first, so looking again is bound to find it.
+            state_file = self._get_state_file(user)
+
         # we exclusive-lock the file to prevent race conditions resulting
         # in potential token reuse.
         if os.access(state_file, os.W_OK):
             logger.debug('%s exists, opening r+' % state_file)
-            fh = open(state_file, 'r+')
+            try:
+                fh = open(state_file, 'r+')
+            except IOError:
+                # The sharding migration may have just moved it
+                state_file = self._get_state_file(user)
+                logger.debug('Retrying with %s' % state_file)
+                fh = open(state_file, 'r+')
+
             logger.debug('Locking state file for user %s' % user)
-            lockf(fh, LOCK_EX)
+            self._lock_state_file(user, fh)
             try:
                 js = json.load(fh)
 
@@ -321,6 +772,8 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
 
                 if 'counter' in js:
                     state.counter = js['counter']
+                if 'last_step' in js:
+                    state.last_step = js['last_step']
 
             except Exception, ex:
                 # We fail out of caution, though if someone wanted to 
@@ -330,35 +783,180 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
                 logger.debug('Parsing json failed with: %s' % ex)
                 logger.debug('Unlocking state file for user %s' % user)
                 lockf(fh, LOCK_UN)
+                fh.close()
+                self._lock_released(user)
                 raise totpcgi.UserStateError(
                     'Error parsing the state file for: %s' % user)
 
             fh.seek(0)
         else:
             logger.debug('%s does not exist, opening w' % state_file)
+            if self.sharded:
+                # never create a flat file, the migration would drop it
+                state_file = get_sharded_path(self.state_dir, user, '.json')
             try:
+                if self.sharded:
+                    make_shard_dirs(self.state_dir, state_file)
                 fh = open(state_file, 'w')
-            except IOError:
+            except (OSError, IOError):
                 raise totpcgi.UserStateError(
                     'Cannot write user state for %s, exiting.' % user)
             logger.debug('Locking state file for user %s' % user)
-            lockf(fh, LOCK_EX)
+            self._lock_state_file(user, fh)
+            self.created.add(user)
 
-        # The following condition should never happen, in theory,
-        # because we have an exclusive lock on that file. If it does, 
-        # things have broken somewhere (probably locking is broken).
-        if user not in self.fhs.keys():
-            self.fhs[user] = fh
+        # Whoever had the user before us has closed and dropped their fh
+        # before letting go of it
+        self.fhs[user] = fh
 
         return state
 
     def update_user_state(self, user, state):
+        self._save_user_state(user, state)
+
+        if self.replication_log is not None:
+            self._log_state_change(user, state)
+
+    def _log_state_change(self, user, state):
+        import json
+
+        entry = json.dumps({
+            'user': user,
+            'time': time.time(),
+            'state': {
+                'fail_timestamps': state.fail_timestamps,
+                'success_timestamps': state.success_timestamps,
+                'used_scratch_tokens': state.used_scratch_tokens,
+                'counter': state.counter,
+                'last_step': state.last_step
+            }
+        })
+
+        fd = os.open(self.replication_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            # keep concurrent writers from interleaving their lines
+            lockf(fd, LOCK_EX)
+            os.write(fd, entry + '\n')
+            if self.durability != 'none':
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def merge_peers(self):
+        """ Merges the state changes peers logged since we last looked.
+            Returns how many we merged."""
+        import json
+
+        offsets_fh = open(self.offsets_file, 'a+')
+        try:
+            try:
+                lockf(offsets_fh, LOCK_EX | LOCK_NB)
+            except IOError:
+                logger.debug('Someone else is merging peer state changes')
+                return 0
+
+            offsets_fh.seek(0)
+            try:
+                offsets = json.load(offsets_fh)
+            except ValueError:
+                offsets = {}
+
+            merged = 0
+            for peer_log in self.peer_logs:
+                (offsets[peer_log], count) = self._merge_peer_log(
+                    peer_log, offsets.get(peer_log, 0))
+                merged += count
+
+            offsets_fh.seek(0)
+            offsets_fh.truncate()
+            json.dump(offsets, offsets_fh)
+        finally:
+            offsets_fh.close()
+
+        if merged:
+            logger.debug('Merged %s state changes from peers' % merged)
+
+        return merged
+
+    def _merge_peer_log(self, peer_log, offset):
+        import json
+
+        try:
+            fh = open(peer_log, 'r')
+        except IOError:
+            logger.debug('No peer log in %s yet' % peer_log)
+            return (offset, 0)
+
+        merged = 0
+        try:
+            # Merging is idempotent, so if the log was rotated, we can
+            # safely go through it again from the start.
+            if os.fstat(fh.fileno()).st_size < offset:
+                offset = 0
+            fh.seek(offset)
+
+            while True:
+                line = fh.readline()
+                if not line.endswith('\n'):
+                    # the rest hasn't been written (or copied over) yet
+                    break
+                offset += len(line)
+
+                try:
+                    entry = json.loads(line)
+                    user = entry['user']
+                    js = entry['state']
+                    theirs = totpcgi.GAUserState()
+                    theirs.fail_timestamps = js['fail_timestamps']
+                    theirs.success_timestamps = js['success_timestamps']
+                    theirs.used_scratch_tokens = js['used_scratch_tokens']
+                    theirs.counter = js.get('counter', -1)
+                    theirs.last_step = js.get('last_step', -1)
+                except (ValueError, KeyError, TypeError), ex:
+                    logger.info('Skipping bad entry in %s: %s' % (peer_log, ex))
+                    continue
+
+                # the user ends up in a file name
+                mo = totpcgi.SANE_USERNAME_RE.match(user)
+                if not mo or mo.group(1) != user:
+                    logger.info('Skipping entry for bad username in %s' % peer_log)
+                    continue
+
+                self._merge_user_state(user, theirs)
+                merged += 1
+        finally:
+            fh.close()
+
+        return (offset, merged)
+
+    def _merge_user_state(self, user, theirs):
+        # not through get_user_state, or we'd start merging all over again
+        ours = self._load_user_state(user)
+        try:
+            # not logged again, or the peers would keep sending it back
+            self._save_user_state(user, merge_user_states(ours, theirs))
+        except:
+            self.abort_user_state(user)
+            raise
+
+    def _save_user_state(self, user, state):
         if user not in self.fhs.keys():
+            self._unlock_user(user)
             raise totpcgi.UserStateError("%s's state FH has gone away!" % user)
 
-        import json
+        fh = self.fhs.pop(user)
+        try:
+            self._write_state_file(user, fh, state)
+        finally:
+            # the next thread to get the user opens its own fh
+            fh.close()
+            self._lock_released(user)
+            self._unlock_user(user)
 
-        fh = self.fhs[user]
+        logger.debug('fhs=%s' % self.fhs)
+
+    def _write_state_file(self, user, fh, state):
+        import json
 
         logger.debug('fh.name=%s' % fh.name)
 
@@ -366,7 +964,8 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
             'fail_timestamps': state.fail_timestamps,
             'success_timestamps': state.success_timestamps,
             'used_scratch_tokens': state.used_scratch_tokens,
-            'counter': state.counter
+            'counter': state.counter,
+            'last_step': state.last_step
         }
 
         logger.debug('saving state=%s' % js)
@@ -375,17 +974,53 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
         json.dump(js, fh, indent=4)
         fh.truncate()
 
+        if self.durability == 'fsync':
+            fh.flush()
+            os.fsync(fh.fileno())
+
         logger.debug('Unlocking state file for user %s' % user)
         lockf(fh, LOCK_UN)
-        fh.close()
+        self._lock_released(user)
 
-        del self.fhs[user]
+        # With group commit we don't need to hold the file lock while
+        # waiting, as other processes see the new state right away anyway.
+        # We just can't return until it's on disk.
+        if self.durability == 'group':
+            fh.flush()
+            self.group_commit.sync(fh.fileno())
 
-        logger.debug('fhs=%s' % self.fhs)
+        if user in self.created:
+            if self.durability != 'none':
+                fsync_dir(fh.name)
+            self.created.discard(user)
+
+    def abort_user_state(self, user):
+        fh = self.fhs.pop(user, None)
+        if fh is None:
+            self._unlock_user(user)
+            return
+
+        logger.debug('Aborting state update for user %s' % user)
+
+        try:
+            # We haven't written anything, so a file we just created is
+            # still empty, and would fail to parse next time.
+            if user in self.created:
+                self.created.discard(user)
+                os.unlink(fh.name)
+        finally:
+            lockf(fh, LOCK_UN)
+            fh.close()
+            self._lock_released(user)
+            self._unlock_user(user)
 
     def delete_user_state(self, user):
         # this should ONLY be used by test.py
-        state_file = os.path.join(self.state_dir, '%s.json' % user)
-        if os.access(state_file, os.W_OK):
-            os.unlink(state_file)
-            logger.debug('Removed user state file: %s' % state_file)
+        state_files = [get_flat_path(self.state_dir, user, '.json')]
+        if self.sharded:
+            state_files.append(get_sharded_path(self.state_dir, user, '.json'))
+
+        for state_file in state_files:
+            if os.access(state_file, os.W_OK):
+                os.unlink(state_file)
+                logger.debug('Removed user state file: %s' % state_file)
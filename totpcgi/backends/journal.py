@@ -0,0 +1,252 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+from __future__ import absolute_import
+
+import logging
+import totpcgi
+import totpcgi.backends
+
+import os
+import json
+import time
+import threading
+
+from fcntl import lockf, LOCK_EX, LOCK_NB
+
+logger = logging.getLogger('totpcgi')
+
+# Globally track the journals, so all backend objects in the process
+# share the same in-memory state.
+journals = {}
+
+
+def get_journal(journal_dir, snapshot_every):
+    global journals
+
+    if journal_dir not in journals:
+        journals[journal_dir] = StateJournal(journal_dir, snapshot_every)
+
+    return journals[journal_dir]
+
+
+class StateJournal:
+    """ Keeps all user states in memory. Every change is appended to the
+        journal and fsync'd before we return, and every snapshot_every
+        changes we write out a full snapshot and truncate the journal.
+        Only one process may use a journal_dir at a time."""
+
+    def __init__(self, journal_dir, snapshot_every=1000):
+        self.journal_dir = journal_dir
+        self.snapshot_every = snapshot_every
+
+        self.snapshot_file = os.path.join(journal_dir, 'state.snapshot')
+        self.journal_file = os.path.join(journal_dir, 'state.journal')
+
+        self.states = {}
+        self.owners = {}
+        self.entries = 0
+        self.cond = threading.Condition()
+
+        self.journal = open(self.journal_file, 'a+')
+
+        try:
+            lockf(self.journal, LOCK_EX | LOCK_NB)
+        except IOError:
+            raise totpcgi.UserStateError(
+                '%s is in use by another process' % self.journal_file)
+
+        self._replay()
+
+    def _replay(self):
+        if os.access(self.snapshot_file, os.R_OK):
+            logger.debug('Loading snapshot from %s' % self.snapshot_file)
+            fh = open(self.snapshot_file, 'r')
+            try:
+                self.states = json.load(fh)
+            except ValueError, ex:
+                raise totpcgi.UserStateError(
+                    'Error parsing %s: %s' % (self.snapshot_file, ex))
+            fh.close()
+
+        logger.debug('Replaying journal from %s' % self.journal_file)
+        self.journal.seek(0)
+        lines = self.journal.readlines()
+
+        good = 0
+        for (lineno, line) in enumerate(lines):
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('No newline')
+                entry = json.loads(line)
+            except ValueError:
+                if lineno == len(lines)-1:
+                    # A torn write at the very end is from a change that was
+                    # never acknowledged, so it's safe to drop it. We have
+                    # to cut it off, too, or the next entry would be
+                    # appended to it and be lost on the next replay.
+                    logger.info('Dropping incomplete last entry in %s' %
+                                self.journal_file)
+                    self.journal.truncate(good)
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                    lines.pop()
+                    break
+                raise totpcgi.UserStateError(
+                    'Error parsing %s at line %s' % (self.journal_file, lineno+1))
+
+            self._apply(entry['user'], entry['state'])
+            good += len(line)
+
+        self.entries = len(lines)
+        logger.debug('Loaded state for %s users' % len(self.states))
+
+    def _apply(self, user, js):
+        if js is None:
+            self.states.pop(user, None)
+        else:
+            self.states[user] = js
+
+    def _snapshot(self):
+        logger.debug('Writing snapshot to %s' % self.snapshot_file)
+
+        tmp_file = self.snapshot_file + '.tmp'
+        fh = open(tmp_file, 'w')
+        json.dump(self.states, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+
+        os.rename(tmp_file, self.snapshot_file)
+
+        dirfd = os.open(self.journal_dir, os.O_RDONLY)
+        os.fsync(dirfd)
+        os.close(dirfd)
+
+        # If we crash before this point, we just replay the journal on top
+        # of the snapshot, which is harmless, as entries hold full states.
+        self.journal.truncate(0)
+        os.fsync(self.journal.fileno())
+        self.entries = 0
+
+    def acquire(self, user, timeout=None):
+        """ Returns (True, state) once we own the user, or (False, None)
+            if someone else still does after timeout seconds."""
+        me = threading.current_thread().ident
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.cond.acquire()
+        try:
+            while self.owners.get(user, me) != me:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return (False, None)
+                    self.cond.wait(remaining)
+
+            self.owners[user] = me
+
+            js = self.states.get(user)
+        finally:
+            self.cond.release()
+
+        return (True, js)
+
+    def release(self, user):
+        self.cond.acquire()
+        try:
+            self.owners.pop(user, None)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def is_held(self, user):
+        return self.owners.get(user) == threading.current_thread().ident
+
+    def write(self, user, js):
+        self.cond.acquire()
+        try:
+            self.journal.write(json.dumps({'user': user, 'state': js}) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+            self._apply(user, js)
+            self.entries += 1
+
+            if self.entries >= self.snapshot_every:
+                self._snapshot()
+        finally:
+            self.cond.release()
+
+
+class GAStateBackend(totpcgi.backends.GAStateBackend):
+    def __init__(self, journal_dir, snapshot_every=1000):
+        totpcgi.backends.GAStateBackend.__init__(self)
+        logger.debug('Using JOURNAL State backend')
+
+        self.journal = get_journal(journal_dir, snapshot_every)
+
+    def get_user_state(self, user):
+        state = totpcgi.GAUserState()
+
+        logger.debug('Locking state for user %s' % user)
+        started = time.time()
+        (acquired, js) = self.journal.acquire(user, self.lock_timeout)
+        if not acquired:
+            raise self._lock_timed_out(user, started)
+        self._lock_acquired(user, started)
+
+        if js is not None:
+            state.fail_timestamps = list(js['fail_timestamps'])
+            state.success_timestamps = list(js['success_timestamps'])
+            state.used_scratch_tokens = list(js['used_scratch_tokens'])
+            state.counter = js['counter']
+            state.last_step = js.get('last_step', -1)
+
+        return state
+
+    def update_user_state(self, user, state):
+        if not self.journal.is_held(user):
+            raise totpcgi.UserStateError("%s's state lock has gone away!" % user)
+
+        js = {
+            'fail_timestamps': list(state.fail_timestamps),
+            'success_timestamps': list(state.success_timestamps),
+            'used_scratch_tokens': list(state.used_scratch_tokens),
+            'counter': state.counter,
+            'last_step': state.last_step
+        }
+
+        logger.debug('Saving new state for user %s' % user)
+        self.journal.write(user, js)
+
+        logger.debug('Unlocking state for user %s' % user)
+        self.journal.release(user)
+        self._lock_released(user)
+
+    def abort_user_state(self, user):
+        if self.journal.is_held(user):
+            logger.debug('Aborting state update for user %s' % user)
+            self.journal.release(user)
+            self._lock_released(user)
+
+    def delete_user_state(self, user):
+        self.journal.acquire(user)
+        self.journal.write(user, None)
+        self.journal.release(user)
@@ -15,15 +15,31 @@
 #
 from __future__ import absolute_import
 
+import os
+import re
+import time
+import hmac
+import hashlib
 import logging
+import threading
 import totpcgi
 import totpcgi.backends
+import totpcgi.utils
 
 import ldap
+import exceptions
 from string import Template
 
 logger = logging.getLogger('totpcgi')
 
+
+class LDAPPoolExhausted(exceptions.Exception):
+    # All our connections to a server are busy, which says nothing about
+    # the server itself
+    def __init__(self, message):
+        exceptions.Exception.__init__(self, message)
+        logger.debug('!LDAPPoolExhausted: %s' % message)
+
 class GASecretBackend:
     def __init__(self):
         raise totpcgi.backends.BackendNotSupported(
@@ -33,11 +49,140 @@ class GASecretBackend:
         pass
 
 
+class LDAPConnectionPool:
+    """ Keeps up to size connections to the LDAP server open, so we only
+        pay for the TLS handshake once per connection instead of once per
+        login. Connections are re-used by binding as the next user."""
+
+    def __init__(self, ldap_url, ldap_cacert, size=4, timeout=5, max_idle=300):
+        self.ldap_url = ldap_url
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        # this is a global option, so we only need to set it once
+        if len(ldap_cacert):
+            ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, ldap_cacert)
+
+        self.idle = []
+        self.created = 0
+        self.cond = threading.Condition()
+
+        # circuit breaker state, see GAPincodeBackend._bind
+        self.failures = 0
+        self.down_until = 0
+
+    def _connect(self):
+        logger.debug('Opening new LDAP connection to %s' % self.ldap_url)
+        lconn = ldap.initialize(self.ldap_url)
+        lconn.protocol_version = 3
+        lconn.set_option(ldap.OPT_REFERRALS, 0)
+        lconn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        lconn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+
+        return lconn
+
+    def _close(self, lconn):
+        try:
+            lconn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+
+        with self.cond:
+            while True:
+                while self.idle:
+                    (lconn, last_used) = self.idle.pop()
+                    if time.time() - last_used < self.max_idle:
+                        return lconn
+
+                    # the server has probably dropped it already
+                    logger.debug('Dropping LDAP connection idle since %s' % last_used)
+                    self.created -= 1
+                    self._close(lconn)
+
+                if self.created < self.size:
+                    self.created += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LDAPPoolExhausted('No LDAP connection to %s available'
+                                            % self.ldap_url)
+                self.cond.wait(remaining)
+
+        try:
+            return self._connect()
+        except Exception:
+            # or the slot is gone for good
+            self.discard(None)
+            raise
+
+    def release(self, lconn):
+        with self.cond:
+            self.idle.append((lconn, time.time()))
+            self.cond.notify()
+
+    def discard(self, lconn):
+        if lconn is not None:
+            self._close(lconn)
+
+        with self.cond:
+            self.created -= 1
+            self.cond.notify()
+
+    def record_failure(self, breaker_failures, breaker_reset):
+        """ Returns True if this failure opened the breaker."""
+        with self.cond:
+            self.failures += 1
+            if self.failures < breaker_failures or self.down_until > time.time():
+                return False
+            self.down_until = time.time() + breaker_reset
+            return True
+
+    def record_success(self):
+        with self.cond:
+            self.failures = 0
+            self.down_until = 0
+
+    def bind(self, dn, password):
+        # A pooled connection may have gone stale without us noticing, in
+        # which case we get one more go on a fresh one.
+        for attempt in (1, 2):
+            lconn = self.acquire()
+
+            try:
+                lconn.simple_bind_s(dn, password)
+
+            except ldap.INVALID_CREDENTIALS:
+                # a perfectly healthy connection, just the wrong password
+                self.release(lconn)
+                raise
+
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT):
+                self.discard(lconn)
+                if attempt == 2:
+                    raise
+                logger.debug('LDAP connection went away, reconnecting')
+                continue
+
+            except Exception:
+                # we can't tell what state it's in, so don't hand it out again
+                self.discard(lconn)
+                raise
+
+            self.release(lconn)
+            return
+
+
 class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
     """ This verifies the pincode by trying to bind to ldap using the 
         username and pincode passed for verification"""
 
-    def __init__(self, ldap_url, ldap_dn, ldap_cacert):
+    def __init__(self, ldap_url, ldap_dn, ldap_cacert, pool_size=4,
+                 timeout=5, max_idle=300, breaker_failures=3, breaker_reset=30):
         totpcgi.backends.GAPincodeBackend.__init__(self)
 
         logger.debug('Using LDAP Pincode backend')
@@ -45,24 +190,103 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
         self.ldap_url = ldap_url
         self.ldap_dn = ldap_dn
         self.ldap_cacert = ldap_cacert
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.negative_cache = None
 
-    def verify_user_pincode(self, user, pincode):
-        if len(self.ldap_cacert):
-            ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, self.ldap_cacert)
+        # Several servers can be listed, which we try in order
+        self.pools = []
+        for url in re.split(r'[\s,]+', ldap_url.strip()):
+            self.pools.append(LDAPConnectionPool(url, ldap_cacert, pool_size,
+                                                 timeout, max_idle))
 
-        lconn = ldap.initialize(self.ldap_url)
-        lconn.protocol_version = 3
-        lconn.set_option(ldap.OPT_REFERRALS, 0)
+    def enable_negative_cache(self, ttl, maxsize=256):
+        # Remembers failed binds, so someone hammering away with the same
+        # wrong pincode doesn't get to hammer the directory as well.
+        logger.debug('Caching failed LDAP binds for %s seconds' % ttl)
+        self.negative_cache = totpcgi.utils.TTLCache(ttl, maxsize)
+        if self.verify_cache is None:
+            self.verify_cache_key = os.urandom(32)
+
+    def _get_servers(self):
+        # servers with a tripped breaker go to the back of the line, but
+        # if they are all down, we still give them a try
+        now = time.time()
+        servers = [(pool.down_until, pool) for pool in self.pools]
+        up = [pool for (down_until, pool) in servers if down_until <= now]
+        down = sorted((down_until, pool) for (down_until, pool) in servers
+                      if down_until > now)
+
+        return up + [pool for (down_until, pool) in down]
+
+    def _bind(self, dn, pincode):
+        last_ex = None
+
+        for pool in self._get_servers():
+            try:
+                pool.bind(dn, pincode)
+
+            except ldap.INVALID_CREDENTIALS:
+                # the server is fine, the pincode is not
+                pool.record_success()
+                raise
+
+            except LDAPPoolExhausted, ex:
+                # we're busy, not the server, so try the next one without
+                # holding it against this one
+                last_ex = ex
+                continue
+
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT), ex:
+                if pool.record_failure(self.breaker_failures, self.breaker_reset):
+                    logger.info('LDAP server %s failed %s times, skipping it for %s seconds'
+                                % (pool.ldap_url, self.breaker_failures, self.breaker_reset))
+
+                logger.debug('LDAP server %s failed: %s' % (pool.ldap_url, ex))
+                last_ex = ex
+                continue
+
+            pool.record_success()
+            return
+
+        raise last_ex
+
+    def verify_user_pincode(self, user, pincode):
+        # An empty password is an anonymous bind, which always succeeds
+        if not len(pincode):
+            raise totpcgi.UserPincodeError('LDAP bind failed: empty pincode')
 
         tpt = Template(self.ldap_dn)
         dn = tpt.safe_substitute(username=user)
+
+        cache_key = None
+        if self.verify_cache is not None or self.negative_cache is not None:
+            cache_key = hmac.new(self.verify_cache_key, '\0'.join((dn, pincode)),
+                                 hashlib.sha256).digest()
+
+            if self.verify_cache is not None and self.verify_cache.get(cache_key):
+                logger.debug('Found cached LDAP bind for %s' % dn)
+                return True
+
+            if self.negative_cache is not None and self.negative_cache.get(cache_key):
+                raise totpcgi.UserPincodeError('LDAP bind failed: recently failed')
         
         try:
-            lconn.simple_bind_s(dn, pincode)
+            self._bind(dn, pincode)
+
+        except ldap.INVALID_CREDENTIALS, ex:
+            if self.negative_cache is not None:
+                self.negative_cache.set(cache_key, True)
+            raise totpcgi.UserPincodeError('LDAP bind failed: %s' % ex)
 
         except Exception, ex:
             raise totpcgi.UserPincodeError('LDAP bind failed: %s' % ex)
 
+        if self.verify_cache is not None:
+            self.verify_cache.set(cache_key, True)
+
+        return True
+
     def save_user_hashcode(self, user, pincode, makedb=True):
         raise totpcgi.backends.BackendNotSupported(
             'LDAP backend does not support saving pincodes.')
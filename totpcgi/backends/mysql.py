@@ -15,7 +15,10 @@
 #
 from __future__ import absolute_import
 
+import copy
+import time
 import logging
+import threading
 import totpcgi
 import totpcgi.backends
 import totpcgi.utils
@@ -24,19 +27,23 @@ import MySQLdb
 
 logger = logging.getLogger('totpcgi')
 
-# Globally track the database connections
-dbconn = {}
+# Globally track the database connections. Transactions and named
+# locks belong to the connection, so every thread gets its own.
+dbconn = threading.local()
 userids = {}
 
 
 def db_connect(connect_host, connect_user, connect_password, connect_db):
     global dbconn
 
-    if connect_host not in dbconn or not dbconn[connect_host].open:
-        dbconn[connect_host] = MySQLdb.connect(host=connect_host, user=connect_user,
-                                               passwd=connect_password, db=connect_db)
+    if not hasattr(dbconn, 'conns'):
+        dbconn.conns = {}
 
-    return dbconn[connect_host]
+    if connect_host not in dbconn.conns or not dbconn.conns[connect_host].open:
+        dbconn.conns[connect_host] = MySQLdb.connect(host=connect_host, user=connect_user,
+                                                     passwd=connect_password, db=connect_db)
+
+    return dbconn.conns[connect_host]
 
 
 def get_user_id(conn, user):
@@ -62,33 +69,70 @@ def get_user_id(conn, user):
 
 
 class GAStateBackend(totpcgi.backends.GAStateBackend):
-    def __init__(self, connect_host, connect_user, connect_password, connect_db):
+    def __init__(self, connect_host, connect_user, connect_password, connect_db,
+                 optimistic=False):
         totpcgi.backends.GAStateBackend.__init__(self)
         logger.debug('Using MySQL State backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_host, connect_user, connect_password, connect_db)
+        self.connect_args = (connect_host, connect_user, connect_password, connect_db)
 
         logger.debug('Checking if we have the counters table')
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
         cur.execute("SELECT exists(SELECT * FROM information_schema.tables WHERE table_name=%s)", ('counters',))
         self.has_counters = cur.fetchone()[0]
 
         if not self.has_counters:
             logger.info('Counters table not found, assuming pre-0.6 database schema (no HOTP support)')
 
-        self.locks = {}
+        logger.debug('Checking if we have the last_steps table')
+        cur.execute("SELECT exists(SELECT * from information_schema.tables where table_name=%s)", ('last_steps',))
+        self.has_last_steps = cur.fetchone()[0]
+
+        # In optimistic mode nothing is locked while the token is checked;
+        # update_user_state only writes if nobody else has in the meantime.
+        self.optimistic = optimistic
+        self.versions = totpcgi.backends.PerThreadDict()
+
+        self.locks = totpcgi.backends.PerThreadDict()
+        # what get_user_state read, to tell what update_user_state changed
+        self.loaded = totpcgi.backends.PerThreadDict()
 
     def get_user_state(self, user):
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
         state = totpcgi.GAUserState()
 
-        logger.debug('Acquiring lock for userid=%s' % userid)
+        cur = db_connect(*self.connect_args).cursor()
+
+        if self.optimistic:
+            cur.execute('SELECT version FROM state_versions WHERE userid = %s',
+                        (userid,))
+            row = cur.fetchone()
+            if row:
+                self.versions[user] = row[0]
+            else:
+                self.versions[user] = 0
+        else:
+            logger.debug('Acquiring lock for userid=%s' % userid)
+            started = time.time()
+
+            lock_timeout = self.lock_timeout
+            if lock_timeout is None:
+                lock_timeout = 180
+
+            cur.execute('SELECT GET_LOCK(%s,%s)', (userid, lock_timeout))
+            (locked,) = cur.fetchone()
+
+            # 0 means we timed out, NULL that something else went wrong
+            if locked is None:
+                raise totpcgi.UserStateError('Could not lock the state of %s' % user)
+            if locked != 1:
+                raise self._lock_timed_out(user, started)
+
+            self._lock_acquired(user, started)
 
-        cur = self.conn.cursor()
-        cur.execute('SELECT GET_LOCK(%s,180)', (userid,))
         self.locks[user] = userid 
 
         cur.execute('''
@@ -121,8 +165,47 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
             if row and row[0] >= 0:
                 state.counter = row[0]
 
+        if self.has_last_steps:
+            cur.execute('''
+                SELECT step
+                  FROM last_steps
+                 WHERE userid = %s''', (userid,))
+
+            row = cur.fetchone()
+            if row:
+                state.last_step = row[0]
+
+        self.loaded[user] = copy.deepcopy(state)
+
+        if self.optimistic:
+            # don't hold a transaction open while the token is checked
+            db_connect(*self.connect_args).commit()
+
         return state
 
+    def _bump_version(self, cur, user, userid):
+        version = self.versions.pop(user)
+
+        cur.execute('''
+            UPDATE state_versions
+               SET version = version + 1
+             WHERE userid = %s AND version = %s''', (userid, version))
+
+        if cur.rowcount == 1:
+            return True
+
+        if version == 0:
+            # nobody has written a version for this user yet
+            try:
+                cur.execute('''
+                    INSERT INTO state_versions (userid, version)
+                         VALUES (%s, 1)''', (userid,))
+                return True
+            except MySQLdb.IntegrityError:
+                pass
+
+        return False
+
     def update_user_state(self, user, state):
         logger.debug('Writing new state for user %s' % user)
 
@@ -130,45 +213,86 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
             raise totpcgi.UserStateError("%s's MySQL lock has gone away!" % user)
 
         userid = self.locks[user]
+        loaded = self.loaded.pop(user, None)
 
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
 
-        cur.execute('DELETE FROM timestamps WHERE userid=%s', (userid,))
-        cur.execute('DELETE FROM used_scratch_tokens WHERE userid=%s', (userid,))
+        # The row lock this takes is only held until we commit below
+        if self.optimistic and not self._bump_version(cur, user, userid):
+            db_connect(*self.connect_args).rollback()
+            del self.locks[user]
+            raise totpcgi.UserStateConflict(
+                'State for %s changed since we read it' % user)
 
-        for timestamp in state.fail_timestamps:
-            cur.execute('''
-                INSERT INTO timestamps (userid, success, timestamp)
-                     VALUES (%s, %s, %s)''', (userid, False, timestamp))
+        # Most logins only change part of the state, so leave the rest be
+        changed = totpcgi.backends.changed_state(loaded, state)
 
-        for timestamp in state.success_timestamps:
-            cur.execute('''
-                INSERT INTO timestamps (userid, success, timestamp)
-                     VALUES (%s, %s, %s)''', (userid, True, timestamp))
+        if 'timestamps' in changed:
+            cur.execute('DELETE FROM timestamps WHERE userid=%s', (userid,))
 
-        for token in state.used_scratch_tokens:
-            cur.execute('''
-                INSERT INTO used_scratch_tokens (userid, token)
-                     VALUES (%s, %s)''', (userid, token))
+            for timestamp in state.fail_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (%s, %s, %s)''', (userid, False, timestamp))
+
+            for timestamp in state.success_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (%s, %s, %s)''', (userid, True, timestamp))
+
+        if 'used_scratch_tokens' in changed:
+            cur.execute('DELETE FROM used_scratch_tokens WHERE userid=%s', (userid,))
 
-        if state.counter >= 0 and self.has_counters:
+            for token in state.used_scratch_tokens:
+                cur.execute('''
+                    INSERT INTO used_scratch_tokens (userid, token)
+                         VALUES (%s, %s)''', (userid, token))
+
+        if state.counter >= 0 and self.has_counters and 'counter' in changed:
             cur.execute('DELETE FROM counters WHERE userid=%s', (userid,))
             cur.execute('''
                 INSERT INTO counters (userid, counter)
                      VALUES (%s, %s)''', (userid, state.counter))
 
-        logger.debug('Releasing lock for userid=%s' % userid)
-        cur.execute('SELECT RELEASE_LOCK(%s)', (userid,))
+        # The one write a login makes with replay_guard = last_step
+        if state.last_step >= 0 and self.has_last_steps and 'last_step' in changed:
+            cur.execute('''
+                INSERT INTO last_steps (userid, step)
+                     VALUES (%s, %s)
+                         ON DUPLICATE KEY UPDATE step = GREATEST(step, VALUES(step))''', (userid, state.last_step))
+
+        if not self.optimistic:
+            logger.debug('Releasing lock for userid=%s' % userid)
+            cur.execute('SELECT RELEASE_LOCK(%s)', (userid,))
 
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
         del self.locks[user]
+        self._lock_released(user)
+
+    def abort_user_state(self, user):
+        if user not in self.locks.keys():
+            return
+
+        logger.debug('Aborting state update for user %s' % user)
+        userid = self.locks.pop(user)
+        self.versions.pop(user, None)
+        self.loaded.pop(user, None)
+
+        db_connect(*self.connect_args).rollback()
+
+        if not self.optimistic:
+            # named locks outlive the transaction
+            cur = db_connect(*self.connect_args).cursor()
+            cur.execute('SELECT RELEASE_LOCK(%s)', (userid,))
+            db_connect(*self.connect_args).commit()
+            self._lock_released(user)
 
     def delete_user_state(self, user):
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
         logger.debug('Deleting state records for user=%s' % user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
         cur.execute('''
             DELETE FROM timestamps
@@ -182,6 +306,12 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
                 DELETE FROM counters
                       WHERE userid=%s''' % (userid,))
 
+        if self.has_last_steps:
+            cur.execute('DELETE FROM last_steps WHERE userid=%s', (userid,))
+
+        if self.optimistic:
+            cur.execute('DELETE FROM state_versions WHERE userid=%s', (userid,))
+
         # If there are no pincodes or secrets entries, then we may as well
         # delete the user record.
         cur.execute('SELECT True FROM pincodes WHERE userid=%s', (userid,))
@@ -191,7 +321,7 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
                 logger.debug('No entries left for user=%s, deleting' % user)
                 cur.execute('DELETE FROM users WHERE userid=%s', (userid,))
 
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
 
 class GASecretBackend(totpcgi.backends.GASecretBackend):
@@ -200,10 +330,10 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
         logger.debug('Using MySQL Secrets backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_host, connect_user, connect_password, connect_db)
+        self.connect_args = (connect_host, connect_user, connect_password, connect_db)
 
         logger.debug('Checking if we have the counters table')
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
         cur.execute("SELECT exists(SELECT * FROM information_schema.tables WHERE table_name=%s)", ('counters',))
         self.has_counters = cur.fetchone()[0]
 
@@ -211,7 +341,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
             logger.info('Counters table not found, assuming pre-0.6 database schema (no HOTP support)')
 
     def get_user_secret(self, user, pincode=None):
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
 
         logger.debug('Querying DB for user %s' % user)
 
@@ -232,7 +362,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
 
         using_encrypted_secret = False
         if secret.find('aes256+hmac256') == 0 and pincode is not None:
-            secret = totpcgi.utils.decrypt_secret(secret, pincode)
+            secret = totpcgi.utils.decrypt_secret(secret, pincode, user)
             using_encrypted_secret = True
         
         gaus = totpcgi.GAUserSecret(secret)
@@ -273,11 +403,11 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
         return gaus
 
     def save_user_secret(self, user, gaus, pincode=None):
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
 
         self._delete_user_secret(user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
         secret = gaus.otp.secret
 
@@ -297,12 +427,12 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
                                 (userid, token)
                          VALUES (%s, %s)''', (userid, token,))
 
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
     def _delete_user_secret(self, user):
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
         cur.execute('''
             DELETE FROM secrets
                   WHERE userid=%s''', (userid,))
@@ -312,7 +442,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
 
     def delete_user_secret(self, user):
         self._delete_user_secret(user)
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
 
 class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
@@ -321,10 +451,10 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
         logger.debug('Using MySQL Pincodes backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_host, connect_user, connect_password, connect_db)
+        self.connect_args = (connect_host, connect_user, connect_password, connect_db)
         
     def verify_user_pincode(self, user, pincode):
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
 
         logger.debug('Querying DB for user %s' % user)
 
@@ -341,12 +471,12 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
 
         (hashcode,) = row
 
-        return self._verify_by_hashcode(pincode, hashcode)
+        return self._verify_user_hashcode(user, pincode, hashcode)
 
     def _delete_user_hashcode(self, user):
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
         cur.execute('''
             DELETE FROM pincodes 
                   WHERE userid=%s''', (userid,))
@@ -354,18 +484,18 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
     def save_user_hashcode(self, user, hashcode, makedb=False):
         self._delete_user_hashcode(user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(*self.connect_args), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(*self.connect_args).cursor()
 
         cur.execute('''
             INSERT INTO pincodes
                         (userid, pincode)
                  VALUES (%s, %s)''', (userid, hashcode,))
 
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
     def delete_user_hashcode(self, user):
         self._delete_user_hashcode(user)
-        self.conn.commit()
+        db_connect(*self.connect_args).commit()
 
@@ -15,27 +15,35 @@
 #
 from __future__ import absolute_import
 
+import copy
+import time
 import logging
+import threading
 import totpcgi
 import totpcgi.backends
 import totpcgi.utils
 
 import psycopg2
+import psycopg2.errorcodes
 
 logger = logging.getLogger('totpcgi')
 
-# Globally track the database connections
-dbconn = {}
+# Globally track the database connections. Transactions and advisory
+# locks belong to the connection, so every thread gets its own.
+dbconn = threading.local()
 userids = {}
 
 
 def db_connect(connect_string):
     global dbconn
 
-    if connect_string not in dbconn or dbconn[connect_string].closed:
-        dbconn[connect_string] = psycopg2.connect(connect_string)
+    if not hasattr(dbconn, 'conns'):
+        dbconn.conns = {}
 
-    return dbconn[connect_string]
+    if connect_string not in dbconn.conns or dbconn.conns[connect_string].closed:
+        dbconn.conns[connect_string] = psycopg2.connect(connect_string)
+
+    return dbconn.conns[connect_string]
 
 
 def get_user_id(conn, user):
@@ -61,33 +69,68 @@ def get_user_id(conn, user):
 
 
 class GAStateBackend(totpcgi.backends.GAStateBackend):
-    def __init__(self, connect_string):
+    def __init__(self, connect_string, optimistic=False):
         totpcgi.backends.GAStateBackend.__init__(self)
         logger.debug('Using PGSQL State backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_string)
+        self.connect_string = connect_string
 
         logger.debug('Checking if we have the counters table')
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
         cur.execute("select exists(select * from information_schema.tables where table_name=%s)", ('counters',))
         self.has_counters = cur.fetchone()[0]
 
         if not self.has_counters:
             logger.info('Counters table not found, assuming pre-0.6 database schema (no HOTP support)')
 
-        self.locks = {}
+        logger.debug('Checking if we have the last_steps table')
+        cur.execute("select exists(select * from information_schema.tables where table_name=%s)", ('last_steps',))
+        self.has_last_steps = cur.fetchone()[0]
+
+        # In optimistic mode nothing is locked while the token is checked;
+        # update_user_state only writes if nobody else has in the meantime.
+        self.optimistic = optimistic
+        self.versions = totpcgi.backends.PerThreadDict()
+
+        self.locks = totpcgi.backends.PerThreadDict()
+        # what get_user_state read, to tell what update_user_state changed
+        self.loaded = totpcgi.backends.PerThreadDict()
 
     def get_user_state(self, user):
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
         state = totpcgi.GAUserState()
 
-        logger.debug('Creating advisory lock for userid=%s' % userid)
-        
-        cur = self.conn.cursor()
-        cur.execute('SELECT pg_advisory_lock(%s)', (userid,))
+        cur = db_connect(self.connect_string).cursor()
+
+        if self.optimistic:
+            cur.execute('SELECT version FROM state_versions WHERE userid = %s',
+                        (userid,))
+            row = cur.fetchone()
+            if row:
+                self.versions[user] = row[0]
+            else:
+                self.versions[user] = 0
+        else:
+            logger.debug('Creating advisory lock for userid=%s' % userid)
+            started = time.time()
+
+            if self.lock_timeout is not None:
+                # Like SET LOCAL, this covers advisory lock waits, too
+                cur.execute("SELECT set_config('lock_timeout', %s, true)",
+                            ('%dms' % (self.lock_timeout*1000),))
+            try:
+                cur.execute('SELECT pg_advisory_lock(%s)', (userid,))
+            except psycopg2.OperationalError, ex:
+                if ex.pgcode != psycopg2.errorcodes.LOCK_NOT_AVAILABLE:
+                    raise
+                db_connect(self.connect_string).rollback()
+                raise self._lock_timed_out(user, started)
+
+            self._lock_acquired(user, started)
+
         self.locks[user] = userid 
 
         cur.execute('''
@@ -120,8 +163,47 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
             if row and row[0] >= 0:
                 state.counter = row[0]
 
+        if self.has_last_steps:
+            cur.execute('''
+                SELECT step
+                  FROM last_steps
+                 WHERE userid = %s''', (userid,))
+
+            row = cur.fetchone()
+            if row:
+                state.last_step = row[0]
+
+        self.loaded[user] = copy.deepcopy(state)
+
+        if self.optimistic:
+            # don't sit idle in a transaction while the token is checked
+            db_connect(self.connect_string).commit()
+
         return state
 
+    def _bump_version(self, cur, user, userid):
+        version = self.versions.pop(user)
+
+        cur.execute('''
+            UPDATE state_versions
+               SET version = version + 1
+             WHERE userid = %s AND version = %s''', (userid, version))
+
+        if cur.rowcount == 1:
+            return True
+
+        if version == 0:
+            # nobody has written a version for this user yet
+            try:
+                cur.execute('''
+                    INSERT INTO state_versions (userid, version)
+                         VALUES (%s, 1)''', (userid,))
+                return True
+            except psycopg2.IntegrityError:
+                pass
+
+        return False
+
     def update_user_state(self, user, state):
         logger.debug('Writing new state for user %s' % user)
 
@@ -129,45 +211,102 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
             raise totpcgi.UserStateError("%s's pg lock has gone away!" % user)
 
         userid = self.locks[user]
+        loaded = self.loaded.pop(user, None)
 
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
 
-        cur.execute('DELETE FROM timestamps WHERE userid=%s', (userid,))
-        cur.execute('DELETE FROM used_scratch_tokens WHERE userid=%s', (userid,))
+        # The row lock this takes is only held until we commit below
+        if self.optimistic and not self._bump_version(cur, user, userid):
+            db_connect(self.connect_string).rollback()
+            del self.locks[user]
+            raise totpcgi.UserStateConflict(
+                'State for %s changed since we read it' % user)
 
-        for timestamp in state.fail_timestamps:
-            cur.execute('''
-                INSERT INTO timestamps (userid, success, timestamp)
-                     VALUES (%s, %s, %s)''', (userid, False, timestamp))
+        # Most logins only change part of the state, so leave the rest be
+        changed = totpcgi.backends.changed_state(loaded, state)
 
-        for timestamp in state.success_timestamps:
-            cur.execute('''
-                INSERT INTO timestamps (userid, success, timestamp)
-                     VALUES (%s, %s, %s)''', (userid, True, timestamp))
+        if 'timestamps' in changed:
+            cur.execute('DELETE FROM timestamps WHERE userid=%s', (userid,))
 
-        for token in state.used_scratch_tokens:
-            cur.execute('''
-                INSERT INTO used_scratch_tokens (userid, token)
-                     VALUES (%s, %s)''', (userid, token))
+            for timestamp in state.fail_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (%s, %s, %s)''', (userid, False, timestamp))
+
+            for timestamp in state.success_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (%s, %s, %s)''', (userid, True, timestamp))
+
+        if 'used_scratch_tokens' in changed:
+            cur.execute('DELETE FROM used_scratch_tokens WHERE userid=%s', (userid,))
+
+            for token in state.used_scratch_tokens:
+                cur.execute('''
+                    INSERT INTO used_scratch_tokens (userid, token)
+                         VALUES (%s, %s)''', (userid, token))
 
-        if state.counter >= 0 and self.has_counters:
+        if state.counter >= 0 and self.has_counters and 'counter' in changed:
             cur.execute('DELETE FROM counters WHERE userid=%s', (userid,))
             cur.execute('''
                 INSERT INTO counters (userid, counter)
                      VALUES (%s, %s)''', (userid, state.counter))
 
-        logger.debug('Unlocking advisory lock for userid=%s' % userid)
-        cur.execute('SELECT pg_advisory_unlock(%s)', (userid,))
-
-        self.conn.commit()
+        # The one write a login makes with replay_guard = last_step
+        if state.last_step >= 0 and self.has_last_steps and 'last_step' in changed:
+            if db_connect(self.connect_string).server_version >= 90500:
+                cur.execute('''
+                    INSERT INTO last_steps (userid, step)
+                         VALUES (%s, %s)
+                    ON CONFLICT (userid)
+                  DO UPDATE SET step = GREATEST(last_steps.step, EXCLUDED.step)''', (userid, state.last_step))
+            else:
+                # Older PostgreSQL has no upsert. Nobody else can write the
+                # user's state until we commit, so there's no race here.
+                cur.execute('SELECT step FROM last_steps WHERE userid = %s', (userid,))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute('''
+                        INSERT INTO last_steps (userid, step)
+                             VALUES (%s, %s)''', (userid, state.last_step))
+                elif row[0] < state.last_step:
+                    cur.execute('''
+                        UPDATE last_steps
+                           SET step = %s
+                         WHERE userid = %s''', (state.last_step, userid))
+
+        if not self.optimistic:
+            logger.debug('Unlocking advisory lock for userid=%s' % userid)
+            cur.execute('SELECT pg_advisory_unlock(%s)', (userid,))
+
+        db_connect(self.connect_string).commit()
 
         del self.locks[user]
+        self._lock_released(user)
+
+    def abort_user_state(self, user):
+        if user not in self.locks.keys():
+            return
+
+        logger.debug('Aborting state update for user %s' % user)
+        userid = self.locks.pop(user)
+        self.versions.pop(user, None)
+        self.loaded.pop(user, None)
+
+        db_connect(self.connect_string).rollback()
+
+        if not self.optimistic:
+            # advisory locks outlive the transaction
+            cur = db_connect(self.connect_string).cursor()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (userid,))
+            db_connect(self.connect_string).commit()
+            self._lock_released(user)
 
     def delete_user_state(self, user):
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
         logger.debug('Deleting state records for user=%s' % user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
         cur.execute('''
             DELETE FROM timestamps
@@ -181,6 +320,12 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
                 DELETE FROM counters
                       WHERE userid=%s''' % (userid,))
 
+        if self.has_last_steps:
+            cur.execute('DELETE FROM last_steps WHERE userid=%s', (userid,))
+
+        if self.optimistic:
+            cur.execute('DELETE FROM state_versions WHERE userid=%s', (userid,))
+
         # If there are no pincodes or secrets entries, then we may as well
         # delete the user record.
         cur.execute('SELECT True FROM pincodes WHERE userid=%s', (userid,))
@@ -194,7 +339,7 @@ class GAStateBackend(totpcgi.backends.GAStateBackend):
                     # we may not have permissions, so ignore this failure.
                     pass
 
-        self.conn.commit()
+        db_connect(self.connect_string).commit()
 
 
 class GASecretBackend(totpcgi.backends.GASecretBackend):
@@ -203,10 +348,10 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
         logger.debug('Using PGSQL Secrets backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_string)
+        self.connect_string = connect_string
 
         logger.debug('Checking if we have the counters table')
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
         cur.execute("select exists(select * from information_schema.tables where table_name=%s)", ('counters',))
         self.has_counters = cur.fetchone()[0]
 
@@ -214,7 +359,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
             logger.info('Counters table not found, assuming pre-0.6 database schema (no HOTP support)')
 
     def get_user_secret(self, user, pincode=None):
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
 
         logger.debug('Querying DB for user %s' % user)
 
@@ -235,7 +380,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
 
         using_encrypted_secret = False
         if secret.find('aes256+hmac256') == 0 and pincode is not None:
-            secret = totpcgi.utils.decrypt_secret(secret, pincode)
+            secret = totpcgi.utils.decrypt_secret(secret, pincode, user)
             using_encrypted_secret = True
         
         gaus = totpcgi.GAUserSecret(secret)
@@ -276,11 +421,11 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
         return gaus
 
     def save_user_secret(self, user, gaus, pincode=None):
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
 
         self._delete_user_secret(user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
         secret = gaus.otp.secret
 
@@ -300,12 +445,12 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
                                 (userid, token)
                          VALUES (%s, %s)''', (userid, token,))
 
-        self.conn.commit()
+        db_connect(self.connect_string).commit()
 
     def _delete_user_secret(self, user):
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
         cur.execute('''
             DELETE FROM secrets
                   WHERE userid=%s''', (userid,))
@@ -315,7 +460,7 @@ class GASecretBackend(totpcgi.backends.GASecretBackend):
 
     def delete_user_secret(self, user):
         self._delete_user_secret(user)
-        self.conn.commit()
+        db_connect(self.connect_string).commit()
 
 
 class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
@@ -324,10 +469,10 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
         logger.debug('Using PGSQL Pincodes backend')
 
         logger.debug('Establishing connection to the database')
-        self.conn = db_connect(connect_string)
+        self.connect_string = connect_string
         
     def verify_user_pincode(self, user, pincode):
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
 
         logger.debug('Querying DB for user %s' % user)
 
@@ -344,12 +489,12 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
 
         (hashcode,) = row
 
-        return self._verify_by_hashcode(pincode, hashcode)
+        return self._verify_user_hashcode(user, pincode, hashcode)
 
     def _delete_user_hashcode(self, user):
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
         cur.execute('''
             DELETE FROM pincodes 
                   WHERE userid=%s''', (userid,))
@@ -357,17 +502,17 @@ class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
     def save_user_hashcode(self, user, hashcode, makedb=False):
         self._delete_user_hashcode(user)
 
-        userid = get_user_id(self.conn, user)
+        userid = get_user_id(db_connect(self.connect_string), user)
 
-        cur = self.conn.cursor()
+        cur = db_connect(self.connect_string).cursor()
 
         cur.execute('''
             INSERT INTO pincodes
                         (userid, pincode)
                  VALUES (%s, %s)''', (userid, hashcode,))
 
-        self.conn.commit()
+        db_connect(self.connect_string).commit()
 
     def delete_user_hashcode(self, user):
         self._delete_user_hashcode(user)
-        self.conn.commit()
\ No newline at end of file
+        db_connect(self.connect_string).commit()
\ No newline at end of file
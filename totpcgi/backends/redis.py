@@ -0,0 +1,289 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+from __future__ import absolute_import
+
+import logging
+import totpcgi
+import totpcgi.backends
+
+import json
+import time
+
+import redis
+
+logger = logging.getLogger('totpcgi')
+
+# Runs server-side, so checking for replays, recording failures and
+# writing the new state all happen atomically in a single round trip,
+# without holding any locks between reading and writing the state.
+#
+# KEYS: steps, used scratch tokens, counter, last step
+# ARGV: cutoff, ttl, loaded counter, new counter, loaded last step,
+#       new last step,
+#       added fail timestamps, removed fail timestamps,
+#       added success timestamps, removed success timestamps,
+#       added scratch tokens, removed scratch tokens,
+#       rate limit count (0 if unknown), rate limit seconds
+UPDATE_SCRIPT = '''
+local cutoff = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local loaded_counter = tonumber(ARGV[3])
+local counter = tonumber(ARGV[4])
+local loaded_last_step = tonumber(ARGV[5])
+local last_step = tonumber(ARGV[6])
+local new_fails = cjson.decode(ARGV[7])
+local old_fails = cjson.decode(ARGV[8])
+local new_successes = cjson.decode(ARGV[9])
+local old_successes = cjson.decode(ARGV[10])
+local new_scratch = cjson.decode(ARGV[11])
+local old_scratch = cjson.decode(ARGV[12])
+local limit_count = tonumber(ARGV[13])
+local limit_seconds = tonumber(ARGV[14])
+
+local result = 'OK'
+
+local steps = {fail = {}, success = {}}
+local raw = redis.call('GET', KEYS[1])
+if raw then
+    steps = cjson.decode(raw)
+end
+
+-- drop anything that is too old to matter or that the caller removed,
+-- and remember which 30-second steps have already been used
+local function keep(current, removed)
+    local counts = {}
+    for _, ts in ipairs(removed) do
+        counts[ts] = (counts[ts] or 0) + 1
+    end
+
+    local kept = {}
+    for _, ts in ipairs(current) do
+        if (counts[ts] or 0) > 0 then
+            counts[ts] = counts[ts] - 1
+        elseif ts >= cutoff then
+            table.insert(kept, ts)
+        end
+    end
+    return kept
+end
+
+local used = {}
+local fail = keep(steps.fail, old_fails)
+local success = keep(steps.success, old_successes)
+
+for _, ts in ipairs(fail) do
+    used[math.floor(ts/30)] = true
+end
+for _, ts in ipairs(success) do
+    used[math.floor(ts/30)] = true
+end
+
+-- if others have failed often enough since we read the state, the user
+-- is rate-limited now, so we mustn't accept anything
+local limited = false
+if limit_count > 0 and (#new_successes > 0 or #new_scratch > 0
+        or last_step > loaded_last_step or counter > loaded_counter) then
+    local recent = 0
+    local since = cutoff + ttl - (30 + limit_seconds)
+    for _, ts in ipairs(fail) do
+        if ts >= since then
+            recent = recent + 1
+        end
+    end
+    if recent >= limit_count then
+        result = 'RATE_LIMIT'
+        limited = true
+    end
+end
+
+-- if the step was used by someone else since we read the state, this
+-- is a replay, so we record it as a failure instead
+for _, ts in ipairs(new_successes) do
+    if limited then
+        table.insert(fail, ts)
+    elseif used[math.floor(ts/30)] then
+        result = 'REPLAY'
+        table.insert(fail, ts)
+    else
+        table.insert(success, ts)
+        used[math.floor(ts/30)] = true
+    end
+end
+
+for _, ts in ipairs(new_fails) do
+    table.insert(fail, ts)
+end
+
+if #fail == 0 and #success == 0 then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], cjson.encode({fail = fail, success = success}),
+               'EX', ttl)
+end
+
+for _, token in ipairs(old_scratch) do
+    redis.call('SREM', KEYS[2], token)
+end
+
+if not limited then
+    for _, token in ipairs(new_scratch) do
+        if redis.call('SADD', KEYS[2], token) == 0 then
+            result = 'REPLAY'
+        end
+    end
+end
+
+-- HOTP counters only ever move forward
+if counter >= 0 and not limited then
+    local current = tonumber(redis.call('GET', KEYS[3]) or '-1')
+    if counter > current then
+        redis.call('SET', KEYS[3], counter)
+    elseif counter > loaded_counter then
+        result = 'REPLAY'
+    end
+end
+
+-- and so do last steps, which are no use once older than the window
+if last_step > loaded_last_step and not limited then
+    local current = tonumber(redis.call('GET', KEYS[4]) or '-1')
+    if last_step > current then
+        redis.call('SET', KEYS[4], last_step, 'EX', ttl)
+    else
+        result = 'REPLAY'
+    end
+end
+
+return result
+'''
+
+# Globally track the connections
+dbconn = {}
+
+
+def db_connect(redis_url):
+    global dbconn
+
+    if redis_url not in dbconn:
+        dbconn[redis_url] = redis.StrictRedis.from_url(redis_url)
+
+    return dbconn[redis_url]
+
+
+def list_difference(first, second):
+    # Like set difference, but respects duplicates
+    difference = list(first)
+    for item in second:
+        if item in difference:
+            difference.remove(item)
+
+    return difference
+
+
+class GAStateBackend(totpcgi.backends.GAStateBackend):
+    def __init__(self, redis_url, state_ttl=900, prefix='totpcgi:'):
+        totpcgi.backends.GAStateBackend.__init__(self)
+        logger.debug('Using REDIS State backend')
+
+        self.conn = db_connect(redis_url)
+        self.update_script = self.conn.register_script(UPDATE_SCRIPT)
+
+        # Must be longer than both the window size and the rate-limit
+        # period, as older timestamps are dropped by key expiry.
+        self.state_ttl = state_ttl
+        self.prefix = prefix
+
+        # what get_user_state read, kept per thread, as the connection
+        # pool lets any number of threads work on the same user at once
+        self.loaded = totpcgi.backends.PerThreadDict()
+
+    def _get_keys(self, user):
+        return ['%s%s:%s' % (self.prefix, user, suffix)
+                for suffix in ('steps', 'scratch', 'counter', 'last_step')]
+
+    def get_user_state(self, user):
+        state = totpcgi.GAUserState()
+
+        (steps_key, scratch_key, counter_key, last_step_key) = self._get_keys(user)
+
+        # No locking here -- the update script sorts out any races
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(steps_key)
+        pipe.smembers(scratch_key)
+        pipe.get(counter_key)
+        pipe.get(last_step_key)
+        (steps, scratch, counter, last_step) = pipe.execute()
+
+        if steps is not None:
+            js = json.loads(steps)
+            # cjson encodes empty lists as empty objects
+            state.fail_timestamps = list(js['fail'] or [])
+            state.success_timestamps = list(js['success'] or [])
+
+        state.used_scratch_tokens = [int(token) for token in scratch]
+
+        if counter is not None:
+            state.counter = int(counter)
+
+        if last_step is not None:
+            state.last_step = int(last_step)
+
+        self.loaded[user] = totpcgi.GAUserState()
+        self.loaded[user].fail_timestamps = list(state.fail_timestamps)
+        self.loaded[user].success_timestamps = list(state.success_timestamps)
+        self.loaded[user].used_scratch_tokens = list(state.used_scratch_tokens)
+        self.loaded[user].counter = state.counter
+        self.loaded[user].last_step = state.last_step
+
+        return state
+
+    def update_user_state(self, user, state):
+        if user not in self.loaded.keys():
+            raise totpcgi.UserStateError("%s's loaded state has gone away!" % user)
+
+        loaded = self.loaded.pop(user)
+
+        # We only send what changed since we read the state, so the
+        # script can merge it with whatever other nodes have written since.
+        args = [int(time.time()) - self.state_ttl, self.state_ttl,
+                loaded.counter, state.counter, loaded.last_step, state.last_step]
+
+        for (new, old) in ((state.fail_timestamps, loaded.fail_timestamps),
+                           (state.success_timestamps, loaded.success_timestamps),
+                           (state.used_scratch_tokens, loaded.used_scratch_tokens)):
+            args.append(json.dumps(list_difference(new, old)))
+            args.append(json.dumps(list_difference(old, new)))
+
+        if state.rate_limit is not None:
+            args.extend(state.rate_limit)
+        else:
+            args.extend((0, 0))
+
+        logger.debug('Saving new state for user %s' % user)
+        result = self.update_script(keys=self._get_keys(user), args=args)
+
+        if result == 'RATE_LIMIT':
+            raise totpcgi.VerifyFailed(totpcgi.RATE_LIMIT_REACHED)
+
+        if result == 'REPLAY':
+            raise totpcgi.VerifyFailed('Token has already been used once')
+
+    def abort_user_state(self, user):
+        # nothing is locked, just forget what we loaded
+        self.loaded.pop(user, None)
+
+    def delete_user_state(self, user):
+        logger.debug('Deleting state keys for user=%s' % user)
+        self.conn.delete(*self._get_keys(user))
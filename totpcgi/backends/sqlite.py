@@ -0,0 +1,560 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+from __future__ import absolute_import
+
+import copy
+import time
+import logging
+import threading
+import totpcgi
+import totpcgi.backends
+import totpcgi.utils
+
+import sqlite3
+
+logger = logging.getLogger('totpcgi')
+
+# Same logical schema as contrib/totpcgi.psql
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        userid   INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(255) NOT NULL,
+        CONSTRAINT users_uniq UNIQUE (username)
+    );
+
+    CREATE TABLE IF NOT EXISTS timestamps (
+        userid    INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        success   BOOLEAN NOT NULL,
+        timestamp INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS timestamps_userid ON timestamps (userid);
+
+    CREATE TABLE IF NOT EXISTS used_scratch_tokens (
+        userid INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        token  INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS used_scratch_tokens_userid
+        ON used_scratch_tokens (userid);
+
+    CREATE TABLE IF NOT EXISTS counters (
+        userid  INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        counter INTEGER NOT NULL,
+        CONSTRAINT counters_uniq UNIQUE (userid, counter)
+    );
+
+    CREATE TABLE IF NOT EXISTS secrets (
+        userid             INTEGER      NOT NULL REFERENCES users ON DELETE CASCADE,
+        secret             VARCHAR(255) NOT NULL,
+        rate_limit_times   INTEGER DEFAULT 3,
+        rate_limit_seconds INTEGER DEFAULT 30,
+        window_size        INTEGER DEFAULT 0,
+        CONSTRAINT secrets_uniq UNIQUE (userid)
+    );
+
+    CREATE TABLE IF NOT EXISTS scratch_tokens (
+        userid INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        token  INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS scratch_tokens_userid ON scratch_tokens (userid);
+
+    CREATE TABLE IF NOT EXISTS pincodes (
+        userid  INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        pincode VARCHAR(1024) NOT NULL,
+        CONSTRAINT pincodes_uniq UNIQUE (userid)
+    );
+
+    CREATE TABLE IF NOT EXISTS last_steps (
+        userid INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        step   INTEGER NOT NULL,
+        CONSTRAINT last_steps_uniq UNIQUE (userid)
+    );
+
+    CREATE TABLE IF NOT EXISTS state_versions (
+        userid  INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        version INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT state_versions_uniq UNIQUE (userid)
+    );
+'''
+
+# INSERT ... ON CONFLICT DO UPDATE needs SQLite 3.24
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Globally track the database connections. A connection may only be
+# used by the thread that opened it, so every thread gets its own.
+dbconn = threading.local()
+busy_timeouts = {}
+# userids by (db_file, user), as every section may use its own database
+userids = {}
+
+
+def db_connect(db_file):
+    global dbconn
+
+    if not hasattr(dbconn, 'conns'):
+        dbconn.conns = {}
+
+    if db_file not in dbconn.conns:
+        # We manage transactions ourselves, so we can use BEGIN IMMEDIATE
+        # to take the write lock up front for state updates.
+        conn = sqlite3.connect(db_file, isolation_level=None)
+        cur = conn.cursor()
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('PRAGMA foreign_keys=ON')
+        if db_file in busy_timeouts:
+            cur.execute('PRAGMA busy_timeout = %d' % busy_timeouts[db_file])
+        cur.executescript(SCHEMA)
+
+        dbconn.conns[db_file] = conn
+
+    return dbconn.conns[db_file]
+
+
+def get_user_id(db_file, user):
+    global userids
+
+    if (db_file, user) in userids:
+        return userids[(db_file, user)]
+
+    cur = db_connect(db_file).cursor()
+    logger.debug('Checking users record for %s' % user)
+
+    # Whoever logs in first creates the record. If several do at once,
+    # all but one insert nothing and read the record the winner made.
+    cur.execute('INSERT OR IGNORE INTO users (username) VALUES (?)', (user,))
+    cur.execute('SELECT userid FROM users WHERE username = ?', (user,))
+    row = cur.fetchone()
+
+    userids[(db_file, user)] = row[0]
+    return row[0]
+
+
+class GAStateBackend(totpcgi.backends.GAStateBackend):
+    def __init__(self, db_file, optimistic=False):
+        totpcgi.backends.GAStateBackend.__init__(self)
+        logger.debug('Using SQLite State backend')
+
+        logger.debug('Opening the database in %s' % db_file)
+        self.db_file = db_file
+        db_connect(db_file)
+
+        # In optimistic mode the write lock is only taken in
+        # update_user_state, and only if nobody else has written the
+        # state since we read it.
+        self.optimistic = optimistic
+        self.versions = totpcgi.backends.PerThreadDict()
+
+        self.locks = totpcgi.backends.PerThreadDict()
+        # what get_user_state read, to tell what update_user_state changed
+        self.loaded = totpcgi.backends.PerThreadDict()
+
+    def set_lock_timeout(self, timeout):
+        totpcgi.backends.GAStateBackend.set_lock_timeout(self, timeout)
+        # BEGIN IMMEDIATE waits for as long as the busy timeout, which is
+        # 5 seconds unless set. Note that this applies to everything else
+        # using the same database file in this process, too.
+        busy_timeouts[self.db_file] = timeout*1000
+        db_connect(self.db_file).execute('PRAGMA busy_timeout = %d' % (timeout*1000))
+
+    def _begin_immediate(self, cur, user):
+        started = time.time()
+
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError, ex:
+            if 'locked' not in str(ex):
+                raise
+            raise self._lock_timed_out(user, started)
+
+        self._lock_acquired(user, started)
+
+    def get_user_state(self, user):
+
+        userid = get_user_id(self.db_file, user)
+
+        state = totpcgi.GAUserState()
+
+        cur = db_connect(self.db_file).cursor()
+
+        if self.optimistic:
+            cur.execute('SELECT version FROM state_versions WHERE userid = ?',
+                        (userid,))
+            row = cur.fetchone()
+            if row:
+                self.versions[user] = row[0]
+            else:
+                self.versions[user] = 0
+        else:
+            logger.debug('Starting immediate transaction for userid=%s' % userid)
+            self._begin_immediate(cur, user)
+
+        self.locks[user] = userid
+
+        cur.execute('''
+            SELECT timestamp, success
+              FROM timestamps
+             WHERE userid = ?''', (userid,))
+
+        for (timestamp, success) in cur.fetchall():
+            if success:
+                state.success_timestamps.append(timestamp)
+            else:
+                state.fail_timestamps.append(timestamp)
+
+        cur.execute('''
+            SELECT token
+              FROM used_scratch_tokens
+             WHERE userid = ?''', (userid,))
+
+        for (token,) in cur.fetchall():
+            state.used_scratch_tokens.append(token)
+
+        cur.execute('''
+            SELECT counter
+              FROM counters
+             WHERE userid = ?''', (userid,))
+
+        row = cur.fetchone()
+        if row and row[0] >= 0:
+            state.counter = row[0]
+
+        cur.execute('''
+            SELECT step
+              FROM last_steps
+             WHERE userid = ?''', (userid,))
+
+        row = cur.fetchone()
+        if row:
+            state.last_step = row[0]
+
+        self.loaded[user] = copy.deepcopy(state)
+
+        return state
+
+    def _bump_version(self, cur, user, userid):
+        version = self.versions.pop(user)
+
+        cur.execute('''
+            UPDATE state_versions
+               SET version = version + 1
+             WHERE userid = ? AND version = ?''', (userid, version))
+
+        if cur.rowcount == 1:
+            return True
+
+        if version == 0:
+            # nobody has written a version for this user yet
+            try:
+                cur.execute('''
+                    INSERT INTO state_versions (userid, version)
+                         VALUES (?, 1)''', (userid,))
+                return True
+            except sqlite3.IntegrityError:
+                pass
+
+        return False
+
+    def update_user_state(self, user, state):
+        logger.debug('Writing new state for user %s' % user)
+
+        if user not in self.locks.keys():
+            raise totpcgi.UserStateError("%s's sqlite transaction has gone away!" % user)
+
+        userid = self.locks[user]
+        loaded = self.loaded.pop(user, None)
+
+        cur = db_connect(self.db_file).cursor()
+
+        if self.optimistic:
+            logger.debug('Starting immediate transaction for userid=%s' % userid)
+            self._begin_immediate(cur, user)
+
+            if not self._bump_version(cur, user, userid):
+                cur.execute('ROLLBACK')
+                del self.locks[user]
+                self._lock_released(user)
+                raise totpcgi.UserStateConflict(
+                    'State for %s changed since we read it' % user)
+
+        # Most logins only change part of the state, so leave the rest be
+        changed = totpcgi.backends.changed_state(loaded, state)
+
+        if 'timestamps' in changed:
+            cur.execute('DELETE FROM timestamps WHERE userid=?', (userid,))
+
+            for timestamp in state.fail_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (?, ?, ?)''', (userid, False, timestamp))
+
+            for timestamp in state.success_timestamps:
+                cur.execute('''
+                    INSERT INTO timestamps (userid, success, timestamp)
+                         VALUES (?, ?, ?)''', (userid, True, timestamp))
+
+        if 'used_scratch_tokens' in changed:
+            cur.execute('DELETE FROM used_scratch_tokens WHERE userid=?', (userid,))
+
+            for token in state.used_scratch_tokens:
+                cur.execute('''
+                    INSERT INTO used_scratch_tokens (userid, token)
+                         VALUES (?, ?)''', (userid, token))
+
+        if state.counter >= 0 and 'counter' in changed:
+            cur.execute('DELETE FROM counters WHERE userid=?', (userid,))
+            cur.execute('''
+                INSERT INTO counters (userid, counter)
+                     VALUES (?, ?)''', (userid, state.counter))
+
+        # The one write a login makes with replay_guard = last_step
+        if state.last_step >= 0 and 'last_step' in changed:
+            if HAS_UPSERT:
+                cur.execute('''
+                    INSERT INTO last_steps (userid, step)
+                         VALUES (?, ?)
+                    ON CONFLICT (userid)
+                  DO UPDATE SET step = max(step, excluded.step)''', (userid, state.last_step))
+            else:
+                # Older SQLite has no upsert. Nobody else can write the
+                # user's state until we commit, so there's no race here.
+                cur.execute('SELECT step FROM last_steps WHERE userid = ?', (userid,))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute('''
+                        INSERT INTO last_steps (userid, step)
+                             VALUES (?, ?)''', (userid, state.last_step))
+                elif row[0] < state.last_step:
+                    cur.execute('''
+                        UPDATE last_steps
+                           SET step = ?
+                         WHERE userid = ?''', (state.last_step, userid))
+
+        logger.debug('Committing transaction for userid=%s' % userid)
+        cur.execute('COMMIT')
+
+        del self.locks[user]
+        self._lock_released(user)
+
+    def abort_user_state(self, user):
+        if user not in self.locks.keys():
+            return
+
+        logger.debug('Aborting state update for user %s' % user)
+        del self.locks[user]
+        self.versions.pop(user, None)
+        self.loaded.pop(user, None)
+
+        # In optimistic mode, we may or may not have begun writing
+        try:
+            db_connect(self.db_file).execute('ROLLBACK')
+        except sqlite3.OperationalError:
+            pass
+
+        self._lock_released(user)
+
+    def delete_user_state(self, user):
+        cur = db_connect(self.db_file).cursor()
+        logger.debug('Deleting state records for user=%s' % user)
+
+        userid = get_user_id(self.db_file, user)
+
+        cur.execute('BEGIN IMMEDIATE')
+
+        cur.execute('DELETE FROM timestamps WHERE userid=?', (userid,))
+        cur.execute('DELETE FROM used_scratch_tokens WHERE userid=?', (userid,))
+        cur.execute('DELETE FROM counters WHERE userid=?', (userid,))
+        cur.execute('DELETE FROM last_steps WHERE userid=?', (userid,))
+        cur.execute('DELETE FROM state_versions WHERE userid=?', (userid,))
+
+        # If there are no pincodes or secrets entries, then we may as well
+        # delete the user record.
+        cur.execute('SELECT 1 FROM pincodes WHERE userid=?', (userid,))
+        if not cur.fetchone():
+            cur.execute('SELECT 1 FROM secrets WHERE userid=?', (userid,))
+            if not cur.fetchone():
+                logger.debug('No entries left for user=%s, deleting' % user)
+                cur.execute('DELETE FROM users WHERE userid=?', (userid,))
+                userids.pop((self.db_file, user), None)
+
+        cur.execute('COMMIT')
+
+
+class GASecretBackend(totpcgi.backends.GASecretBackend):
+    def __init__(self, db_file):
+        totpcgi.backends.GASecretBackend.__init__(self)
+        logger.debug('Using SQLite Secrets backend')
+
+        logger.debug('Opening the database in %s' % db_file)
+        self.db_file = db_file
+        db_connect(db_file)
+
+    def get_user_secret(self, user, pincode=None):
+        cur = db_connect(self.db_file).cursor()
+
+        logger.debug('Querying DB for user %s' % user)
+
+        cur.execute('''
+            SELECT s.secret,
+                   s.rate_limit_times,
+                   s.rate_limit_seconds,
+                   s.window_size
+              FROM secrets AS s
+              JOIN users AS u USING (userid)
+             WHERE u.username = ?''', (user,))
+        row = cur.fetchone()
+
+        if not row:
+            raise totpcgi.UserNotFound('no secrets record for %s' % user)
+
+        (secret, rate_limit_times, rate_limit_seconds, window_size) = row
+
+        using_encrypted_secret = False
+        if secret.find('aes256+hmac256') == 0 and pincode is not None:
+            secret = totpcgi.utils.decrypt_secret(secret, pincode, user)
+            using_encrypted_secret = True
+
+        gaus = totpcgi.GAUserSecret(secret)
+        if rate_limit_times is not None and rate_limit_seconds is not None:
+            gaus.rate_limit = (rate_limit_times, rate_limit_seconds)
+
+        if window_size is not None:
+            gaus.window_size = window_size
+
+        logger.debug('Querying DB for counter info for %s' % user)
+        cur.execute('''
+            SELECT c.counter
+              FROM counters AS c
+              JOIN users AS u USING (userid)
+             WHERE u.username = ?''', (user,))
+
+        row = cur.fetchone()
+        if row:
+            gaus.set_hotp(row[0])
+
+        # Not loading scratch tokens if using encrypted secret
+        if using_encrypted_secret:
+            return gaus
+
+        logger.debug('Querying DB for scratch tokens for %s' % user)
+
+        cur.execute('''
+            SELECT st.token
+              FROM scratch_tokens AS st
+              JOIN users AS u USING (userid)
+             WHERE u.username = ?''', (user,))
+
+        for (token,) in cur.fetchall():
+            gaus.scratch_tokens.append(token)
+
+        return gaus
+
+    def save_user_secret(self, user, gaus, pincode=None):
+        cur = db_connect(self.db_file).cursor()
+
+        userid = get_user_id(self.db_file, user)
+
+        secret = gaus.otp.secret
+
+        if pincode is not None:
+            secret = totpcgi.utils.encrypt_secret(secret, pincode)
+
+        cur.execute('BEGIN IMMEDIATE')
+
+        self._delete_user_secret(user)
+
+        cur.execute('''
+            INSERT INTO secrets
+                        (userid, secret, rate_limit_times,
+                         rate_limit_seconds, window_size)
+                 VALUES (?, ?, ?, ?, ?)''',
+                    (userid, secret, gaus.rate_limit[0], gaus.rate_limit[1], gaus.window_size))
+
+        for token in gaus.scratch_tokens:
+            cur.execute('''
+                    INSERT INTO scratch_tokens
+                                (userid, token)
+                         VALUES (?, ?)''', (userid, token,))
+
+        cur.execute('COMMIT')
+
+    def _delete_user_secret(self, user):
+        userid = get_user_id(self.db_file, user)
+
+        cur = db_connect(self.db_file).cursor()
+        cur.execute('DELETE FROM secrets WHERE userid=?', (userid,))
+        cur.execute('DELETE FROM scratch_tokens WHERE userid=?', (userid,))
+
+    def delete_user_secret(self, user):
+        cur = db_connect(self.db_file).cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        self._delete_user_secret(user)
+        cur.execute('COMMIT')
+
+
+class GAPincodeBackend(totpcgi.backends.GAPincodeBackend):
+    def __init__(self, db_file):
+        totpcgi.backends.GAPincodeBackend.__init__(self)
+        logger.debug('Using SQLite Pincodes backend')
+
+        logger.debug('Opening the database in %s' % db_file)
+        self.db_file = db_file
+        db_connect(db_file)
+
+    def verify_user_pincode(self, user, pincode):
+        cur = db_connect(self.db_file).cursor()
+
+        logger.debug('Querying DB for user %s' % user)
+
+        cur.execute('''
+            SELECT p.pincode
+              FROM pincodes AS p
+              JOIN users AS u USING (userid)
+             WHERE u.username = ?''', (user,))
+
+        row = cur.fetchone()
+
+        if not row:
+            raise totpcgi.UserNotFound('no pincodes record for user %s' % user)
+
+        (hashcode,) = row
+
+        return self._verify_user_hashcode(user, pincode, hashcode)
+
+    def _delete_user_hashcode(self, user):
+        userid = get_user_id(self.db_file, user)
+
+        cur = db_connect(self.db_file).cursor()
+        cur.execute('DELETE FROM pincodes WHERE userid=?', (userid,))
+
+    def save_user_hashcode(self, user, hashcode, makedb=False):
+        userid = get_user_id(self.db_file, user)
+
+        cur = db_connect(self.db_file).cursor()
+        cur.execute('BEGIN IMMEDIATE')
+
+        self._delete_user_hashcode(user)
+
+        cur.execute('''
+            INSERT INTO pincodes
+                        (userid, pincode)
+                 VALUES (?, ?)''', (userid, hashcode,))
+
+        cur.execute('COMMIT')
+
+    def delete_user_hashcode(self, user):
+        cur = db_connect(self.db_file).cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        self._delete_user_hashcode(user)
+        cur.execute('COMMIT')
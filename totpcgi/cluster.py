@@ -0,0 +1,651 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# Cluster mode for persistent servers (totp.fcgi). Every user is owned by
+# exactly one node on a consistent-hash ring, and the other nodes forward
+# that user's logins to the owner, so the owner can keep the user's state
+# in memory and only ever has to lock it against its own threads.
+#
+# Nodes talk to each other over plain TCP, one JSON message per line.
+# Every request and every reply carries an HMAC of its body made with the
+# shared cluster secret, which itself is never sent, so nobody without it
+# can move users around or answer for the owner. Nothing is encrypted,
+# though, so the cluster port still should not be reachable from anywhere
+# but the other nodes.
+#
+import os
+import json
+import hmac
+import time
+import bisect
+import socket
+import hashlib
+import logging
+import threading
+import SocketServer
+
+import totpcgi
+import totpcgi.backends
+import totpcgi.utils
+
+from totpcgi.backends.file import merge_user_states
+
+import exceptions
+
+logger = logging.getLogger('totpcgi')
+
+# Points each member gets on the ring, to even out how many users it owns
+RING_REPLICAS = 64
+# How many idle connections we keep open to each peer
+PEER_POOL_SIZE = 4
+# How far apart the members' clocks may be, in seconds. Requests older
+# than this are refused, and we remember the nonces of the newer ones.
+MAX_CLOCK_SKEW = 30
+# How many users we keep in memory, and for how long since their last
+# change. The backing state backend has them all, so forgetting one only
+# means reading it back in, but users we no longer hold are not handed
+# off when members change.
+MEMORY_STATE_TTL = 86400
+MEMORY_STATE_SIZE = 100000
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+class ClusterError(exceptions.Exception):
+    def __init__(self, message):
+        exceptions.Exception.__init__(self, message)
+        logger.debug('!ClusterError: %s' % message)
+
+
+# What the owner's errors turn back into on the node the user talked to
+REMOTE_ERRORS = dict((cls.__name__, cls) for cls in (
+    totpcgi.UserNotFound, totpcgi.UserSecretError, totpcgi.UserStateError,
+    totpcgi.UserStateConflict, totpcgi.UserStateLockTimeout,
+    totpcgi.UserPincodeError, totpcgi.VerifyFailed, ClusterError))
+
+
+def parse_members(value):
+    """ 'one=10.0.0.1:8000, two=10.0.0.2:8000' -> {name: (host, port)}"""
+    members = {}
+
+    for member in value.replace(',', ' ').split():
+        try:
+            (name, address) = member.split('=', 1)
+            (host, port) = address.rsplit(':', 1)
+            members[name] = (host, int(port))
+        except ValueError:
+            raise ClusterError('Not a valid cluster member: %s' % member)
+
+    return members
+
+
+def get_mac(secret, *parts):
+    return hmac.new(secret, '\n'.join(parts), hashlib.sha256).hexdigest()
+
+
+def check_mac(secret, mac, *parts):
+    return compare_digest(str(mac), get_mac(secret, *parts))
+
+
+def state_to_js(state):
+    return {
+        'fail_timestamps': list(state.fail_timestamps),
+        'success_timestamps': list(state.success_timestamps),
+        'used_scratch_tokens': list(state.used_scratch_tokens),
+        'counter': state.counter,
+        'last_step': state.last_step
+    }
+
+
+def js_to_state(js):
+    state = totpcgi.GAUserState()
+    state.fail_timestamps = list(js['fail_timestamps'])
+    state.success_timestamps = list(js['success_timestamps'])
+    state.used_scratch_tokens = list(js['used_scratch_tokens'])
+    state.counter = js['counter']
+    state.last_step = js.get('last_step', -1)
+
+    return state
+
+
+class HashRing:
+    def __init__(self, members, replicas=RING_REPLICAS):
+        self.members = sorted(members)
+
+        points = sorted((self._hash('%s-%s' % (member, i)), member)
+                        for member in self.members for i in xrange(replicas))
+        self.points = [point for (point, member) in points]
+        self.owners = [member for (point, member) in points]
+
+    @staticmethod
+    def _hash(key):
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, user):
+        if not self.points:
+            raise ClusterError('There are no cluster members')
+
+        i = bisect.bisect(self.points, self._hash(user)) % len(self.points)
+        return self.owners[i]
+
+
+class MemoryStateBackend(totpcgi.backends.GAStateBackend):
+    """ Keeps the state of the users this node owns in memory. Users are
+        loaded from the backing state backend the first time we see them,
+        and every change is written through to it, so the state outlives
+        the process."""
+
+    def __init__(self, backing=None, ttl=MEMORY_STATE_TTL, maxsize=MEMORY_STATE_SIZE):
+        totpcgi.backends.GAStateBackend.__init__(self)
+        logger.debug('Using in-memory cluster state')
+
+        self.backing = backing
+        self.states = totpcgi.utils.TTLCache(ttl, maxsize)
+        # which thread holds each user
+        self.owners = {}
+        self.cond = threading.Condition()
+
+    def _acquire(self, user):
+        me = threading.current_thread().ident
+        started = time.time()
+
+        if self.lock_timeout is not None:
+            deadline = started + self.lock_timeout
+
+        logger.debug('Locking state for user %s' % user)
+        self.cond.acquire()
+        try:
+            while self.owners.get(user, me) != me:
+                if self.lock_timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise self._lock_timed_out(user, started)
+                    self.cond.wait(remaining)
+
+            self.owners[user] = me
+        finally:
+            self.cond.release()
+
+        self._lock_acquired(user, started)
+
+    def _release(self, user):
+        logger.debug('Unlocking state for user %s' % user)
+        self.cond.acquire()
+        try:
+            self.owners.pop(user, None)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+        self._lock_released(user)
+
+    def _is_held(self, user):
+        return self.owners.get(user) == threading.current_thread().ident
+
+    def users(self):
+        return self.states.keys()
+
+    def get_user_state(self, user):
+        self._acquire(user)
+
+        state = self.states.get(user)
+        if state is None:
+            state = totpcgi.GAUserState()
+            if self.backing is not None:
+                try:
+                    state = self.backing.get_user_state(user)
+                    self.backing.abort_user_state(user)
+                except:
+                    self._release(user)
+                    raise
+            self.states.set(user, state)
+
+        # GAUser changes what it gets, so never hand out our own copy
+        return js_to_state(state_to_js(state))
+
+    def update_user_state(self, user, state):
+        if not self._is_held(user):
+            raise totpcgi.UserStateError("%s's state lock has gone away!" % user)
+
+        try:
+            if self.backing is not None:
+                with self.backing.transaction(user) as stored:
+                    (stored.fail_timestamps, stored.success_timestamps,
+                     stored.used_scratch_tokens, stored.counter,
+                     stored.last_step) = (
+                        state.fail_timestamps, state.success_timestamps,
+                        state.used_scratch_tokens, state.counter,
+                        state.last_step)
+
+            logger.debug('Saving new state for user %s' % user)
+            self.states.set(user, js_to_state(state_to_js(state)))
+        finally:
+            self._release(user)
+
+    def abort_user_state(self, user):
+        if self._is_held(user):
+            logger.debug('Aborting state update for user %s' % user)
+            self._release(user)
+
+    def delete_user_state(self, user):
+        self._acquire(user)
+        try:
+            self.states.delete(user)
+            if self.backing is not None:
+                self.backing.delete_user_state(user)
+        finally:
+            self._release(user)
+
+    def merge_user_state(self, user, theirs):
+        """ Folds in state handed off by the user's previous owner."""
+        ours = self.get_user_state(user)
+        self.update_user_state(user, merge_user_states(ours, theirs))
+
+    def forget_user_state(self, user):
+        """ Drops a user we hold from memory, once someone else owns it."""
+        if not self._is_held(user):
+            raise totpcgi.UserStateError("%s's state lock has gone away!" % user)
+
+        self.states.delete(user)
+        self._release(user)
+
+
+class PeerConnection:
+    """ Keeps a few connections to a peer open, so forwarding a login does
+        not cost a TCP handshake every time."""
+
+    def __init__(self, address, secret, timeout=5, pool_size=PEER_POOL_SIZE):
+        self.address = address
+        self.secret = secret
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except socket.error, ex:
+            raise ClusterError('Cannot connect to %s:%s: %s'
+                               % (self.address[0], self.address[1], ex))
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (sock, sock.makefile('r'))
+
+    def _close(self, conn):
+        (sock, rfile) = conn
+        rfile.close()
+        sock.close()
+
+    def _request(self, conn, line):
+        (sock, rfile) = conn
+        sock.sendall(line)
+        return rfile.readline()
+
+    def call(self, message):
+        body = json.dumps(message)
+        nonce = os.urandom(16).encode('hex')
+        stamp = str(int(time.time()))
+        line = json.dumps({
+            'nonce': nonce,
+            'time': stamp,
+            'body': body,
+            'mac': get_mac(self.secret, 'request', nonce, stamp, body)
+        }) + '\n'
+
+        with self.lock:
+            conn = None
+            if self.idle:
+                conn = self.idle.pop()
+
+        response = ''
+        if conn is not None:
+            try:
+                response = self._request(conn, line)
+            except socket.timeout:
+                self._close(conn)
+                raise ClusterError('Timed out waiting for %s:%s' % self.address)
+            except socket.error:
+                pass
+
+            if not response:
+                # The peer closed it while it sat idle, so it never saw
+                # the request and it's safe to send again.
+                logger.debug('Idle connection to %s:%s went away' % self.address)
+                self._close(conn)
+                conn = None
+
+        if conn is None:
+            conn = self._connect()
+            try:
+                response = self._request(conn, line)
+            except socket.error, ex:
+                self._close(conn)
+                raise ClusterError('Request to %s:%s failed: %s'
+                                   % (self.address[0], self.address[1], ex))
+
+        if not response.endswith('\n'):
+            self._close(conn)
+            raise ClusterError('%s:%s closed the connection' % self.address)
+
+        # The reply has to be for this request, and from someone who
+        # knows the secret, or anyone could tell us a token was fine.
+        try:
+            envelope = json.loads(response)
+            body = str(envelope['body'])
+            if not check_mac(self.secret, envelope['mac'], 'response', nonce, body):
+                raise ValueError('wrong MAC')
+            response = json.loads(body)
+        except (ValueError, KeyError, TypeError, UnicodeError), ex:
+            self._close(conn)
+            raise ClusterError('Reply from %s:%s failed authentication: %s'
+                               % (self.address[0], self.address[1], ex))
+
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                conn = None
+
+        if conn is not None:
+            self._close(conn)
+
+        return response
+
+    def close(self):
+        with self.lock:
+            (idle, self.idle) = (self.idle, [])
+
+        for conn in idle:
+            self._close(conn)
+
+
+class ClusterRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # peers keep the connection open for as many requests as they like
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            self.wfile.write(self.server.node.handle_message(line) + '\n')
+
+
+class ClusterServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ClusterNode:
+    def __init__(self, name, members, backends, require_pincode=False,
+                 token_first=False, secret=None, timeout=5):
+        if not secret:
+            raise ClusterError('Cluster mode needs a secret')
+
+        self.name = name
+        self.secret = secret
+        self.timeout = timeout
+        self.backends = backends
+
+        # from here on, the configured state backend is only there to
+        # load users from and write their changes through to
+        self.state_backend = MemoryStateBackend(backends.state_backend)
+        backends.state_backend = self.state_backend
+
+        self.ga = totpcgi.GoogleAuthenticator(backends, require_pincode, token_first)
+
+        self.lock = threading.Lock()
+        self.members = {}
+        self.peers = {}
+        self.ring = HashRing([])
+        self._set_ring(members)
+
+        # nonce -> when it's old enough to be refused anyway
+        self.nonces = {}
+        self.nonces_lock = threading.Lock()
+
+        self.server = None
+
+    def _set_ring(self, members):
+        with self.lock:
+            for (name, peer) in self.peers.items():
+                if members.get(name) != self.members.get(name):
+                    peer.close()
+                    del self.peers[name]
+
+            for (name, address) in members.items():
+                if name != self.name and name not in self.peers:
+                    self.peers[name] = PeerConnection(address, self.secret,
+                                                      self.timeout)
+
+            self.members = dict(members)
+            self.ring = HashRing(members.keys())
+
+        logger.debug('Cluster members are now: %s' % ', '.join(sorted(members)))
+
+    def start(self):
+        """ Starts answering peers in a background thread."""
+        self.server = ClusterServer(self.members[self.name], ClusterRequestHandler)
+        self.server.node = self
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        logger.debug('Cluster node %s listening on %s:%s'
+                     % ((self.name,) + self.server.server_address[:2]))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        for peer in self.peers.values():
+            peer.close()
+
+    def _call(self, name, message):
+        with self.lock:
+            peer = self.peers.get(name)
+
+        if peer is None:
+            raise ClusterError('Not a cluster member: %s' % name)
+
+        response = peer.call(message)
+
+        if 'error' in response:
+            raise REMOTE_ERRORS.get(response.get('type'),
+                                    totpcgi.VerifyFailed)(response['error'])
+
+        return response
+
+    def verify_user_token(self, user, token, forwarded=False):
+        owner = self.ring.get_node(user)
+
+        # While the members are changing, the node that forwarded this
+        # may not agree with us about who owns the user. Bouncing it back
+        # could go on forever, so we just deal with it.
+        if owner == self.name or forwarded:
+            return self.ga.verify_user_token(user, token)
+
+        logger.debug('Forwarding %s to %s' % (user, owner))
+        return self._call(owner, {'op': 'verify', 'user': user,
+                                  'token': token})['status']
+
+    def set_members(self, members):
+        """ Switches to the new members and hands the users that now
+            belong to someone else over to them. Until a user's state
+            arrives, its new owner only has what the backing state backend
+            has, so every node should be told about the change at about
+            the same time."""
+        self._set_ring(members)
+
+        if not members:
+            return 0
+
+        handed = 0
+        for user in self.state_backend.users():
+            owner = self.ring.get_node(user)
+            if owner == self.name:
+                continue
+
+            state = self.state_backend.get_user_state(user)
+            try:
+                self._call(owner, {'op': 'handoff', 'user': user,
+                                   'state': state_to_js(state)})
+            except Exception, ex:
+                # the backing state backend still has it, and we may
+                # get another go when members change again
+                logger.info('Could not hand %s off to %s: %s' % (user, owner, ex))
+                self.state_backend.abort_user_state(user)
+                continue
+
+            self.state_backend.forget_user_state(user)
+            handed += 1
+
+        logger.debug('Handed %s users off to other members' % handed)
+        return handed
+
+    def _authenticate(self, envelope):
+        """ Returns the request in envelope, if it is signed with our
+            secret, recent and not one we've seen before."""
+        try:
+            (nonce, stamp, body) = (str(envelope['nonce']), str(envelope['time']),
+                                    str(envelope['body']))
+            if not check_mac(self.secret, envelope['mac'], 'request', nonce, stamp, body):
+                raise ClusterError('Request failed authentication')
+            stamp = int(stamp)
+        except (ValueError, KeyError, TypeError, UnicodeError):
+            raise ClusterError('Request failed authentication')
+
+        now = time.time()
+        if abs(now - stamp) > MAX_CLOCK_SKEW:
+            raise ClusterError('Request is too old or too new')
+
+        with self.nonces_lock:
+            for (seen, expires) in self.nonces.items():
+                if expires < now:
+                    del self.nonces[seen]
+
+            if nonce in self.nonces:
+                raise ClusterError('Request was replayed')
+            self.nonces[nonce] = stamp + MAX_CLOCK_SKEW
+
+        return json.loads(body)
+
+    def handle_message(self, line):
+        """ Returns the signed reply to a request line."""
+        nonce = ''
+        try:
+            envelope = json.loads(line)
+            if isinstance(envelope, dict):
+                nonce = str(envelope.get('nonce', ''))
+
+            message = self._authenticate(envelope)
+            op = message.get('op')
+
+            if op == 'verify':
+                status = self.verify_user_token(str(message['user']),
+                                                str(message['token']),
+                                                forwarded=True)
+
+            elif op == 'handoff':
+                user = str(message['user'])
+                mo = totpcgi.SANE_USERNAME_RE.match(user)
+                if not mo or mo.group(1) != user:
+                    raise ClusterError('Username contains invalid characters')
+
+                logger.debug('Taking over %s' % user)
+                self.state_backend.merge_user_state(user, js_to_state(message['state']))
+                status = 'OK'
+
+            elif op == 'members':
+                members = dict((str(name), (str(host), int(port)))
+                               for (name, (host, port)) in message['members'].items())
+                status = 'Handed off %s users' % self.set_members(members)
+
+            else:
+                raise ClusterError('Unknown request: %s' % op)
+
+            response = {'status': status}
+
+        except Exception, ex:
+            response = {'error': str(ex), 'type': ex.__class__.__name__}
+
+        body = json.dumps(response)
+        return json.dumps({'body': body,
+                           'mac': get_mac(self.secret, 'response', nonce, body)})
+
+
+def announce_members(members, nodes, secret, timeout=5):
+    """ Tells every one of nodes ({name: (host, port)}) that the cluster
+        now consists of members. Returns the names of the nodes we could
+        not tell."""
+    if not secret:
+        raise ClusterError('Cluster mode needs a secret')
+
+    message = {'op': 'members', 'members': members}
+
+    failed = []
+    for (name, address) in sorted(nodes.items()):
+        peer = PeerConnection(address, secret, timeout)
+        try:
+            response = peer.call(message)
+            if 'error' in response:
+                raise ClusterError(response['error'])
+            logger.debug('%s: %s' % (name, response['status']))
+        except ClusterError, ex:
+            logger.info('Could not update members of %s: %s' % (name, ex))
+            failed.append(name)
+        finally:
+            peer.close()
+
+    return failed
+
+
+def load_from_config(config, backends, require_pincode=False, token_first=False):
+    """ Returns a ClusterNode if [cluster] is configured, or None."""
+    if not config.has_section('cluster'):
+        return None
+
+    name = config.get('cluster', 'node_name')
+    members = parse_members(config.get('cluster', 'members'))
+    if name not in members:
+        raise ClusterError('node_name %s is not one of the members' % name)
+
+    # ClusterNode refuses to start without one
+    secret = None
+    if config.has_option('cluster', 'secret'):
+        secret = config.get('cluster', 'secret')
+    timeout = 5
+    if config.has_option('cluster', 'timeout'):
+        timeout = config.getint('cluster', 'timeout')
+
+    return ClusterNode(name, members, backends, require_pincode, token_first,
+                       secret, timeout)
@@ -0,0 +1,233 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# Picks the fastest implementation of PBKDF2-HMAC-SHA256 and AES-CBC
+# available on this system when first imported, and checks them against
+# known answers before first use.
+#
+import hmac
+import struct
+import hashlib
+import logging
+import threading
+
+import exceptions
+
+logger = logging.getLogger('totpcgi')
+
+
+class CryptoSelfTestFailed(exceptions.Exception):
+    def __init__(self, message):
+        exceptions.Exception.__init__(self, message)
+        logger.debug('!CryptoSelfTestFailed: %s' % message)
+
+
+def _pbkdf2_hashlib(password, salt, iterations, keylen):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations, keylen)
+
+
+def _pbkdf2_cryptography(password, salt, iterations, keylen):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=keylen, salt=salt,
+                     iterations=iterations, backend=default_backend())
+    return kdf.derive(password)
+
+
+def _pbkdf2_passlib(password, salt, iterations, keylen):
+    from passlib.utils.pbkdf2 import pbkdf2
+    return pbkdf2(password, salt, iterations, keylen, prf='hmac-sha256')
+
+
+def _pbkdf2_python(password, salt, iterations, keylen):
+    # RFC 2898, only ever used if nothing better is around
+    prf = hmac.new(password, digestmod=hashlib.sha256)
+    blocks = []
+
+    for block in xrange((keylen + prf.digest_size - 1) / prf.digest_size):
+        mac = prf.copy()
+        mac.update(salt + struct.pack('>I', block+1))
+        u = mac.digest()
+        result = int(u.encode('hex'), 16)
+
+        for i in xrange(iterations-1):
+            mac = prf.copy()
+            mac.update(u)
+            u = mac.digest()
+            result ^= int(u.encode('hex'), 16)
+
+        blocks.append(('%064x' % result).decode('hex'))
+
+    return ''.join(blocks)[:keylen]
+
+
+def _aes_cryptography(key, iv, data, encrypt):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    if encrypt:
+        ctx = cipher.encryptor()
+    else:
+        ctx = cipher.decryptor()
+
+    return ctx.update(data) + ctx.finalize()
+
+
+def _aes_pycrypto(key, iv, data, encrypt):
+    from Crypto.Cipher import AES
+
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    if encrypt:
+        return cipher.encrypt(data)
+
+    return cipher.decrypt(data)
+
+
+def _find_providers():
+    pbkdf2_providers = []
+    aes_providers = []
+
+    # If python was built against an OpenSSL without PBKDF2, hashlib
+    # falls back to a python implementation of its own, which is no
+    # better than passlib's.
+    hashlib_in_c = (hasattr(hashlib, 'pbkdf2_hmac')
+                    and type(hashlib.pbkdf2_hmac).__name__ == 'builtin_function_or_method')
+
+    if hashlib_in_c:
+        pbkdf2_providers.append(('hashlib', _pbkdf2_hashlib))
+
+    try:
+        import cryptography.hazmat.backends
+        pbkdf2_providers.append(('cryptography', _pbkdf2_cryptography))
+        aes_providers.append(('cryptography', _aes_cryptography))
+    except ImportError:
+        pass
+
+    try:
+        import passlib.utils.pbkdf2
+        pbkdf2_providers.append(('passlib', _pbkdf2_passlib))
+    except ImportError:
+        pass
+
+    if hasattr(hashlib, 'pbkdf2_hmac') and not hashlib_in_c:
+        pbkdf2_providers.append(('hashlib', _pbkdf2_hashlib))
+
+    pbkdf2_providers.append(('python', _pbkdf2_python))
+
+    # pycrypto or pycryptodome, both install as Crypto
+    try:
+        import Crypto.Cipher.AES
+        aes_providers.append(('pycrypto', _aes_pycrypto))
+    except ImportError:
+        pass
+
+    return pbkdf2_providers, aes_providers
+
+
+# In order of preference, the first one is what we use
+(PBKDF2_PROVIDERS, AES_PROVIDERS) = _find_providers()
+
+(pbkdf2_provider, _pbkdf2) = PBKDF2_PROVIDERS[0]
+
+if AES_PROVIDERS:
+    (aes_provider, _aes) = AES_PROVIDERS[0]
+else:
+    (aes_provider, _aes) = (None, None)
+
+self_tested = False
+self_test_lock = threading.Lock()
+
+# PBKDF2-HMAC-SHA256 of 'password' and 'salt' with 2 iterations
+PBKDF2_KAT = ('ae4d0c95af6b46d32d0adff928f06dd02a303f8ef3c251dfd6e2d85a95474c43'
+              '830651afcb5c862f0b249bd031f7a67520d136470f5ec271ece91c07773253d9')
+
+# NIST SP 800-38A, F.2.5 CBC-AES256.Encrypt, first block
+AES_KAT_KEY = '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4'
+AES_KAT_IV = '000102030405060708090a0b0c0d0e0f'
+AES_KAT_PLAIN = '6bc1bee22e409f96e93d7e117393172a'
+AES_KAT_CIPHER = 'f58c4c04d6e5f1ba779eabfb5f7bfbd6'
+
+# RFC 4231, test case 2
+HMAC_KAT = '5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843'
+
+
+def self_test(pbkdf2_func=None, aes_func=None):
+    if pbkdf2_func is None:
+        pbkdf2_func = _pbkdf2
+    if aes_func is None:
+        aes_func = _aes
+
+    if pbkdf2_func('password', 'salt', 2, 64).encode('hex') != PBKDF2_KAT:
+        raise CryptoSelfTestFailed('PBKDF2 known-answer test failed')
+
+    if hmac.new('Jefe', 'what do ya want for nothing?',
+                hashlib.sha256).hexdigest() != HMAC_KAT:
+        raise CryptoSelfTestFailed('HMAC known-answer test failed')
+
+    if aes_func is not None:
+        key = AES_KAT_KEY.decode('hex')
+        iv = AES_KAT_IV.decode('hex')
+
+        if aes_func(key, iv, AES_KAT_PLAIN.decode('hex'), True).encode('hex') != AES_KAT_CIPHER:
+            raise CryptoSelfTestFailed('AES encrypt known-answer test failed')
+
+        if aes_func(key, iv, AES_KAT_CIPHER.decode('hex'), False).encode('hex') != AES_KAT_PLAIN:
+            raise CryptoSelfTestFailed('AES decrypt known-answer test failed')
+
+
+def _ensure_self_tested():
+    global self_tested
+
+    if self_tested:
+        return
+
+    with self_test_lock:
+        if not self_tested:
+            logger.debug('Self-testing crypto providers: pbkdf2=%s, aes=%s'
+                         % (pbkdf2_provider, aes_provider))
+            self_test()
+            self_tested = True
+
+
+def pbkdf2_sha256(password, salt, iterations, keylen):
+    _ensure_self_tested()
+    return _pbkdf2(password, salt, iterations, keylen)
+
+
+def hmac_sha256(key, data):
+    # the stdlib one is already a thin wrapper around C hashes
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def _get_aes():
+    if _aes is None:
+        raise ImportError('Need pycrypto, pycryptodome or cryptography for AES')
+
+    _ensure_self_tested()
+    return _aes
+
+
+def aes_cbc_encrypt(key, iv, data):
+    return _get_aes()(key, iv, data, True)
+
+
+def aes_cbc_decrypt(key, iv, data):
+    return _get_aes()(key, iv, data, False)
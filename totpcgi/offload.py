@@ -0,0 +1,130 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# In persistent, threaded processes (totp.fcgi), a bcrypt run or a key
+# derivation holds the GIL long enough to stall every other request, so
+# we can hand those to a pool of worker processes instead. Without
+# enable() everything runs inline, like it always did.
+#
+import time
+import logging
+import threading
+import multiprocessing
+
+import exceptions
+
+logger = logging.getLogger('totpcgi')
+
+
+class OffloadBusy(exceptions.Exception):
+    def __init__(self, message):
+        exceptions.Exception.__init__(self, message)
+        logger.debug('!OffloadBusy: %s' % message)
+
+
+pool = None
+max_pending = 0
+timeout = 0
+pending = 0
+pending_cond = threading.Condition()
+
+
+def enable(processes=None, queue_size=None, wait_timeout=5):
+    """ Start the worker pool. Must be called before any threads are
+        started, since the workers are forked off this process."""
+    global pool
+    global max_pending
+    global timeout
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if queue_size is None:
+        queue_size = processes * 4
+
+    logger.debug('Offloading hashing to %s processes, with up to %s pending'
+                 % (processes, queue_size))
+
+    pool = multiprocessing.Pool(processes)
+    max_pending = queue_size
+    timeout = wait_timeout
+
+
+def disable():
+    global pool
+
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+        pool = None
+
+
+def _call(func, args):
+    # runs in the worker, make sure the result callback fires even
+    # when func raises, so the slot gets released
+    try:
+        return (True, func(*args))
+    except Exception, ex:
+        return (False, ex)
+
+
+def _release(result):
+    global pending
+
+    with pending_cond:
+        pending -= 1
+        pending_cond.notify()
+
+
+def run(func, *args):
+    """ Run func(*args) in the worker pool, if there is one. func must be
+        a module-level function, and its arguments and return value must
+        be picklable."""
+    global pending
+
+    if pool is None:
+        return func(*args)
+
+    # If the queue is full, wait for a slot, but not forever: it's better
+    # to turn a login away than to let requests pile up behind the pool.
+    deadline = time.time() + timeout
+
+    with pending_cond:
+        while pending >= max_pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise OffloadBusy('Too many pending verifications, try again later')
+            pending_cond.wait(remaining)
+
+        pending += 1
+
+    try:
+        result = pool.apply_async(_call, (func, args), callback=_release)
+    except:
+        _release(None)
+        raise
+
+    try:
+        (success, value) = result.get(timeout)
+    except multiprocessing.TimeoutError:
+        raise OffloadBusy('Timed out waiting for verification')
+
+    if not success:
+        raise value
+
+    return value
@@ -0,0 +1,193 @@
+##
+# Copyright (C) 2012 by Konstantin Ryabitsev and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+#
+# Per-source token buckets, kept in a small mmap'd file so that every
+# CGI process and fcgi worker on the host shares the same counts. This is
+# checked before we look anything up for the user, so abusive sources
+# never get as far as the backends.
+#
+import os
+import mmap
+import time
+import fcntl
+import socket
+import struct
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('totpcgi')
+
+MAGIC = 'TOTPRL01'
+HEADER = struct.Struct('<8sI')
+HEADER_SIZE = 32
+# key digest, tokens left, when we last refilled
+SLOT = struct.Struct('<16sdd')
+EMPTY_KEY = '\0' * 16
+# how far we look for a key before evicting the stalest entry we saw
+PROBES = 8
+
+
+def get_subnet(remote_addr, ipv4_prefix=24, ipv6_prefix=64):
+    if ':' in remote_addr:
+        (family, prefix) = (socket.AF_INET6, ipv6_prefix)
+    else:
+        (family, prefix) = (socket.AF_INET, ipv4_prefix)
+
+    packed = socket.inet_pton(family, remote_addr)
+
+    masked = ''
+    for i in xrange(len(packed)):
+        bits = min(max(prefix - i*8, 0), 8)
+        masked += chr(ord(packed[i]) & (0xff << (8-bits)) & 0xff)
+
+    return '%s/%s' % (socket.inet_ntop(family, masked), prefix)
+
+
+class SourceLimiter:
+    def __init__(self, table_file, ip_burst=10, ip_rate=1.0, subnet_burst=50,
+                 subnet_rate=5.0, slots=4096):
+        self.ip_burst = ip_burst
+        self.ip_rate = ip_rate
+        self.subnet_burst = subnet_burst
+        self.subnet_rate = subnet_rate
+        self.slots = slots
+        # lockf only keeps other processes out, not our own threads
+        self.lock = threading.Lock()
+
+        size = HEADER_SIZE + slots*SLOT.size
+
+        self.fd = os.open(table_file, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(self.fd, HEADER.size)
+            current = os.fstat(self.fd).st_size
+
+            # Other processes may have the table mapped, and touching
+            # anything past the end of a file that shrank under them gets
+            # them killed with SIGBUS, so we only ever set up a table
+            # nobody has set up before us.
+            if current == 0 or (current == size and header == '\0'*HEADER.size):
+                logger.debug('Initializing source limit table %s' % table_file)
+                os.ftruncate(self.fd, size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, slots))
+
+            elif current != size or header != HEADER.pack(MAGIC, slots):
+                raise ValueError('%s is not a source limit table for %s slots, '
+                                 'remove it once nothing is using it' % (table_file, slots))
+
+            self.table = mmap.mmap(self.fd, size, mmap.MAP_SHARED)
+        except:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            raise
+
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _find_slot(self, key):
+        digest = hashlib.md5(key).digest()
+        start = struct.unpack('<I', digest[:4])[0] % self.slots
+
+        stalest = None
+        for i in xrange(PROBES):
+            slot = (start+i) % self.slots
+            offset = HEADER_SIZE + slot*SLOT.size
+            (slot_key, tokens, last) = SLOT.unpack_from(self.table, offset)
+
+            if slot_key == digest:
+                return (offset, digest, tokens, last)
+
+            if slot_key == EMPTY_KEY:
+                return (offset, digest, None, None)
+
+            if stalest is None or last < stalest[1]:
+                stalest = (offset, last)
+
+        return (stalest[0], digest, None, None)
+
+    def _take(self, key, burst, rate, now):
+        (offset, digest, tokens, last) = self._find_slot(key)
+
+        if tokens is None:
+            tokens = burst
+        else:
+            tokens = min(burst, tokens + (now-last)*rate)
+
+        return (offset, digest, tokens)
+
+    def allow(self, remote_addr):
+        """ Takes a token from both the address's and its subnet's bucket,
+            or from neither if either one is empty."""
+        if not remote_addr:
+            return True
+
+        now = time.time()
+
+        try:
+            subnet = get_subnet(remote_addr)
+        except (socket.error, ValueError):
+            logger.debug('Not a valid address: %s' % remote_addr)
+            subnet = remote_addr
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                ip_slot = self._take('ip:' + remote_addr, self.ip_burst,
+                                     self.ip_rate, now)
+                # claim it now, so the subnet can't land in the same slot
+                SLOT.pack_into(self.table, ip_slot[0], ip_slot[1], ip_slot[2], now)
+                subnet_slot = self._take('net:' + subnet, self.subnet_burst,
+                                         self.subnet_rate, now)
+
+                allowed = ip_slot[2] >= 1 and subnet_slot[2] >= 1
+
+                for (offset, digest, tokens) in (ip_slot, subnet_slot):
+                    if allowed:
+                        tokens -= 1
+                    SLOT.pack_into(self.table, offset, digest, tokens, now)
+
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+        if not allowed:
+            logger.debug('Source limit reached for %s' % remote_addr)
+
+        return allowed
+
+    def close(self):
+        self.table.close()
+        os.close(self.fd)
+
+
+def load_from_config(config):
+    """ Returns a SourceLimiter if one is configured in [main], or None."""
+    if not config.has_option('main', 'source_limit_file'):
+        return None
+
+    table_file = config.get('main', 'source_limit_file')
+
+    opts = {}
+    for (option, getter) in (('ip_burst', config.getint),
+                             ('ip_rate', config.getfloat),
+                             ('subnet_burst', config.getint),
+                             ('subnet_rate', config.getfloat)):
+        if config.has_option('main', 'source_limit_' + option):
+            opts[option] = getter('main', 'source_limit_' + option)
+
+    return SourceLimiter(table_file, **opts)
@@ -18,45 +18,184 @@
 #
 
 import os
+import time
 import base64
 import hashlib
 import hmac
 import logging
+import threading
 
 import string
 import struct
 
+from collections import OrderedDict
+
 import totpcgi
+import totpcgi.crypto
+import totpcgi.offload
 
 logger = logging.getLogger('totpcgi')
 
-from Crypto.Cipher import AES
-from passlib.utils.pbkdf2 import pbkdf2
-
 AES_BLOCK_SIZE = 16
+# What the unversioned aes256+hmac256 format always used
 KDF_ITER = 2000
+KDF_MIN_ITER = 1000
+# Anyone who can write a secret could otherwise make every login for it
+# spend minutes in the KDF
+KDF_MAX_ITER = 1000000
 SALT_SIZE = 32
 KEY_SIZE = 32
 
 
-def hash_pincode(pincode, algo='bcrypt'):
+class TTLCache:
+    """ A small in-process cache, where entries expire after ttl seconds
+        and the oldest entries get dropped once we hold maxsize of them."""
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # Since all entries live for the same ttl, insertion order is also
+        # the order in which they expire.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.entries:
+            key = next(iter(self.entries))
+            if self.entries[key][0] > now:
+                break
+            self._drop(key)
+
+    def _drop(self, key):
+        del self.entries[key]
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._expire(time.time())
+            if key not in self.entries:
+                return default
+            return self.entries[key][1]
+
+    def set(self, key, value):
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+
+            if key in self.entries:
+                self._drop(key)
+
+            while len(self.entries) >= self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+            self.entries[key] = (now+self.ttl, value)
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+
+    def keys(self):
+        with self.lock:
+            self._expire(time.time())
+            return list(self.entries.keys())
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._drop(key)
+
+
+class KeyCache(TTLCache):
+    """ A TTLCache for derived keys, which get zeroed out as soon as they
+        are dropped from the cache. Values must be bytearrays."""
+
+    def _drop(self, key):
+        value = self.entries[key][1]
+        for i in xrange(len(value)):
+            value[i] = 0
+        del self.entries[key]
+
+
+# What encrypt_secret uses, see set_kdf_iterations
+kdf_iterations = KDF_ITER
+
+# Only enabled in persistent processes, see enable_kdf_cache
+kdf_cache = None
+kdf_cache_key = None
+
+
+def enable_kdf_cache(ttl, maxsize=256):
+    global kdf_cache
+    global kdf_cache_key
+
+    logger.debug('Caching derived secret keys for %s seconds' % ttl)
+    kdf_cache = KeyCache(ttl, maxsize)
+    kdf_cache_key = os.urandom(32)
+
+
+def set_kdf_iterations(iterations):
+    global kdf_iterations
+
+    if iterations < KDF_MIN_ITER:
+        raise ValueError('Need at least %s KDF iterations' % KDF_MIN_ITER)
+    if iterations > KDF_MAX_ITER:
+        raise ValueError('Need at most %s KDF iterations' % KDF_MAX_ITER)
+
+    kdf_iterations = iterations
+
+
+def derive_key(pincode, salt, kdf='pbkdf2-sha256', iterations=KDF_ITER):
+    if kdf != 'pbkdf2-sha256':
+        raise totpcgi.UserSecretError('Unsupported KDF: %s' % kdf)
+
+    # derive a twice-long key from pincode
+    return totpcgi.crypto.pbkdf2_sha256(pincode, salt, iterations, KEY_SIZE*2)
+
+
+def calibrate_kdf(target_ms=100):
+    """ Returns how many KDF iterations it takes to spend about target_ms
+        milliseconds deriving a key on this host."""
+    salt = os.urandom(SALT_SIZE)
+    iterations = KDF_MIN_ITER
+
+    # keep doubling until we have a measurement worth scaling from
+    while True:
+        start = time.time()
+        derive_key('calibrate', salt, iterations=iterations)
+        elapsed = time.time() - start
+
+        if elapsed >= 0.05 or elapsed*1000 >= target_ms:
+            break
+        iterations *= 2
+
+    iterations = int(iterations * target_ms / (elapsed*1000))
+    # round to the nearest thousand so it reads nicely in the config
+    iterations = int(round(iterations, -3))
+
+    return min(max(iterations, KDF_MIN_ITER), KDF_MAX_ITER)
+
+
+def hash_pincode(pincode, algo='bcrypt', rounds=None):
     if algo not in ('bcrypt', 'sha256', 'sha512', 'md5'):
         raise ValueError('Unsupported algorithm: %s' % algo)
 
     import passlib.hash
 
-    # we stick to 5000 rounds for uniform compatibility
+    # we stick to 5000 rounds by default for uniform compatibility
     # if you want higher computational cost, just use bcrypt
     if algo == 'sha256':
-        return passlib.hash.sha256_crypt.encrypt(pincode, rounds=5000)
+        return passlib.hash.sha256_crypt.encrypt(pincode, rounds=rounds or 5000)
 
     if algo == 'sha512':
-        return passlib.hash.sha512_crypt.encrypt(pincode, rounds=5000)
+        return passlib.hash.sha512_crypt.encrypt(pincode, rounds=rounds or 5000)
 
     if algo == 'md5':
         # really? Okay.
         return passlib.hash.md5_crypt.encrypt(pincode)
 
+    if rounds is not None:
+        return passlib.hash.bcrypt.encrypt(pincode, rounds=rounds)
+
     return passlib.hash.bcrypt.encrypt(pincode)
 
 
@@ -76,11 +215,13 @@ def generate_secret(rate_limit=(3, 30), window_size=3, scratch_tokens=5, bs=80):
     return gaus
 
 
-def encrypt_secret(data, pincode):
-    salt = os.urandom(SALT_SIZE)
+def encrypt_secret(data, pincode, iterations=None):
+    if iterations is None:
+        iterations = kdf_iterations
 
-    # derive a twice-long key from pincode
-    key = pbkdf2(pincode, salt, KDF_ITER, KEY_SIZE*2, prf='hmac-sha256')
+    salt = os.urandom(SALT_SIZE)
+    kdf = 'pbkdf2-sha256'
+    key = derive_key(pincode, salt, kdf, iterations)
 
     # split the key in two, one used for AES, another for HMAC
     aes_key = key[:KEY_SIZE]
@@ -89,12 +230,13 @@ def encrypt_secret(data, pincode):
     pad = AES_BLOCK_SIZE - len(data) % AES_BLOCK_SIZE
     data += pad * chr(pad)
     iv_bytes = os.urandom(AES_BLOCK_SIZE)
-    cypher = AES.new(aes_key, AES.MODE_CBC, iv_bytes)
-    data = iv_bytes + cypher.encrypt(data)
-    sig = hmac.new(hmac_key, data, hashlib.sha256).digest()
+    data = iv_bytes + totpcgi.crypto.aes_cbc_encrypt(aes_key, iv_bytes, data)
+    sig = totpcgi.crypto.hmac_sha256(hmac_key, data)
 
-    # jab it all together in a base64-encrypted format
-    b64str = ('aes256+hmac256$' 
+    # jab it all together in a base64-encrypted format, recording
+    # how the key was derived, so we can change it later
+    b64str = ('aes256+hmac256+v2$'
+              + '%s:%s$' % (kdf, iterations)
               + base64.b64encode(salt).replace('\n', '') + '$'
               + base64.b64encode(data+sig).replace('\n', ''))
 
@@ -103,10 +245,19 @@ def encrypt_secret(data, pincode):
     return b64str
 
 
-def decrypt_secret(b64str, pincode):
+def decrypt_secret(b64str, pincode, user=None):
     # split the secret into components
     try:
-        (scheme, salt, ciphertext) = b64str.split('$')
+        if b64str.startswith('aes256+hmac256+v2$'):
+            (scheme, kdf, salt, ciphertext) = b64str.split('$')
+            (kdf, iterations) = kdf.split(':')
+            iterations = int(iterations)
+            # checked before we spend any time on it
+            if not KDF_MIN_ITER <= iterations <= KDF_MAX_ITER:
+                raise ValueError('Bad KDF iterations: %s' % iterations)
+        else:
+            (scheme, salt, ciphertext) = b64str.split('$')
+            (kdf, iterations) = ('pbkdf2-sha256', KDF_ITER)
 
         salt = base64.b64decode(salt)
         ciphertext = base64.b64decode(ciphertext)
@@ -114,7 +265,20 @@ def decrypt_secret(b64str, pincode):
     except (ValueError, TypeError):
         raise totpcgi.UserSecretError('Failed to parse encrypted secret')
 
-    key = pbkdf2(pincode, salt, KDF_ITER, KEY_SIZE*2, prf='hmac-sha256')
+    cache_key = None
+    key = None
+
+    if kdf_cache is not None and user is not None:
+        # We never keep the pincode itself, just a keyed hash of it
+        cache_key = (user, kdf, iterations, salt,
+                     hmac.new(kdf_cache_key, pincode, hashlib.sha256).digest())
+        key = kdf_cache.get(cache_key)
+
+    if key is not None:
+        logger.debug('Using cached key for %s' % user)
+        key = str(key)
+    else:
+        key = totpcgi.offload.run(derive_key, pincode, salt, kdf, iterations)
 
     aes_key = key[:KEY_SIZE]
     hmac_key = key[KEY_SIZE:]
@@ -124,14 +288,17 @@ def decrypt_secret(b64str, pincode):
     data = ciphertext[:-sig_size]
 
     # verify hmac sig first
-    if hmac.new(hmac_key, data, hashlib.sha256).digest() != sig:
+    if totpcgi.crypto.hmac_sha256(hmac_key, data) != sig:
         raise totpcgi.UserSecretError('Failed to verify hmac!')
 
+    # only keys that actually verified ever make it into the cache
+    if cache_key is not None:
+        kdf_cache.set(cache_key, bytearray(key))
+
     iv_bytes = data[:AES_BLOCK_SIZE]
     data = data[AES_BLOCK_SIZE:]
 
-    cypher = AES.new(aes_key, AES.MODE_CBC, iv_bytes)
-    data = cypher.decrypt(data)
+    data = totpcgi.crypto.aes_cbc_decrypt(aes_key, iv_bytes, data)
     secret = data[:-ord(data[-1])]
 
     logger.debug('Decryption successful')